@@ -1,15 +1,27 @@
 from types import new_class
 import streamlit as st
-from PIL import Image
-import tensorflow as tf
 import numpy as np
-import requests
-import json
-from pathlib import Path
 import time
 import os
-import hashlib
-import sqlite3
+
+import bulk_diagnosis
+import diagnosis
+import metrics
+import near_duplicates
+import tiling
+from connectivity import REFRESH_WAIT, get_monitor
+from diagnosis import CLASS_NAMES, TTA_THRESHOLD
+from inference_batcher import get_batcher
+from inference_pool import POOL_SOCKET
+from model_registry import get_registry, model_version
+from model_versions import get_router
+from prediction_store import get_store
+from preprocessing import content_hash, load_image, read_bytes, tta_views
+from result_cache import get_result_cache
+from sync_worker import get_sync_worker
+from treatment_kb import get_kb
+from usage_stats import DASHBOARD_DAYS, get_usage_stats
+from user_store import get_user_store
 
 # Set page config (must be first Streamlit command)
 st.set_page_config(layout="wide")
@@ -18,46 +30,9 @@ st.set_page_config(layout="wide")
 # AUTHENTICATION SYSTEM
 # ===========================================
 
-# Initialize SQLite database for user authentication
-def init_db():
-    conn = sqlite3.connect('users.db')
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS users
-                 (username TEXT PRIMARY KEY, 
-                  password TEXT, 
-                  email TEXT)''')
-    conn.commit()
-    conn.close()
-
-init_db()
-
-# Hash password for security
-def hash_password(password):
-    return hashlib.sha256(password.encode()).hexdigest()
-
-# User authentication functions
-def create_user(username, password, email):
-    conn = sqlite3.connect('users.db')
-    c = conn.cursor()
-    try:
-        c.execute("INSERT INTO users VALUES (?, ?, ?)", 
-                 (username, hash_password(password), email))
-        conn.commit()
-        return True
-    except sqlite3.IntegrityError:
-        return False  # Username already exists
-    finally:
-        conn.close()
-
-def verify_user(username, password):
-    conn = sqlite3.connect('users.db')
-    c = conn.cursor()
-    c.execute("SELECT password FROM users WHERE username=?", (username,))
-    result = c.fetchone()
-    conn.close()
-    if result:
-        return result[0] == hash_password(password)
-    return False
+# users.db access (pooled connections, scrypt hashes); the table is
+# created once per process rather than on every rerun
+user_store = get_user_store()
 
 # Authentication state
 if 'authenticated' not in st.session_state:
@@ -79,9 +54,16 @@ if not st.session_state.authenticated:
             login_button = st.form_submit_button("Login")
             
             if login_button:
-                if verify_user(username, password):
+                if user_store.verify_user(username, password):
                     st.session_state.authenticated = True
                     st.session_state.username = username
+                    # Records from before logins existed go to one owner
+                    # (prediction_store.LEGACY_OWNER) rather than to nobody
+                    get_store().claim_unowned(username)
+                    # Start loading TensorFlow and the model while the dashboard renders
+                    # (the inference pool, when used, has its own copy)
+                    if not POOL_SOCKET:
+                        get_registry().preload()
                     st.success("Login successful!")
                     st.rerun()  # Refresh to show main app
                 else:
@@ -102,7 +84,7 @@ if not st.session_state.authenticated:
                 elif len(new_password) < 6:
                     st.error("Password must be at least 6 characters")
                 else:
-                    if create_user(new_username, new_password, new_email):
+                    if user_store.create_user(new_username, new_password, new_email):
                         st.success("Account created successfully! Please login.")
                     else:
                         st.error("Username already exists")
@@ -113,134 +95,98 @@ if not st.session_state.authenticated:
 # MAIN APPLICATION
 # ===========================================
 
-# Local treatment database (fallback when offline)
-LOCAL_TREATMENTS = {
-    'Tomato___Bacterial_spot': {
-        'description': 'Caused by Xanthomonas bacteria, appears as small water-soaked spots',
-        'treatment': {
-            'prevention': [
-                'Use disease-free seeds',
-                'Practice crop rotation (2-3 years)',
-                'Avoid overhead watering'
-            ],
-            'organic': [
-                'Copper-based fungicides',
-                'Bacillus subtilis products'
-            ],
-            'chemical': [
-                'Streptomycin sulfate (limited availability)',
-                'Copper hydroxide'
-            ]
-        }
-    },
-    'Tomato___Early_blight': {
-        'description': 'Fungal disease causing concentric rings on leaves',
-        'treatment': {
-            'prevention': [
-                'Remove infected plant debris',
-                'Ensure proper plant spacing'
-            ],
-            'organic': [
-                'Copper fungicides',
-                'Baking soda sprays (1 tbsp/gallon)'
-            ],
-            'chemical': [
-                'Chlorothalonil',
-                'Mancozeb'
-            ]
-        }
-    },
-    'Tomato___healthy': {
-        'description': 'No disease detected',
-        'treatment': {
-            'prevention': [
-                'Maintain good growing conditions',
-                'Regularly inspect plants'
-            ],
-            'organic': [],
-            'chemical': []
-        }
-    }
-}
-
-# API integration for treatment info
-def get_treatment_info(disease_name):
-    """Get treatment info from API if online, otherwise use local database"""
-    if is_online():
-        try:
-            response = requests.get(
-                f"https://www.researchgate.net/publication/366308502_An_Automatic_Recommendation_System_for_Plant_Disease_Treatment{disease_name}",
-                timeout=3
-            )
-            if response.status_code == 200:
-                return response.json()
-        except:
-            pass
-    
-    return LOCAL_TREATMENTS.get(disease_name, {
-        'description': 'No information available for this disease',
-        'treatment': {
-            'prevention': ['Consult local agricultural extension officer'],
-            'organic': [],
-            'chemical': []
-        }
-    })
+# Treatment knowledge base
+def lookup_treatment(disease_name):
+    """(treatment info, knowledge-base version); refreshes from the remote source when online"""
+    with metrics.span("treatment.lookup"):
+        return diagnosis.lookup_treatment(disease_name, online=is_online())
 
 # OFFLINE-ONLINE INFRASTRUCTURE
 def is_online():
-    try:
-        requests.get("https://www.google.com", timeout=2)
-        return True
-    except:
-        return False
+    # Cached by the background probe; the sidebar toggle forces offline
+    with metrics.span("connectivity.is_online"):
+        return get_monitor().is_online(force_offline=st.session_state.get("offline_mode", False))
 
-LOCAL_DATA_PATH = Path("local_predictions.json")
 os.makedirs("local_cache", exist_ok=True)
 
-def load_local_data():
-    if LOCAL_DATA_PATH.exists():
-        return json.loads(LOCAL_DATA_PATH.read_text())
-    return {"predictions": []}
-
-def save_local_data(data):
-    LOCAL_DATA_PATH.write_text(json.dumps(data))
-
-def sync_predictions_to_cloud(prediction_data):
+# Usernames that see the per-request timing breakdown in the sidebar
+ADMIN_USERS = {name.strip() for name in os.environ.get("CROP_ADMIN_USERS", "").split(",") if name.strip()}
+
+# Predictions and feedback live in predictions.db; local_predictions.json
+# is imported once on first use
+store = get_store()
+# Uploads unsynced records in the background (enabled by CROP_SYNC_URL)
+sync_worker = get_sync_worker()
+
+def model_prediction(data, image_hash, tta=False):
+    """(calibrated class probabilities, model version) for upload bytes with content hash image_hash.
+
+    tta=True averages over augmented views.
+    """
+    # Keyed on the model's content hash, so a new model file never hits stale results
+    # (this also triggers the registry's periodic change check)
+    # The user's A/B bucket decides which model serves them
+    backend = router.choose(st.session_state.username)
+    with metrics.span("predict.model"):
+        model_hash = backend.model_digest()
+    cache_key = f"{image_hash}:tta" if tta else image_hash
+    with metrics.span("predict.result_cache"):
+        probabilities = result_cache.get(cache_key, model_hash)
+    if probabilities is None:
+        # uint8 128x128, cached by content hash so re-predicting skips decoding
+        with metrics.span("predict.decode"):
+            input_arr = load_image(data, key=image_hash)
+        # Concurrent sessions are grouped into a single forward pass, and so
+        # are the augmented views of one image. The result is cached and
+        # tagged under the model that computed it, which differs from
+        # model_hash if a new model was swapped in meanwhile.
+        if tta:
+            with metrics.span("predict.inference_tta"):
+                probabilities, model_hash = router.predict_served(backend, tta_views(input_arr))
+                probabilities = probabilities.mean(axis=0)
+        else:
+            with metrics.span("predict.inference"):
+                probabilities, model_hash = router.predict_served(backend, [input_arr])
+                probabilities = probabilities[0]
+        with metrics.span("predict.result_cache_put"):
+            result_cache.put(cache_key, model_hash, probabilities)
+    # Scaled by the temperature fitted for the model that computed them
+    return diagnosis.calibrate(probabilities, digest=model_hash), model_version(model_hash)
+
+
+def model_ready(backend):
+    """Load backend's model if needed; if it can't be loaded, say why and return False"""
     try:
-        time.sleep(1)
-        return True
-    except:
+        backend.model_digest()
+    except Exception as e:
+        st.warning(f"The model couldn't be loaded, so photos can't be diagnosed right now: {e}")
         return False
-
-def get_cloud_updates():
-    try:
-        return {"predictions": []}
-    except:
-        return None
-
-def model_prediction(test_image):
-    model_path = "trained_model2.keras"
-    local_cache_path = Path("local_cache/model.keras")
-    
-    if is_online():
-        try:
-            if local_cache_path.exists():
-                os.remove(local_cache_path)
-            import shutil
-            shutil.copy(model_path, local_cache_path)
-        except Exception as e:
-            st.warning(f"Couldn't update model: {e}")
-    
-    if local_cache_path.exists():
-        model = tf.keras.models.load_model(local_cache_path)
-    else:
-        model = tf.keras.models.load_model(model_path)
-    
-    image = tf.keras.preprocessing.image.load_img(test_image, target_size=(128,128))
-    input_arr = tf.keras.preprocessing.image.img_to_array(image)
-    input_arr = np.array([input_arr])
-    prediction = model.predict(input_arr)
-    return np.argmax(prediction)
+    return True
+
+
+def tiled_prediction(data):
+    """tiling.predict_tiled() on the upload's bytes plus its "model_version"; None if it shows too little plant to tile"""
+    backend = router.choose(st.session_state.username)
+    # Through the router, so tiled batches are recorded and shadow-scored
+    # too, under the model that actually served them
+    with metrics.span("predict.tiled"):
+        tiled = tiling.predict_tiled(data, lambda image_arrays: router.predict_served(backend, image_arrays))
+    if tiled:
+        tiled["model_version"] = model_version(tiled["model_digest"])
+    return tiled
+
+# Load and warm the shared model in the background (no-op once loaded);
+# the first prediction waits for it if it hasn't finished yet. With
+# CROP_INFERENCE_SOCKET set, inference runs in the pool processes instead.
+if not POOL_SOCKET:
+    get_registry().preload()
+result_cache = get_result_cache()
+# A/B routing and shadow scoring when CROP_CANDIDATE_MODEL is set
+router = get_router()
+# Perceptual hashes of diagnosed photos, for re-uploads and similar cases
+duplicate_index = near_duplicates.get_index()
+# Aggregates kept current by triggers on predictions.db (usage_stats.py)
+usage_stats = get_usage_stats()
 
 # ===========================================
 # MAIN PAGE LAYOUT WITH DASHBOARD
@@ -324,13 +270,59 @@ for i, (page_name, page_info) in enumerate(DASHBOARD_ITEMS.items()):
             st.session_state.selected_page = page_name
             st.rerun()
 
+# Offline/Online toggle in sidebar (read before the status so it applies this rerun)
+st.session_state.offline_mode = st.sidebar.toggle("Offline Mode", value=False)
+st.sidebar.toggle("Re-check unsure photos", value=True, key="tta_enabled",
+                  help=f"Predictions below {TTA_THRESHOLD:.0%} confidence are re-scored with "
+                       "test-time augmentation (flips, rotations and crops)")
+st.sidebar.toggle("Tile large photos", value=False, key="tiled_enabled",
+                  help="Classify overlapping 128x128 tiles of the leafy parts of the photo "
+                       "instead of the whole photo shrunk to 128x128; slower, but finds small "
+                       "lesions on wide field shots")
+st.sidebar.toggle("Reuse results for repeat photos", value=True, key="dedupe_enabled",
+                  help="A re-compressed, slightly cropped or renamed copy of a photo you already "
+                       "diagnosed reuses that diagnosis instead of being analyzed again")
+
 # Status indicator
 online_status = is_online()
-st.sidebar.markdown(f"**Status:** {'Online 🌐' if online_status else 'Offline 📴'}")
+if st.session_state.offline_mode:
+    st.sidebar.markdown("**Status:** Offline 📴 (forced)")
+elif get_monitor().status is None:
+    st.sidebar.markdown("**Status:** Checking connection...")
+else:
+    st.sidebar.markdown(f"**Status:** {'Online 🌐' if online_status else 'Offline 📴'}")
 st.sidebar.markdown(f"**Logged in as:** {st.session_state.username}")
-
-# Offline/Online toggle in sidebar
-st.session_state.offline_mode = st.sidebar.toggle("Offline Mode", value=False)
+if POOL_SOCKET:
+    st.sidebar.markdown(f"**Model:** Inference pool ({len(get_batcher().workers)} workers)")
+else:
+    registry = get_registry()
+    if registry.loaded:
+        st.sidebar.markdown(f"**Model:** Ready ({registry.version})")
+    elif registry.load_error:
+        st.sidebar.markdown("**Model:** Unavailable")
+        st.sidebar.warning(f"The model couldn't be loaded: {registry.load_error}")
+    else:
+        st.sidebar.markdown("**Model:** Loading...")
+
+# Inference scheduler stats for tuning MAX_BATCH_SIZE / MAX_WAIT
+with st.sidebar.expander("Inference Stats"):
+    batcher_stats = get_batcher().stats()
+    st.write(f"**Requests:** {batcher_stats['requests']} in {batcher_stats['batches']} batches")
+    st.write(f"**Queue depth:** {batcher_stats['queue_depth']}")
+    st.write("**Batch sizes:**", batcher_stats["batch_size_histogram"])
+    st.write("**Queue depth at dispatch:**", batcher_stats["queue_depth_histogram"])
+    cache_stats = result_cache.stats()
+    st.write(f"**Result cache:** {cache_stats['hits']} hits / {cache_stats['misses']} misses")
+
+with st.sidebar.expander("Sync"):
+    sync_stats = sync_worker.stats()
+    if sync_stats["enabled"]:
+        st.write(f"**Sync:** {sync_stats['pending']} pending, {sync_stats['uploaded']} uploaded, "
+                 f"{sync_stats['pulled']} pulled")
+        if sync_stats["last_error"]:
+            st.write(f"**Last sync error:** {sync_stats['last_error']}")
+    else:
+        st.write("**Sync:** disabled (CROP_SYNC_URL not set)")
 
 # ===========================================
 # PAGE CONTENT
@@ -351,67 +343,211 @@ def show_home():
         col1, col2, col3 = st.columns(3)
         with col1:
             if st.button("🔄 Check for Updates"):
-                if is_online():
+                # Wait for a fresh probe, not the status cached before the click
+                with st.spinner("Checking connection..."):
+                    get_monitor().refresh(wait=REFRESH_WAIT)
+                if not is_online():
+                    st.warning("Cannot check for updates - you're offline")
+                elif not sync_worker.enabled:
                     st.success("System is up to date!")
                 else:
-                    st.warning("Cannot check for updates - you're offline")
+                    try:
+                        with st.spinner("Fetching updates..."):
+                            pulled = sync_worker.pull_updates()
+                        if pulled["records"]:
+                            st.success(f"Fetched {pulled['records']} new records")
+                        else:
+                            st.success("System is up to date!")
+                    except Exception as e:
+                        st.warning(f"Couldn't fetch updates: {e}")
         
         with col2:
             if st.button("📊 View Statistics"):
-                st.info("Feature coming soon!")
+                st.session_state.selected_page = "Statistics"
+                st.rerun()
         
         with col3:
             if st.button("🆘 Get Help"):
                 st.info("Contact support.planthealth@gmail.com")
 
+def show_bulk_diagnosis():
+    uploads = st.file_uploader(
+        "Upload images or zip archives",
+        type=["jpg", "png", "jpeg", "gif", "zip"],
+        accept_multiple_files=True
+    )
+    
+    if uploads and st.button("Run Bulk Diagnosis") and model_ready(get_batcher()):
+        # Counted from the file names; images are only read as they are decoded
+        total = bulk_diagnosis.count_images(uploads)
+        if not total:
+            st.warning("No images found in the upload")
+            return
+        
+        progress = st.progress(0.0, text=f"Analyzing 0/{total} images...")
+        table = st.empty()
+        rows = []
+        records = []
+        treatments = {}
+        timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
+        
+        # Bulk runs always use the primary model; each record is tagged with
+        # the version that scored its batch, which a hot swap can change mid-run
+        for batch in bulk_diagnosis.diagnose(bulk_diagnosis.expand_uploads(uploads)):
+            for image_name, result_index, confidence, model_hash, error in batch:
+                disease_name = CLASS_NAMES[result_index] if error is None else None
+                rows.append({"image_name": image_name, "prediction": disease_name,
+                             "confidence": confidence, "error": error})
+                if error is None:
+                    # One treatment lookup per label, not per image
+                    if disease_name not in treatments:
+                        treatments[disease_name] = lookup_treatment(disease_name)[1]
+                    records.append({
+                        "timestamp": timestamp,
+                        "username": st.session_state.username,
+                        "image_name": image_name,
+                        "prediction": disease_name,
+                        "confidence": confidence,
+                        "synced": False,
+                        "treatment_id": disease_name,
+                        "treatment_version": treatments[disease_name],
+                        "model_version": model_version(model_hash)
+                    })
+            progress.progress(len(rows) / total, text=f"Analyzing {len(rows)}/{total} images...")
+            table.dataframe(rows, use_container_width=True)
+        
+        store.add_predictions(records)
+        sync_worker.notify()
+        metrics.inc("predictions_total", len(records), source="bulk", tta="false")
+        failed = len(rows) - len(records)
+        st.success(f"Diagnosed {len(records)} images" + (f" ({failed} could not be read)" if failed else ""))
+        st.download_button(
+            "Download results as CSV",
+            bulk_diagnosis.results_to_csv(rows),
+            file_name=f"bulk_diagnosis_{time.strftime('%Y%m%d_%H%M%S')}.csv",
+            mime="text/csv"
+        )
+
 def show_disease_detection():
     st.title("Disease Detection")
+    mode = st.radio("Mode", ["Single image", "Bulk"], horizontal=True)
+    if mode == "Bulk":
+        show_bulk_diagnosis()
+        return
+    
     test_image = st.file_uploader("Upload image", type=["jpg", "png","jpeg","gif"])
         
     if test_image:
         if st.button("Show Image"):
             st.image(test_image, use_column_width=60)
         
-        if st.button("Predict"):
+        if st.button("Predict") and model_ready(router.choose(st.session_state.username)):
             with st.spinner("Analyzing image..."):
-                result_index = model_prediction(test_image)
+                # Timed stage by stage; admins see the breakdown in the sidebar
+                with metrics.trace("predict") as request_trace:
+                    with metrics.span("predict.read_hash"):
+                        data = read_bytes(test_image)
+                        image_hash = content_hash(data)
+                    # Decoded once and cached under image_hash, where
+                    # model_prediction() finds it
+                    with metrics.span("predict.image_hashes"):
+                        hashes = near_duplicates.image_hashes(load_image(data, key=image_hash)[None])[0]
+                    tiled_enabled = st.session_state.get("tiled_enabled")
+                    tta_enabled = st.session_state.get("tta_enabled", True)
+                    # A re-upload of a photo this user already had diagnosed by the
+                    # same model, the same way, reuses that prediction and its record
+                    duplicate = None
+                    if st.session_state.get("dedupe_enabled", True):
+                        version = router.version(router.choose(st.session_state.username))
+                        modes = ["tiled"] if tiled_enabled else ["plain", "tta"]
+                        duplicate = duplicate_index.find_duplicate(st.session_state.username, hashes,
+                                                                   version, modes)
+                        # An unsure result from before TTA was turned on gets TTA now
+                        if (duplicate and duplicate["mode"] == "plain" and tta_enabled
+                                and duplicate["probabilities"].max() < TTA_THRESHOLD):
+                            duplicate = None
+                    tiled = None
+                    if duplicate:
+                        probabilities, prediction_mode = duplicate["probabilities"], duplicate["mode"]
+                        router.reused(version)
+                    elif tiled_enabled:
+                        tiled = tiled_prediction(data)
+                    if tiled:
+                        probabilities, version = tiled["probabilities"], tiled["model_version"]
+                        prediction_mode = "tiled"
+                    elif not duplicate:
+                        probabilities, version = model_prediction(data, image_hash)
+                        prediction_mode = "plain"
+                        # Only unsure photos pay for test-time augmentation
+                        if probabilities.max() < TTA_THRESHOLD and tta_enabled:
+                            probabilities, version = model_prediction(data, image_hash, tta=True)
+                            prediction_mode = "tta"
+                    result_index = int(np.argmax(probabilities))
+                    confidence = float(probabilities[result_index])
                 
-                class_name = [
-                    'Tomato___Bacterial_spot',
-                    'Tomato___Early_blight',
-                    'Tomato___Late_blight',
-                    'Tomato___Leaf_Mold',
-                    'Tomato___Septoria_leaf_spot',
-                    'Tomato___Spider_mites Two-spotted_spider_mite',
-                    'Tomato___Target_Spot',
-                    'Tomato___Tomato_Yellow_Leaf_Curl_Virus',
-                    'Tomato___Tomato_mosaic_virus',
-                    'Tomato___healthy'
-                ]
+                    disease_name = CLASS_NAMES[result_index]
+                    treatment_info, treatment_version = lookup_treatment(disease_name)
                 
-                disease_name = class_name[result_index]
-                treatment_info = get_treatment_info(disease_name)
+                    prediction_result = {
+                        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+                        "username": st.session_state.username,
+                        "image_name": test_image.name,
+                        "prediction": disease_name,
+                        "confidence": confidence,
+                        "synced": False,
+                        "treatment_id": disease_name,
+                        "treatment_version": treatment_version,
+                        "model_version": version
+                    }
                 
-                prediction_result = {
-                    "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
-                    "image_name": test_image.name,
-                    "prediction": disease_name,
-                    "synced": False,
-                    "treatment_info": treatment_info
-                }
+                    # Clicking Predict again on the same upload reuses its record
+                    # instead of appending a duplicate
+                    recorded = st.session_state.setdefault("recorded_uploads", {})
+                    upload_key = (test_image.file_id, result_index)
+                    existing = store.get_prediction(recorded[upload_key]) if upload_key in recorded else None
+                    if duplicate and not existing:
+                        existing = store.get_prediction(duplicate["prediction_id"])
                 
-                data = load_local_data()
-                data["predictions"].append(prediction_result)
-                save_local_data(data)
+                    if existing:
+                        prediction_result = existing
+                        record_id = existing["id"]
+                    else:
+                        record_id = recorded[upload_key] = store.add_prediction(prediction_result)
+                        duplicate_index.add(record_id, st.session_state.username, hashes, version,
+                                            prediction_mode, probabilities)
+                        # Uploaded by the background worker; don't wait for it here
+                        sync_worker.notify()
+                st.session_state.last_prediction = {"id": record_id, "prediction": disease_name,
+                                                    "file_id": test_image.file_id}
+                st.session_state.last_trace = request_trace.breakdown()
+                metrics.inc("predictions_total", source="single", tta=str(prediction_mode == "tta").lower(),
+                            tiled=str(bool(tiled)).lower(), duplicate=str(bool(duplicate)).lower())
                 
-                if is_online():
-                    if sync_predictions_to_cloud(prediction_result):
-                        prediction_result["synced"] = True
-                        data["predictions"][-1] = prediction_result
-                        save_local_data(data)
-                        st.balloons()
+                if duplicate and existing:
+                    st.info(f"This looks like the photo you uploaded as {existing['image_name']} "
+                            f"on {existing['timestamp']}, so that diagnosis was reused")
+                st.success(f"**Disease Identified:** {disease_name} ({confidence:.0%} confidence)")
+                if confidence < TTA_THRESHOLD:
+                    st.warning("Low confidence. Try retaking the photo of a single leaf in good, even light.")
                 
-                st.success(f"**Disease Identified:** {disease_name}")
+                if tiled:
+                    method = f" (from {tiled['tiles']} tiles)"
+                elif prediction_mode == "tiled":
+                    method = " (from tiles)"
+                elif prediction_mode == "tta":
+                    method = " (with test-time augmentation)"
+                else:
+                    method = ""
+                st.write(f"**Top matches**{method}:")
+                for label, probability in diagnosis.top_k(probabilities):
+                    st.progress(probability, text=f"{label.replace('___', ': ').replace('_', ' ')} — {probability:.1%}")
+                if tiled:
+                    rows, cols = tiled["grid"]
+                    st.image(tiled["overlay"], use_container_width=True,
+                             caption=f"Red marks likely disease ({tiled['tiles']} of {rows * cols} tiles "
+                                     "were leaf and got classified)")
+                elif tiled_enabled and prediction_mode != "tiled":
+                    st.caption("Too little leaf in view to tile this photo; classified it whole")
                 
                 with st.expander("🔍 Disease Details", expanded=True):
                     st.write(f"**Description:** {treatment_info['description']}")
@@ -430,43 +566,51 @@ def show_disease_detection():
                         for treatment in treatment_info['treatment']['chemical']:
                             st.write(f"- {treatment}")
                 
-                st.info("Prediction saved locally" if not prediction_result["synced"] else "Prediction synced to cloud")
-
-                # Feedback system
-                st.markdown("---")
-                with st.form("feedback_form"):
-                    st.write("Was this diagnosis helpful?")
-                    feedback = st.radio(
-                        "Accuracy:",
-                        ["Correct", "Partially correct", "Incorrect"],
-                        index=None
-                    )
-                    notes = st.text_area("Additional notes (optional)")
-                    submitted = st.form_submit_button("Submit Feedback")
-                    
-                    if submitted and feedback:
-                        feedback_data = {
-                            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
-                            "prediction": disease_name,
-                            "feedback": feedback,
-                            "notes": notes,
-                            "synced": False
-                        }
-                        
-                        if "feedback" not in data:
-                            data["feedback"] = []
-                        data["feedback"].append(feedback_data)
-                        save_local_data(data)
-                        
-                        if is_online():
-                            try:
-                                feedback_data["synced"] = True
-                                data["feedback"][-1] = feedback_data
-                                save_local_data(data)
-                            except:
-                                pass
-                        
-                        st.success("Thank you for your feedback!")
+                if prediction_result["synced"]:
+                    st.info("Prediction synced to cloud")
+                elif sync_worker.enabled:
+                    st.info("Prediction saved locally; it will sync in the background")
+                else:
+                    st.info("Prediction saved locally")
+
+        # Outside the Predict block: submitting the form reruns the script,
+        # and the Predict button is not pressed on that rerun
+        last_prediction = st.session_state.get("last_prediction")
+        if last_prediction and last_prediction["file_id"] == test_image.file_id:
+            show_feedback_form(last_prediction)
+
+def show_feedback_form(last_prediction):
+    st.markdown("---")
+    if last_prediction.get("feedback_id"):
+        st.success("Thank you for your feedback!")
+        return
+    with st.form("feedback_form"):
+        st.write("Was this diagnosis helpful?")
+        feedback = st.radio(
+            "Accuracy:",
+            ["Correct", "Partially correct", "Incorrect"],
+            index=None
+        )
+        actual = st.selectbox("If incorrect, what was it actually? (optional)", ["Not sure", *CLASS_NAMES])
+        notes = st.text_area("Additional notes (optional)")
+        submitted = st.form_submit_button("Submit Feedback")
+
+    if submitted and feedback:
+        feedback_data = {
+            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "prediction": last_prediction["prediction"],
+            "prediction_id": last_prediction["id"],
+            "actual_label": actual if feedback == "Incorrect" and actual != "Not sure" else None,
+            "username": st.session_state.username,
+            "feedback": feedback,
+            "notes": notes,
+            "synced": False
+        }
+
+        last_prediction["feedback_id"] = store.add_feedback(feedback_data)
+        sync_worker.notify()
+
+        st.success("Thank you for your feedback!")
 
 def show_pest_identification():
     st.title("Pest Identification")
@@ -477,10 +621,12 @@ def show_treatment_guide():
     st.title("Treatment Guide")
     st.write("Browse our comprehensive treatment guide:")
     
-    disease = st.selectbox("Select a disease", list(LOCAL_TREATMENTS.keys()))
+    kb = get_kb()
+    disease = st.selectbox("Select a disease", kb.labels())
+    st.caption(f"Knowledge base version {kb.version}")
     
-    if disease in LOCAL_TREATMENTS:
-        treatment_info = LOCAL_TREATMENTS[disease]
+    treatment_info, _ = kb.lookup(disease, online=is_online())
+    if treatment_info:
         st.subheader(disease.replace("_", " "))
         
         st.write(f"**Description:** {treatment_info['description']}")
@@ -526,38 +672,162 @@ def show_prevention_tips():
 
 def show_history():
     st.title("Prediction History")
-    data = load_local_data()
+    username = st.session_state.username
+    
+    # Server-side filters; changing any of them starts again from page one
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        disease = st.selectbox("Disease", ["All"] + store.user_labels(username))
+    with col2:
+        date_from = st.date_input("From", value=None)
+    with col3:
+        date_to = st.date_input("To", value=None)
     
-    if "predictions" not in data or not data["predictions"]:
+    filters = (disease, date_from, date_to)
+    if st.session_state.get("history_filters") != filters:
+        st.session_state.history_filters = filters
+        # Cursors of the pages visited so far; the last one is the current page
+        st.session_state.history_cursors = [None]
+    cursors = st.session_state.history_cursors
+    
+    predictions, next_cursor = store.history_page(
+        username,
+        cursor=cursors[-1],
+        disease=None if disease == "All" else disease,
+        date_from=date_from,
+        date_to=date_to,
+    )
+    
+    if not predictions:
         st.info("No prediction history found")
         return
     
-    for prediction in reversed(data["predictions"]):
+    for prediction in predictions:
         with st.expander(f"{prediction['timestamp']} - {prediction['image_name']}"):
-            st.write(f"**Prediction:** {prediction['prediction']}")
+            confidence = prediction.get("confidence")
+            st.write(f"**Prediction:** {prediction['prediction']}"
+                     + (f" ({confidence:.0%} confidence)" if confidence is not None else ""))
             st.write(f"**Status:** {'Synced to cloud' if prediction.get('synced', False) else 'Local only'}")
+            if prediction.get("model_version"):
+                st.caption(f"Model version {prediction['model_version']}")
+            
+            # Photos of this user's within the perceptual-hash radius (near_duplicates.py)
+            if st.toggle("Show similar past cases", key=f"similar_{prediction['id']}"):
+                similar = [(distance, store.get_prediction(other_id))
+                           for distance, other_id in duplicate_index.similar(prediction["id"])]
+                similar = [(distance, other) for distance, other in similar if other]
+                if similar:
+                    for distance, other in similar:
+                        st.write(f"- {other['timestamp']} — {other['image_name']}: {other['prediction']}"
+                                 f" ({'near-identical' if distance <= near_duplicates.DUPLICATE_PHASH else 'similar'})")
+                else:
+                    st.write("No similar photos found (only photos diagnosed since similarity "
+                             "search was added are indexed)")
             
-            if "treatment_info" in prediction:
+            # Treatment details are only fetched for records the user opens
+            if not st.toggle("Show treatment information", key=f"treatment_{prediction['id']}"):
+                continue
+            treatment = store.get_treatment(prediction["id"]) or {}
+            # Older records carry the full payload; newer ones reference the
+            # knowledge-base version they were diagnosed with
+            treatment_info = treatment.get("treatment_info")
+            if treatment_info is None and treatment.get("treatment_id"):
+                treatment_info = get_kb().get(treatment["treatment_id"], treatment["treatment_version"])
+            if treatment_info:
                 st.write("**Treatment Information:**")
-                st.write(prediction["treatment_info"]["description"])
+                st.write(treatment_info["description"])
                 
                 cols = st.columns(3)
                 with cols[0]:
                     st.write("**Prevention:**")
-                    for item in prediction["treatment_info"]["treatment"]["prevention"]:
+                    for item in treatment_info["treatment"]["prevention"]:
                         st.write(f"- {item}")
                 
                 with cols[1]:
-                    if prediction["treatment_info"]["treatment"]["organic"]:
+                    if treatment_info["treatment"]["organic"]:
                         st.write("**Organic:**")
-                        for item in prediction["treatment_info"]["treatment"]["organic"]:
+                        for item in treatment_info["treatment"]["organic"]:
                             st.write(f"- {item}")
                 
                 with cols[2]:
-                    if prediction["treatment_info"]["treatment"]["chemical"]:
+                    if treatment_info["treatment"]["chemical"]:
                         st.write("**Chemical:**")
-                        for item in prediction["treatment_info"]["treatment"]["chemical"]:
+                        for item in treatment_info["treatment"]["chemical"]:
                             st.write(f"- {item}")
+    
+    col1, col2, col3 = st.columns([1, 2, 1])
+    with col1:
+        if len(cursors) > 1 and st.button("← Newer"):
+            cursors.pop()
+            st.rerun()
+    with col2:
+        st.caption(f"Page {len(cursors)}")
+    with col3:
+        if next_cursor and st.button("Older →"):
+            cursors.append(next_cursor)
+            st.rerun()
+
+def short_label(label):
+    return label.replace("___", ": ").replace("_", " ")
+
+def show_statistics():
+    st.title("Statistics")
+    scope = st.radio("Show", ["My predictions", "All users"], horizontal=True)
+    username = st.session_state.username if scope == "My predictions" else None
+    
+    totals = usage_stats.label_totals(username)
+    accuracy = usage_stats.feedback_accuracy(username)
+    backlog = usage_stats.sync_backlog()
+    rated = sum(sum(v for k, v in counts.items() if k != "accuracy") for counts in accuracy.values())
+    correct = sum(counts.get("Correct", 0) for counts in accuracy.values())
+    
+    col1, col2, col3 = st.columns(3)
+    col1.metric("Predictions", sum(totals.values()))
+    col2.metric("Rated correct", f"{correct / rated:.0%}" if rated else "—",
+                help=f"Share of {rated} feedback entries marked Correct")
+    col3.metric("Waiting to sync", backlog["unsynced_predictions"] + backlog["unsynced_feedback"],
+                help="Predictions and feedback on this device not uploaded yet")
+    
+    if not totals:
+        st.info("No predictions yet")
+        return
+    
+    st.subheader("Diagnoses")
+    st.bar_chart([{"disease": short_label(label), "predictions": count} for label, count in totals.items()],
+                 x="disease", y="predictions", horizontal=True)
+    
+    st.subheader(f"Last {DASHBOARD_DAYS} days")
+    daily = usage_stats.daily_counts(username)
+    if daily:
+        st.bar_chart([{"day": row["day"], "disease": short_label(row["label"]), "predictions": row["count"]}
+                      for row in daily], x="day", y="predictions", color="disease")
+    else:
+        st.write(f"No predictions in the last {DASHBOARD_DAYS} days")
+    
+    st.subheader("Feedback accuracy")
+    if accuracy:
+        st.dataframe(
+            [{"disease": short_label(label),
+              "rated": sum(v for k, v in counts.items() if k != "accuracy"),
+              "correct": counts.get("Correct", 0),
+              "partially correct": counts.get("Partially correct", 0),
+              "incorrect": counts.get("Incorrect", 0),
+              "accuracy": f"{counts['accuracy']:.0%}"}
+             for label, counts in sorted(accuracy.items())],
+            use_container_width=True, hide_index=True
+        )
+    else:
+        st.write("No feedback yet")
+    
+    confusion = usage_stats.confusion(username)
+    if confusion:
+        st.subheader("Most common mix-ups")
+        st.caption("From Incorrect feedback that named the actual disease")
+        st.dataframe(
+            [{"predicted": short_label(row["predicted"]), "actually": short_label(row["actual"]),
+              "count": row["count"]} for row in confusion],
+            use_container_width=True, hide_index=True
+        )
 
 # Page routing
 if st.session_state.selected_page == "Home":
@@ -572,6 +842,46 @@ elif st.session_state.selected_page == "Prevention Tips":
     show_prevention_tips()
 elif st.session_state.selected_page == "History":
     show_history()
+elif st.session_state.selected_page == "Statistics":
+    show_statistics()
+
+# Per-request timing for admins (CROP_ADMIN_USERS); rendered last so it
+# includes a Predict click from this run
+if st.session_state.username in ADMIN_USERS:
+    with st.sidebar.expander("Request Timing"):
+        last_trace = st.session_state.get("last_trace")
+        if last_trace:
+            st.write(f"**Last {last_trace['name']}:** {last_trace['total_ms']:.1f} ms")
+            st.dataframe(
+                [{"stage": "  " * span["depth"] + span["span"], "ms": span["ms"]} for span in last_trace["spans"]],
+                use_container_width=True, hide_index=True
+            )
+        else:
+            st.write("No Predict click timed yet in this session")
+        st.write("**All sessions (mean ms):**")
+        st.dataframe(
+            [{"stage": name, "count": stat["count"], "mean ms": stat["mean_ms"]}
+             for name, stat in metrics.get_metrics().summary().items()],
+            use_container_width=True, hide_index=True
+        )
+
+    # Per-version serving latency and shadow agreement (see model_versions.py)
+    with st.sidebar.expander("Model Versions"):
+        if router.candidate is None:
+            st.write("No candidate model (CROP_CANDIDATE_MODEL not set)")
+        else:
+            st.write(f"**Candidate traffic:** {router.candidate_fraction:.0%}, "
+                     f"shadow scoring {'on' if router.shadow else 'off'}")
+        version_stats = router.stats()
+        stored = store.model_version_counts()
+        st.dataframe(
+            [{"version": version, **stat, "stored": stored.get(version, {}).get("predictions", 0)}
+             for version, stat in version_stats["versions"].items()],
+            use_container_width=True, hide_index=True
+        )
+        if version_stats["agreement"]:
+            st.write("**Top-label agreement:**")
+            st.dataframe(version_stats["agreement"], use_container_width=True, hide_index=True)
 
 # Logout button in sidebar
 if st.sidebar.button("Logout"):
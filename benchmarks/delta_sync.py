@@ -0,0 +1,102 @@
+"""Incremental pull benchmark against the local mock cloud.
+
+    python benchmarks/delta_sync.py [--history 1000 10000 100000] [--delta 10 100 1000]
+
+For each (history, delta) pair the mock server holds `history` records
+from another device, and a fresh local store is positioned so that the
+last `delta` of them are new. Reports compressed bytes on the wire, the
+number of pages, and total pull and merge time. For a fixed delta these
+should stay flat as history grows.
+"""
+import argparse
+import json
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import mock_cloud  # noqa: E402
+from prediction_store import PredictionStore, new_record_id  # noqa: E402
+from sync_worker import SyncWorker  # noqa: E402
+
+LABELS = ["Tomato___Early_blight", "Tomato___Late_blight", "Tomato___healthy"]
+
+
+def seed_cloud(cloud, history):
+    records = [
+        {
+            "id": new_record_id(),
+            "timestamp": f"2025-01-{i % 28 + 1:02d} 12:00:00",
+            "image_name": f"leaf_{i}.jpg",
+            "prediction": LABELS[i % len(LABELS)],
+            "username": f"user{i % 50}",
+            "treatment_info": None,
+        }
+        for i in range(history)
+    ]
+    cloud.accept({"device_id": "other-device", "predictions": records})
+
+
+def bench(history, delta):
+    cloud = mock_cloud.MockCloud()
+    seed_cloud(cloud, history)
+    server, url = mock_cloud.start_server(cloud)
+    try:
+        store = PredictionStore(Path(tempfile.mkdtemp(prefix="delta-bench-")) / "predictions.db")
+        # Pretend everything up to history - delta was pulled earlier
+        store.merge_remote([], [], history - delta)
+
+        merge_seconds = 0.0
+        merge_remote = store.merge_remote
+
+        def timed_merge(*args):
+            nonlocal merge_seconds
+            start = time.perf_counter()
+            merge_remote(*args)
+            merge_seconds += time.perf_counter() - start
+
+        store.merge_remote = timed_merge
+        worker = SyncWorker(store, url, is_online=lambda: True)
+        start = time.perf_counter()
+        stats = worker.pull_updates()
+        pull_seconds = time.perf_counter() - start
+    finally:
+        server.shutdown()
+
+    assert stats["records"] == delta, stats
+    return {
+        "history": history,
+        "delta": delta,
+        "pages": stats["pages"],
+        "bytes": stats["bytes"],
+        "pull_ms": round(pull_seconds * 1000, 2),
+        "merge_ms": round(merge_seconds * 1000, 2),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Incremental pull: cost vs history and delta size")
+    parser.add_argument("--history", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--delta", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--output", help="write results as JSON here")
+    args = parser.parse_args(argv)
+
+    results = [
+        bench(history, delta)
+        for history in args.history
+        for delta in args.delta
+        if delta <= history
+    ]
+    text = json.dumps(results, indent=2)
+    if args.output:
+        Path(args.output).write_text(text)
+    for row in results:
+        print(f"history={row['history']:>7} delta={row['delta']:>5} pages={row['pages']:>2} "
+              f"bytes={row['bytes']:>8} pull={row['pull_ms']:>8}ms merge={row['merge_ms']:>7}ms")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
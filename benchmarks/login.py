@@ -0,0 +1,77 @@
+"""Login latency benchmark for the scrypt cost setting.
+
+    python benchmarks/login.py [--costs 12 13 14 15] [--threads 8] [--logins 200]
+
+For each scrypt cost N = 2**k, creates users in a scratch users.db and
+runs concurrent verify_user() calls from a thread pool, reporting login
+latency percentiles. Pick the largest N whose p99 is acceptable and set
+it with CROP_SCRYPT_N.
+"""
+import argparse
+import json
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import user_store  # noqa: E402
+
+USERS = 20
+
+
+def bench_cost(n, threads, logins):
+    user_store.SCRYPT_N = n
+    path = Path(tempfile.mkdtemp(prefix="login-bench-")) / "users.db"
+    store = user_store.UserStore(path)
+    for i in range(USERS):
+        store.create_user(f"user{i}", f"password{i}", f"user{i}@example.com")
+
+    def login(i):
+        start = time.perf_counter()
+        ok = store.verify_user(f"user{i % USERS}", f"password{i % USERS}")
+        assert ok
+        return (time.perf_counter() - start) * 1000
+
+    wall_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        latencies = np.array(list(pool.map(login, range(logins))))
+    wall = time.perf_counter() - wall_start
+
+    return {
+        "scrypt_n": n,
+        "memory_mb": round(128 * n * user_store.SCRYPT_R / 2 ** 20, 1),
+        "p50_ms": round(float(np.percentile(latencies, 50)), 2),
+        "p95_ms": round(float(np.percentile(latencies, 95)), 2),
+        "p99_ms": round(float(np.percentile(latencies, 99)), 2),
+        "logins_per_second": round(logins / wall, 1),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="scrypt cost vs login latency")
+    parser.add_argument("--costs", type=int, nargs="+", default=[12, 13, 14, 15],
+                        help="log2 of the scrypt N values to try")
+    parser.add_argument("--threads", type=int, default=8, help="concurrent logins")
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--output", help="write results as JSON here")
+    args = parser.parse_args(argv)
+
+    results = {
+        "threads": args.threads,
+        "logins": args.logins,
+        "costs": [bench_cost(2 ** k, args.threads, args.logins) for k in args.costs],
+    }
+    text = json.dumps(results, indent=2)
+    if args.output:
+        Path(args.output).write_text(text)
+    print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
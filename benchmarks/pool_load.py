@@ -0,0 +1,182 @@
+"""Load test for the multi-process inference pool.
+
+    python benchmarks/pool_load.py [--model trained_model2.keras] [--workers 1 2 4]
+                                   [--clients 4] [--threads 4] [--duration 10]
+
+For each --workers count, starts an InferencePool, then drives it from
+--clients processes with --threads threads each (think Streamlit server
+processes with several sessions) for --duration seconds. Every thread
+sends single-image predict requests back to back. Reports throughput and
+p50/p95/p99 request latency per worker count.
+
+It also reads /proc/<pid>/smaps_rollup for every worker once the pool is
+warm. Rss counts the memory-mapped .tflite weights in every worker, but
+Pss splits shared pages between the processes that map them, so if the
+weights are shared, total Pss grows by much less than N x Rss. Private
+is what each extra worker really costs.
+
+Without --model it builds the random-weight stand-in from suite.py.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT))
+
+from inference_pool import InferencePool, PoolClient  # noqa: E402
+from preprocessing import INPUT_SHAPE  # noqa: E402
+
+SMAPS_FIELDS = {"Rss": "rss_mb", "Pss": "pss_mb", "Private_Clean": "private_mb", "Private_Dirty": "private_mb"}
+
+
+def worker_memory(pid):
+    """{"rss_mb", "pss_mb", "private_mb"} from /proc/<pid>/smaps_rollup, or None"""
+    try:
+        lines = Path(f"/proc/{pid}/smaps_rollup").read_text().splitlines()
+    except OSError:
+        return None
+    memory = {"rss_mb": 0.0, "pss_mb": 0.0, "private_mb": 0.0}
+    for line in lines:
+        field, _, value = line.partition(":")
+        if field in SMAPS_FIELDS:
+            memory[SMAPS_FIELDS[field]] += int(value.split()[0]) / 1024
+    return {key: round(value, 1) for key, value in memory.items()}
+
+
+def client_main(socket_base, threads, duration, start_at, results):
+    """One client process: threads x back-to-back predicts until the deadline"""
+    client = PoolClient(socket_base)
+    image = np.random.default_rng(os.getpid()).integers(0, 255, INPUT_SHAPE, dtype=np.uint8)
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def run():
+        local = []
+        while time.time() < start_at:
+            time.sleep(0.001)
+        deadline = start_at + duration
+        while time.time() < deadline:
+            start = time.perf_counter()
+            try:
+                client.predict(image)
+            except Exception:
+                with lock:
+                    errors[0] += 1
+                continue
+            local.append((time.perf_counter() - start) * 1000)
+        with lock:
+            latencies.extend(local)
+
+    pool = [threading.Thread(target=run) for _ in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    results.put((latencies, errors[0]))
+
+
+def run_load(socket_base, clients, threads, duration):
+    ctx = multiprocessing.get_context("spawn")
+    results = ctx.Queue()
+    # Give every client time to import and connect before the clock starts
+    start_at = time.time() + 5
+    processes = [
+        ctx.Process(target=client_main, args=(socket_base, threads, duration, start_at, results))
+        for _ in range(clients)
+    ]
+    for process in processes:
+        process.start()
+    latencies, errors = [], 0
+    for _ in processes:
+        client_latencies, client_errors = results.get()
+        latencies.extend(client_latencies)
+        errors += client_errors
+    for process in processes:
+        process.join()
+
+    samples = np.asarray(latencies or [np.nan])
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "per_second": round(len(latencies) / duration, 1),
+        "p50_ms": round(float(np.percentile(samples, 50)), 2),
+        "p95_ms": round(float(np.percentile(samples, 95)), 2),
+        "p99_ms": round(float(np.percentile(samples, 99)), 2),
+    }
+
+
+def bench_workers(model_path, workers, clients, threads, duration, threads_per_worker):
+    socket_base = os.path.join(tempfile.mkdtemp(prefix="crop-pool-"), "inference.sock")
+    pool = InferencePool(socket_base, workers, model_path, threads_per_worker).start()
+    try:
+        memory = [worker_memory(pid) for pid in pool.pids()]
+        load = run_load(socket_base, clients, threads, duration)
+        stats = PoolClient(socket_base).stats()
+    finally:
+        pool.stop()
+
+    known = [m for m in memory if m]
+    return {
+        "workers": workers,
+        **load,
+        "mean_batch_size": round(stats["requests"] / max(stats["batches"], 1), 2),
+        "memory": {
+            "per_worker": memory,
+            "total_rss_mb": round(sum(m["rss_mb"] for m in known), 1),
+            "total_pss_mb": round(sum(m["pss_mb"] for m in known), 1),
+            "total_private_mb": round(sum(m["private_mb"] for m in known), 1),
+        },
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Inference pool throughput, latency and memory")
+    parser.add_argument("--model", help="model to serve (default: a tiny stand-in)")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--clients", type=int, default=4, help="client processes")
+    parser.add_argument("--threads", type=int, default=4, help="request threads per client")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of load per worker count")
+    parser.add_argument("--threads-per-worker", type=int, default=1)
+    parser.add_argument("--output", help="write results as JSON here")
+    args = parser.parse_args(argv)
+
+    model_path = args.model
+    if model_path is None:
+        from suite import build_tiny_model
+
+        model_path = build_tiny_model(os.path.join(tempfile.mkdtemp(prefix="crop-pool-"), "tiny.keras"))
+
+    results = {
+        "model": model_path,
+        "cpus": os.cpu_count(),
+        "clients": args.clients,
+        "threads": args.threads,
+        "duration_s": args.duration,
+        "runs": [],
+    }
+    for workers in args.workers:
+        run = bench_workers(model_path, workers, args.clients, args.threads,
+                            args.duration, args.threads_per_worker)
+        print(f"{workers} worker(s): {run['per_second']}/s  p50 {run['p50_ms']} ms  "
+              f"p99 {run['p99_ms']} ms  Pss {run['memory']['total_pss_mb']} MB", file=sys.stderr)
+        results["runs"].append(run)
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        Path(args.output).write_text(text)
+    print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,106 @@
+"""Cold-start benchmark.
+
+    python benchmarks/startup.py [--model trained_model2.keras] [--runs 5]
+
+Each measurement runs in a fresh Python process, so import and model
+load costs are paid every time:
+
+- auth_first_paint: process start -> login page fully rendered
+  (app3.py run headless via streamlit.testing)
+- first_prediction: process start -> first label from diagnosis.predict()
+
+Also reports whether TensorFlow was imported while rendering the login
+page, which should be False.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+AUTH_PAGE_SCRIPT = """
+import json, sys
+from streamlit.testing.v1 import AppTest
+at = AppTest.from_file(sys.argv[1], default_timeout=300)
+at.run()
+assert not at.exception, at.exception
+print(json.dumps({"tensorflow_imported": "tensorflow" in sys.modules}))
+"""
+
+FIRST_PREDICTION_SCRIPT = """
+import io, json, sys
+import numpy as np
+from PIL import Image
+import diagnosis
+buf = io.BytesIO()
+Image.fromarray(np.random.default_rng(0).integers(0, 255, (960, 1280, 3), dtype=np.uint8)).save(buf, "JPEG")
+print(json.dumps({"label": diagnosis.predict(buf.getvalue())}))
+"""
+
+
+def run_cold(script, args=(), env=None, cwd=REPO_ROOT):
+    """Wall-clock seconds for a fresh interpreter to run script, plus its JSON output"""
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-c", script, *args],
+        cwd=cwd, env=env, capture_output=True, text=True,
+    )
+    elapsed = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr)
+    return elapsed, json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def summarize(samples):
+    return {
+        "median_s": round(statistics.median(samples), 3),
+        "min_s": round(min(samples), 3),
+        "max_s": round(max(samples), 3),
+        "runs": len(samples),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Cold-start benchmark")
+    parser.add_argument("--model", help="model file for first_prediction "
+                                        "(default: CROP_MODEL_PATH or trained_model2.keras)")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--output", help="write results as JSON here")
+    args = parser.parse_args(argv)
+
+    env = dict(os.environ, PYTHONPATH=str(REPO_ROOT), TF_CPP_MIN_LOG_LEVEL="3")
+    model = args.model or os.environ.get("CROP_MODEL_PATH") or REPO_ROOT / "trained_model2.keras"
+    env["CROP_MODEL_PATH"] = str(Path(model).resolve())
+    # Predictions run in a scratch directory so the registry's local_cache/
+    # copy of the model doesn't overwrite the real one
+    scratch = tempfile.mkdtemp(prefix="startup-bench-")
+
+    paint, prediction = [], []
+    tensorflow_imported = False
+    for _ in range(args.runs):
+        seconds, info = run_cold(AUTH_PAGE_SCRIPT, [str(REPO_ROOT / "app3.py")], env)
+        paint.append(seconds)
+        tensorflow_imported |= info["tensorflow_imported"]
+        seconds, _ = run_cold(FIRST_PREDICTION_SCRIPT, env=env, cwd=scratch)
+        prediction.append(seconds)
+
+    results = {
+        "auth_first_paint": summarize(paint),
+        "first_prediction": summarize(prediction),
+        "tensorflow_imported_on_auth_page": tensorflow_imported,
+    }
+    text = json.dumps(results, indent=2)
+    if args.output:
+        Path(args.output).write_text(text)
+    print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,453 @@
+"""Offline benchmark and profiling suite.
+
+    python benchmarks/suite.py [--quick] [--stages decode inference ...] [--output results.json]
+    python benchmarks/suite.py --compare baseline.json [--tolerance 0.2]
+
+Runs on CPU with synthetic phone-sized photos and a tiny stand-in model
+(same 128x128x3 -> 10-class shape as trained_model2.keras), so it needs
+no dataset or network. Stages:
+
+- decode: preprocessing.decode() on JPEG/PNG bytes, swept over threads
+- inference: one forward pass, swept over batch size
+- model_prediction: the app's Predict path (hash, result cache, decode,
+  micro-batcher) with concurrent sessions, swept over thread count
+- tiled: tiling.predict_tiled() on the same photos through the
+  micro-batcher, swept over the decoded size (MAX_SIDE)
+- store: saving predictions and loading History pages from
+  predictions.db (what load_local_data/save_local_data used to do),
+  swept over history size
+- login: UserStore.verify_user() at the configured scrypt cost, swept
+  over threads
+- history_render: app3.py's History page rendered headless, swept over
+  history size
+
+Every result row is {"stage", "params", "p50_ms", "p95_ms", "p99_ms",
+"per_second"}. Write a run with --output, then pass it to --compare on a
+later release: rows are matched on (stage, params) and the run exits 1
+if any p50 got slower, or throughput dropped, by more than --tolerance.
+--profile DIR also writes a cProfile dump per stage (python -m pstats).
+"""
+import argparse
+import cProfile
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT))
+
+import diagnosis  # noqa: E402
+import tiling  # noqa: E402
+from inference_batcher import InferenceBatcher  # noqa: E402
+from model_registry import ModelRegistry  # noqa: E402
+from prediction_store import PredictionStore  # noqa: E402
+from preprocessing import INPUT_SHAPE, content_hash, decode, load_image, read_bytes  # noqa: E402
+from result_cache import ResultCache  # noqa: E402
+from user_store import UserStore  # noqa: E402
+
+# Sub-millisecond timings jitter by more than any sane tolerance, so
+# --compare never flags rows that are this fast in both runs
+NOISE_FLOOR_MS = 0.5
+
+STAGES = ["decode", "inference", "model_prediction", "tiled", "store", "login", "history_render"]
+USERNAME = "bench"
+
+SWEEPS = {
+    "full": {
+        "image_size": (4032, 3024),
+        "images": 32,
+        "threads": [1, 2, 4, 8],
+        "batch_sizes": [1, 8, 32, 64],
+        "tile_sides": [384, 768, 1024],
+        "history_sizes": [1000, 10000, 100000],
+        "runs": 50,
+        "logins": 64,
+    },
+    "quick": {
+        "image_size": (1280, 960),
+        "images": 8,
+        "threads": [1, 4],
+        "batch_sizes": [1, 32],
+        "tile_sides": [384, 768],
+        "history_sizes": [1000, 10000],
+        "runs": 10,
+        "logins": 8,
+    },
+}
+
+HISTORY_RENDER_SCRIPT = """
+import json, sys, time
+from streamlit.testing.v1 import AppTest
+at = AppTest.from_file(sys.argv[1], default_timeout=300)
+at.session_state.authenticated = True
+at.session_state.username = sys.argv[2]
+at.session_state.selected_page = "History"
+at.run()
+assert not at.exception, at.exception
+samples = []
+for _ in range(int(sys.argv[3])):
+    start = time.perf_counter()
+    at.run()
+    samples.append((time.perf_counter() - start) * 1000)
+assert not at.exception, at.exception
+print(json.dumps(samples))
+"""
+
+
+def summarize(stage, params, samples_ms, items=1):
+    """Percentiles of per-call latency; per_second counts items (images, rows, logins)"""
+    samples_ms = np.asarray(samples_ms, dtype=np.float64)
+    return {
+        "stage": stage,
+        "params": params,
+        "p50_ms": round(float(np.percentile(samples_ms, 50)), 3),
+        "p95_ms": round(float(np.percentile(samples_ms, 95)), 3),
+        "p99_ms": round(float(np.percentile(samples_ms, 99)), 3),
+        "per_second": round(items * 1000 / float(samples_ms.mean()), 1),
+    }
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return (time.perf_counter() - start) * 1000, result
+
+
+# -- fixtures ---------------------------------------------------------------
+
+def synthetic_photos(count, size, fmt="JPEG", seed=0):
+    """Smooth gradient-plus-noise photos, so they compress like real ones"""
+    rng = np.random.default_rng(seed)
+    width, height = size
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    photos = []
+    for _ in range(count):
+        phase = rng.uniform(0, 2 * np.pi, 3)
+        channels = [127 + 100 * np.sin(x / rng.uniform(80, 400) + y / rng.uniform(80, 400) + p)
+                    for p in phase]
+        pixels = np.stack(channels, axis=-1) + rng.normal(0, 8, (height, width, 3))
+        buf = io.BytesIO()
+        Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8)).save(buf, fmt, quality=90)
+        photos.append(buf.getvalue())
+    return photos
+
+
+def build_tiny_model(path):
+    """Random-weight stand-in with the production model's input and output shape"""
+    import tensorflow as tf
+
+    inputs = tf.keras.Input(INPUT_SHAPE)
+    x = tf.keras.layers.Rescaling(1 / 255)(inputs)
+    x = tf.keras.layers.Conv2D(16, 3, strides=2, activation="relu")(x)
+    x = tf.keras.layers.Conv2D(32, 3, strides=2, activation="relu")(x)
+    x = tf.keras.layers.GlobalAveragePooling2D()(x)
+    outputs = tf.keras.layers.Dense(len(diagnosis.CLASS_NAMES), activation="softmax")(x)
+    tf.keras.Model(inputs, outputs).save(path)
+    return path
+
+
+def fill_history(path, size, seed=0):
+    rng = np.random.default_rng(seed)
+    labels = rng.integers(0, len(diagnosis.CLASS_NAMES), size)
+    days = rng.integers(0, 365, size)
+    store = PredictionStore(path)
+    store.add_predictions([
+        {
+            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(1.7e9 + int(days[i]) * 86400 + i)),
+            "username": USERNAME,
+            "image_name": f"leaf_{i}.jpg",
+            "prediction": diagnosis.CLASS_NAMES[labels[i]],
+            "confidence": 0.9,
+            "treatment_id": diagnosis.CLASS_NAMES[labels[i]],
+            "treatment_version": 1,
+        }
+        for i in range(size)
+    ])
+    return store
+
+
+# -- stages -----------------------------------------------------------------
+
+def bench_decode(ctx):
+    rows = []
+    for fmt, photos in ctx["photos"].items():
+        for threads in ctx["sweep"]["threads"]:
+            work = photos * max(1, ctx["sweep"]["runs"] // len(photos))
+            with ThreadPoolExecutor(max_workers=threads) as pool:
+                wall, samples = timed(lambda: list(pool.map(lambda data: timed(decode, data)[0], work)))
+            row = summarize("decode", {"format": fmt, "threads": threads}, samples)
+            row["per_second"] = round(len(work) * 1000 / wall, 1)
+            rows.append(row)
+    return rows
+
+
+def bench_inference(ctx):
+    rows = []
+    images = [decode(data) for data in ctx["photos"]["JPEG"]]
+    for batch_size in ctx["sweep"]["batch_sizes"]:
+        batch = [images[i % len(images)] for i in range(batch_size)]
+        diagnosis.predict_proba_batch(batch, ctx["model"])  # warm-up / retrace
+        samples = [timed(diagnosis.predict_proba_batch, batch, ctx["model"])[0]
+                   for _ in range(ctx["sweep"]["runs"])]
+        rows.append(summarize("inference", {"batch_size": batch_size}, samples, items=batch_size))
+    return rows
+
+
+def bench_model_prediction(ctx):
+    """Cold (uncached) Predict clicks from concurrent sessions, as in app3.model_prediction"""
+    rows = []
+    registry = ctx["registry"]
+    batcher = InferenceBatcher(registry.current)
+    cache = ResultCache(Path(ctx["scratch"]) / "results.db")
+    counter = iter(range(10 ** 9))
+    counter_lock = threading.Lock()
+
+    def predict_once(data):
+        with counter_lock:
+            # A fresh salt per call keeps every request a cache miss
+            salted = data + next(counter).to_bytes(8, "little")
+        start = time.perf_counter()
+        data = read_bytes(salted)
+        image_hash = content_hash(data)
+        if cache.get(image_hash, registry.current()[1]) is None:
+            probabilities, digest = batcher.predict_served([load_image(data, key=image_hash)])
+            cache.put(image_hash, digest, probabilities[0])
+        return (time.perf_counter() - start) * 1000
+
+    photos = ctx["photos"]["JPEG"]
+    predict_once(photos[0])
+    for threads in ctx["sweep"]["threads"]:
+        work = [photos[i % len(photos)] for i in range(ctx["sweep"]["runs"] * threads)]
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            wall, samples = timed(lambda: list(pool.map(predict_once, work)))
+        row = summarize("model_prediction", {"threads": threads}, samples)
+        row["per_second"] = round(len(work) * 1000 / wall, 1)
+        rows.append(row)
+    return rows
+
+
+def bench_tiled(ctx):
+    """Tiled Predict clicks: decode at max_side, mask, and one batched pass over the leaf tiles"""
+    rows = []
+    batcher = InferenceBatcher(ctx["registry"].current)
+    photos = ctx["photos"]["JPEG"]
+    for max_side in ctx["sweep"]["tile_sides"]:
+        tiles = []
+
+        def predict_once(data):
+            elapsed, result = timed(tiling.predict_tiled, data, batcher.predict_served, max_side)
+            tiles.append(result["tiles"] if result else 0)
+            return elapsed
+
+        predict_once(photos[0])
+        samples = [predict_once(photos[i % len(photos)]) for i in range(ctx["sweep"]["runs"])]
+        row = summarize("tiled", {"max_side": max_side}, samples)
+        row["tiles_per_image"] = round(float(np.mean(tiles)), 1)
+        rows.append(row)
+    return rows
+
+
+def bench_store(ctx):
+    rows = []
+    runs = ctx["sweep"]["runs"]
+    for size in ctx["sweep"]["history_sizes"]:
+        path = Path(ctx["scratch"]) / f"history_{size}.db"
+        wall, store = timed(fill_history, path, size)
+        rows.append(summarize("store_bulk_save", {"history": size}, [wall], items=size))
+
+        record = {"username": USERNAME, "prediction": diagnosis.CLASS_NAMES[0], "image_name": "new.jpg"}
+        samples = [timed(store.add_prediction, dict(record))[0] for _ in range(runs)]
+        rows.append(summarize("store_save", {"history": size}, samples))
+
+        samples = [timed(store.history_page, USERNAME)[0] for _ in range(runs)]
+        rows.append(summarize("store_history_page", {"history": size, "page": 1}, samples))
+
+        # Page 10, reached by following cursors like the Older button does
+        cursor = None
+        for _ in range(9):
+            _, cursor = store.history_page(USERNAME, cursor)
+        samples = [timed(store.history_page, USERNAME, cursor)[0] for _ in range(runs)]
+        rows.append(summarize("store_history_page", {"history": size, "page": 10}, samples))
+
+        samples = [timed(store.user_labels, USERNAME)[0] for _ in range(runs)]
+        rows.append(summarize("store_user_labels", {"history": size}, samples))
+    return rows
+
+
+def bench_login(ctx):
+    store = UserStore(Path(ctx["scratch"]) / "users.db")
+    users = 8
+    for i in range(users):
+        store.create_user(f"user{i}", f"password{i}", f"user{i}@example.com")
+
+    def login(i):
+        elapsed, ok = timed(store.verify_user, f"user{i % users}", f"password{i % users}")
+        assert ok
+        return elapsed
+
+    rows = []
+    for threads in ctx["sweep"]["threads"]:
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            wall, samples = timed(lambda: list(pool.map(login, range(ctx["sweep"]["logins"]))))
+        row = summarize("login", {"threads": threads}, samples)
+        row["per_second"] = round(len(samples) * 1000 / wall, 1)
+        rows.append(row)
+    return rows
+
+
+def bench_history_render(ctx):
+    rows = []
+    env = dict(os.environ, PYTHONPATH=str(REPO_ROOT), TF_CPP_MIN_LOG_LEVEL="3",
+               CROP_MODEL_PATH=str(ctx["model_path"]))
+    env.pop("CROP_SYNC_URL", None)
+    for size in ctx["sweep"]["history_sizes"]:
+        # Fresh directory per size: the app opens predictions.db relative to cwd
+        cwd = Path(tempfile.mkdtemp(prefix=f"history-{size}-", dir=ctx["scratch"]))
+        fill_history(cwd / "predictions.db", size)
+        result = subprocess.run(
+            [sys.executable, "-c", HISTORY_RENDER_SCRIPT, str(REPO_ROOT / "app3.py"), USERNAME,
+             str(ctx["sweep"]["runs"])],
+            cwd=cwd, env=env, capture_output=True, text=True,
+        )
+        if result.returncode != 0:
+            raise RuntimeError(result.stderr)
+        samples = json.loads(result.stdout.strip().splitlines()[-1])
+        rows.append(summarize("history_render", {"history": size}, samples))
+    return rows
+
+
+BENCHES = {
+    "decode": bench_decode,
+    "inference": bench_inference,
+    "model_prediction": bench_model_prediction,
+    "tiled": bench_tiled,
+    "store": bench_store,
+    "login": bench_login,
+    "history_render": bench_history_render,
+}
+
+
+# -- reporting --------------------------------------------------------------
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT,
+                                capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    import tensorflow as tf
+    import PIL
+    return {
+        "commit": commit,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "numpy": np.__version__,
+        "pillow": PIL.__version__,
+        "tensorflow": tf.__version__,
+    }
+
+
+def row_key(row):
+    return row["stage"], json.dumps(row["params"], sort_keys=True)
+
+
+def compare(baseline, current, tolerance):
+    """Lines describing each matched row; regressions are marked and counted"""
+    previous = {row_key(row): row for row in baseline["results"]}
+    lines, regressions = [], 0
+    for row in current["results"]:
+        old = previous.get(row_key(row))
+        if old is None:
+            continue
+        latency = row["p50_ms"] / old["p50_ms"] - 1 if old["p50_ms"] else 0.0
+        throughput = row["per_second"] / old["per_second"] - 1 if old["per_second"] else 0.0
+        regressed = (latency > tolerance or throughput < -tolerance) and \
+            max(row["p50_ms"], old["p50_ms"]) >= NOISE_FLOOR_MS
+        regressions += regressed
+        lines.append(
+            f"{'REGRESSION ' if regressed else '           '}{row['stage']:<20} {row_key(row)[1]:<36} "
+            f"p50 {old['p50_ms']:>9.2f} -> {row['p50_ms']:>9.2f} ms ({latency:+.0%})  "
+            f"{old['per_second']:>9.1f} -> {row['per_second']:>9.1f}/s ({throughput:+.0%})"
+        )
+    return lines, regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmark and profiling suite")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES)
+    parser.add_argument("--quick", action="store_true", help="smaller sweeps for a fast smoke run")
+    parser.add_argument("--model", help="benchmark this model instead of a tiny stand-in")
+    parser.add_argument("--output", help="write results as JSON here")
+    parser.add_argument("--compare", help="baseline results JSON to diff against")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed relative slowdown before --compare fails (default 0.2)")
+    parser.add_argument("--profile", help="write a cProfile dump per stage into this directory")
+    args = parser.parse_args(argv)
+
+    sweep = SWEEPS["quick" if args.quick else "full"]
+    scratch = tempfile.mkdtemp(prefix="bench-suite-")
+    model_path = Path(args.model).resolve() if args.model else build_tiny_model(Path(scratch) / "tiny.keras")
+    registry = ModelRegistry(model_path, cache_path=None)
+    ctx = {
+        "sweep": sweep,
+        "scratch": scratch,
+        "model_path": model_path,
+        "registry": registry,
+        "model": registry.get(),
+        "photos": {
+            "JPEG": synthetic_photos(sweep["images"], sweep["image_size"], "JPEG"),
+            "PNG": synthetic_photos(max(2, sweep["images"] // 4), sweep["image_size"], "PNG"),
+        },
+    }
+
+    results = []
+    for stage in args.stages:
+        print(f"Running {stage}...", file=sys.stderr)
+        profiler = cProfile.Profile() if args.profile else None
+        if profiler:
+            profiler.enable()
+        results.extend(BENCHES[stage](ctx))
+        if profiler:
+            profiler.disable()
+            Path(args.profile).mkdir(parents=True, exist_ok=True)
+            profiler.dump_stats(Path(args.profile) / f"{stage}.prof")
+
+    report = {
+        "environment": environment(),
+        "model": "tiny stand-in" if not args.model else str(model_path),
+        "sweep": "quick" if args.quick else "full",
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(text)
+
+    for row in results:
+        print(f"{row['stage']:<20} {row_key(row)[1]:<36} p50 {row['p50_ms']:>9.2f} ms  "
+              f"p95 {row['p95_ms']:>9.2f} ms  p99 {row['p99_ms']:>9.2f} ms  {row['per_second']:>9.1f}/s")
+
+    if args.compare:
+        lines, regressions = compare(json.loads(Path(args.compare).read_text()), report, args.tolerance)
+        print(f"\nCompared with {args.compare} (tolerance {args.tolerance:.0%}):")
+        print("\n".join(lines))
+        if regressions:
+            print(f"{regressions} regression(s)")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
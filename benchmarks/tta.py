@@ -0,0 +1,128 @@
+"""Test-time augmentation cost and benefit.
+
+    python benchmarks/tta.py [--model trained_model2.keras] [--images DIR] [--runs 50]
+
+Times a single-image forward pass against a TTA pass (all tta_views() of
+the image in one batch) and reports latency percentiles for both.
+
+With --images, every photo is also scored once plainly to find how many
+fall below each --thresholds value, and the expected per-photo latency
+when TTA only runs for those. If the photos sit in folders named after
+CLASS_NAMES (the PlantVillage layout), it also reports accuracy with and
+without TTA and the temperature fit_temperature() suggests (save one
+with python -m model_export --fit-temperature).
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import diagnosis  # noqa: E402
+from model_registry import MODEL_PATH, ModelRegistry  # noqa: E402
+from preprocessing import load_image, tta_views  # noqa: E402
+from score_images import find_images  # noqa: E402
+
+
+def percentiles(samples_ms):
+    samples_ms = np.asarray(samples_ms)
+    return {
+        "p50_ms": round(float(np.percentile(samples_ms, 50)), 2),
+        "p95_ms": round(float(np.percentile(samples_ms, 95)), 2),
+        "mean_ms": round(float(samples_ms.mean()), 2),
+    }
+
+
+def time_call(fn, runs):
+    fn()  # warm-up
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+def bench_latency(model, image, runs):
+    single = time_call(lambda: diagnosis.predict_proba_batch([image], model), runs)
+    tta = time_call(lambda: diagnosis.predict_tta(image, model), runs)
+    return {
+        "views": len(tta_views(image)),
+        "single": percentiles(single),
+        "tta": percentiles(tta),
+    }
+
+
+def bench_images(model, model_path, root, thresholds, single_ms, tta_ms):
+    paths = find_images(root)
+    if not paths:
+        raise SystemExit(f"No images found under {root}")
+    images = [load_image(Path(root) / path, cache=False) for path in paths]
+    labels = [diagnosis.CLASS_NAMES.index(Path(path).parent.name)
+              if Path(path).parent.name in diagnosis.CLASS_NAMES else None
+              for path in paths]
+
+    probabilities = np.concatenate([
+        diagnosis.predict_proba_batch(images[i:i + 32], model, model_path) for i in range(0, len(images), 32)
+    ])
+    confidence = probabilities.max(axis=1)
+    results = {"images": len(images), "thresholds": []}
+
+    labelled = all(label is not None for label in labels)
+    if labelled:
+        labels = np.array(labels)
+        tta_predictions = np.array([diagnosis.predict_tta(image, model, model_path).argmax() for image in images])
+        # probabilities are already scaled by the current temperature, and
+        # scaling by t1 then t2 equals scaling by t1 * t2
+        results["fitted_temperature"] = (diagnosis.fit_temperature(probabilities, labels)
+                                         * diagnosis.current_temperature(model_path))
+
+    for threshold in thresholds:
+        unsure = confidence < threshold
+        row = {
+            "threshold": threshold,
+            "tta_fraction": round(float(unsure.mean()), 4),
+            # Unsure photos pay for the plain pass and then the TTA pass
+            "expected_ms": round(single_ms + float(unsure.mean()) * tta_ms, 2),
+        }
+        if labelled:
+            plain = probabilities.argmax(axis=1)
+            gated = np.where(unsure, tta_predictions, plain)
+            row["accuracy_plain"] = round(float((plain == labels).mean()), 4)
+            row["accuracy_gated_tta"] = round(float((gated == labels).mean()), 4)
+        results["thresholds"].append(row)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Test-time augmentation latency and gating")
+    parser.add_argument("--model", default=os.environ.get("CROP_MODEL_PATH", str(MODEL_PATH)))
+    parser.add_argument("--images", help="folder of sample photos (class-named subfolders for accuracy)")
+    parser.add_argument("--thresholds", type=float, nargs="+", default=[0.4, 0.5, 0.6, 0.7, 0.8])
+    parser.add_argument("--runs", type=int, default=50)
+    parser.add_argument("--output", help="write results as JSON here")
+    args = parser.parse_args(argv)
+
+    model = ModelRegistry(args.model, cache_path=None).get()
+    image = np.random.default_rng(0).integers(0, 255, (128, 128, 3), dtype=np.uint8)
+    results = {"model": args.model, "latency": bench_latency(model, image, args.runs)}
+    if args.images:
+        results["gating"] = bench_images(
+            model, args.model, args.images, args.thresholds,
+            results["latency"]["single"]["mean_ms"], results["latency"]["tta"]["mean_ms"],
+        )
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        Path(args.output).write_text(text)
+    print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
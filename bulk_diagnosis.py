@@ -0,0 +1,131 @@
+"""Bulk diagnosis of many leaf photos in one run.
+
+Uploads (individual images and/or zip archives) are expanded lazily into
+(name, bytes) entries, decoded and resized on a thread pool, and fed
+through the shared batcher (or inference pool) in fixed-size batches.
+Results are yielded per batch so the page can stream them as they
+complete.
+
+At most MAX_PENDING_DECODES entries are read and queued for decoding
+ahead of the model, so a zip of hundreds of photos is never held in
+memory decompressed all at once. Bulk decodes also bypass the
+preprocessing cache, which is sized for interactive re-predicts.
+"""
+import csv
+import io
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import PurePosixPath
+
+import metrics
+from diagnosis import calibrate
+from inference_batcher import get_batcher
+from preprocessing import load_image
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif"}
+BATCH_SIZE = 32
+DECODE_WORKERS = 4
+# Entries read and decoding (or decoded) ahead of the batch on the model
+MAX_PENDING_DECODES = 2 * BATCH_SIZE
+
+CSV_FIELDS = ["image_name", "prediction", "confidence", "error"]
+
+
+def is_image_name(name):
+    return PurePosixPath(name).suffix.lower() in IMAGE_EXTENSIONS
+
+
+def _image_members(archive):
+    # Skip folders and macOS resource forks
+    return [
+        info for info in archive.infolist()
+        if not info.is_dir() and "__MACOSX/" not in info.filename and is_image_name(info.filename)
+    ]
+
+
+def count_images(uploads):
+    """Number of entries expand_uploads() yields, from the names alone (nothing is decompressed)"""
+    count = 0
+    for upload in uploads:
+        if upload.name.lower().endswith(".zip"):
+            with zipfile.ZipFile(upload) as archive:
+                count += len(_image_members(archive))
+        elif is_image_name(upload.name):
+            count += 1
+    return count
+
+
+def expand_uploads(uploads):
+    """Yield (name, bytes) for every image in the uploads, unpacking zips one member at a time"""
+    for upload in uploads:
+        if upload.name.lower().endswith(".zip"):
+            with zipfile.ZipFile(upload) as archive:
+                for info in _image_members(archive):
+                    yield f"{upload.name}/{info.filename}", archive.read(info)
+        elif is_image_name(upload.name):
+            yield upload.name, upload.getvalue()
+
+
+def _decode_entry(entry):
+    name, data = entry
+    try:
+        with metrics.span("bulk.decode"):
+            return name, load_image(data, cache=False), None
+    except Exception as e:
+        metrics.inc("bulk_decode_errors_total")
+        return name, None, str(e)
+
+
+def _decode_ahead(pool, entries, max_pending):
+    """Yield _decode_entry() results in order, keeping at most max_pending entries in flight"""
+    pending = deque()
+    for entry in entries:
+        pending.append(pool.submit(_decode_entry, entry))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def diagnose(entries, batch_size=BATCH_SIZE, workers=DECODE_WORKERS, max_pending=MAX_PENDING_DECODES):
+    """Yield a list of (name, class_index, confidence, model_digest, error) per batch.
+
+    model_digest is the content hash of the model that scored the batch,
+    which changes mid-run if a new model is swapped in. class_index,
+    confidence and model_digest are None for images that failed to decode.
+
+    entries is consumed lazily: up to max_pending of them are decoding
+    while the current batch is on the model.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        batch = []
+        for item in _decode_ahead(pool, entries, max(max_pending, batch_size)):
+            batch.append(item)
+            if len(batch) == batch_size:
+                yield _run_batch(batch)
+                batch = []
+        if batch:
+            yield _run_batch(batch)
+
+
+def _run_batch(batch):
+    ok = [i for i, (_, _, error) in enumerate(batch) if error is None]
+    scored = {}
+    if ok:
+        with metrics.span("bulk.inference"):
+            probabilities, digest = get_batcher().predict_served([batch[i][1] for i in ok])
+        probabilities = calibrate(probabilities, digest=digest)
+        for i, row in zip(ok, probabilities):
+            index = int(row.argmax())
+            scored[i] = (index, round(float(row[index]), 4), digest)
+    return [(name, *scored.get(i, (None, None, None)), error) for i, (name, _, error) in enumerate(batch)]
+
+
+def results_to_csv(rows):
+    """Serialize result dicts (CSV_FIELDS keys) to CSV text"""
+    out = io.StringIO()
+    writer = csv.DictWriter(out, fieldnames=CSV_FIELDS, extrasaction="ignore")
+    writer.writeheader()
+    writer.writerows(rows)
+    return out.getvalue()
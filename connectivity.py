@@ -0,0 +1,131 @@
+"""Background connectivity monitor.
+
+A daemon thread probes PROBE_URL and publishes the result; callers read
+the cached status without touching the network. While online the probe
+repeats every ONLINE_TTL seconds; while offline it backs off
+exponentially from OFFLINE_BACKOFF_MIN up to OFFLINE_BACKOFF_MAX.
+"""
+import threading
+import time
+
+import requests
+
+import metrics
+
+PROBE_URL = "https://www.google.com"
+PROBE_TIMEOUT = 2
+ONLINE_TTL = 30
+OFFLINE_BACKOFF_MIN = 5
+OFFLINE_BACKOFF_MAX = 300
+# How long refresh(wait=...) callers typically wait for the new result
+REFRESH_WAIT = PROBE_TIMEOUT + 1
+
+
+class ConnectivityMonitor:
+    def __init__(self, url=PROBE_URL, timeout=PROBE_TIMEOUT, ttl=ONLINE_TTL,
+                 backoff_min=OFFLINE_BACKOFF_MIN, backoff_max=OFFLINE_BACKOFF_MAX):
+        self.url = url
+        self.timeout = timeout
+        self.ttl = ttl
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        # None until the first probe finishes
+        self._online = None
+        self._checked_at = None
+        self._wake = threading.Event()
+        # Probes started / finished, so refresh() can wait for one that
+        # started after it was called
+        self._probed = threading.Condition()
+        self._probes_started = 0
+        self._probes_finished = 0
+        self._start_lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def status(self):
+        """True / False, or None if no probe has completed yet"""
+        return self._online
+
+    @property
+    def checked_at(self):
+        return self._checked_at
+
+    def is_online(self, force_offline=False):
+        """Cached status; force_offline lets callers honor a user override"""
+        if force_offline:
+            return False
+        self.start()
+        return bool(self._online)
+
+    def refresh(self, wait=None):
+        """Ask the probe thread to re-check now instead of waiting out the TTL.
+
+        With wait, block up to that many seconds for the new probe's
+        result; returns whether it arrived in time.
+        """
+        self.start()
+        with self._probed:
+            requested = self._probes_started
+        self._wake.set()
+        if not wait:
+            return False
+        with self._probed:
+            return self._probed.wait_for(lambda: self._probes_finished > requested, wait)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="connectivity-probe", daemon=True
+                )
+                self._thread.start()
+
+    def _probe(self):
+        with metrics.span("connectivity.probe"):
+            try:
+                requests.head(self.url, timeout=self.timeout)
+                online = True
+            except requests.RequestException:
+                online = False
+        metrics.inc("connectivity_probes_total", result="online" if online else "offline")
+        return online
+
+    def _run(self):
+        backoff = self.backoff_min
+        while True:
+            # Cleared before probing, so a refresh() during the probe
+            # triggers another one instead of being lost
+            self._wake.clear()
+            with self._probed:
+                self._probes_started += 1
+                probe = self._probes_started
+            online = self._probe()
+            with self._probed:
+                self._online = online
+                self._checked_at = time.time()
+                self._probes_finished = probe
+                self._probed.notify_all()
+            if online:
+                delay = self.ttl
+                backoff = self.backoff_min
+            else:
+                delay = backoff
+                backoff = min(backoff * 2, self.backoff_max)
+            self._wake.wait(delay)
+
+
+_monitor = None
+_monitor_lock = threading.Lock()
+
+
+def get_monitor():
+    """Return the process-wide monitor, starting its probe thread"""
+    global _monitor
+    if _monitor is None:
+        with _monitor_lock:
+            if _monitor is None:
+                _monitor = ConnectivityMonitor()
+                _monitor.start()
+    return _monitor
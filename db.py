@@ -0,0 +1,43 @@
+"""Shared SQLite connection helper.
+
+Connections are cached per thread and per database file, so Streamlit
+session threads reuse one connection each instead of reconnecting on
+every call. Every connection runs in WAL mode with a busy timeout, so
+readers never block the writer and concurrent writers wait instead of
+failing with "database is locked".
+"""
+import sqlite3
+import threading
+
+BUSY_TIMEOUT_MS = 5000
+# Compiled statements kept per connection, so repeated queries skip parsing
+STATEMENT_CACHE_SIZE = 256
+
+_local = threading.local()
+
+
+def connect(path):
+    """Return this thread's connection to the database at path"""
+    connections = getattr(_local, "connections", None)
+    if connections is None:
+        connections = _local.connections = {}
+
+    key = str(path)
+    conn = connections.get(key)
+    if conn is None:
+        conn = sqlite3.connect(
+            key, timeout=BUSY_TIMEOUT_MS / 1000, cached_statements=STATEMENT_CACHE_SIZE
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+        connections[key] = conn
+    return conn
+
+
+def close_all():
+    """Close this thread's connections (used by CLI tools and benchmarks)"""
+    for conn in getattr(_local, "connections", {}).values():
+        conn.close()
+    _local.connections = {}
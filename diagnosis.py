@@ -0,0 +1,255 @@
+"""Streamlit-free diagnosis API.
+
+Everything needed to score a leaf photo and look up its treatment, usable
+from app3.py, cron jobs and worker processes alike:
+
+    import diagnosis
+    label = diagnosis.predict("leaf.jpg")
+    info = diagnosis.get_treatment_info(label)
+    ranked = diagnosis.predict_top_k("leaf.jpg", tta=True)
+
+Probabilities are the model's softmax output, temperature-scaled by
+calibrate() so that they can be compared against TTA_THRESHOLD. The
+temperature is fitted on labelled photos with
+`python -m model_export --fit-temperature DIR` and saved next to the
+model file (see temperature_path()). Output is scaled by the temperature
+of the model that produced it, so an A/B candidate or a model scored with
+score_images -m uses its own; CROP_TEMPERATURE overrides them all.
+"""
+import json
+import os
+import threading
+from pathlib import Path
+
+import numpy as np
+
+from model_registry import MODEL_PATH, file_digest, get_registry, loaded_model_path
+from preprocessing import fill_batch, load_image, tta_views
+from treatment_kb import get_kb
+
+# Model output index -> label
+CLASS_NAMES = [
+    'Tomato___Bacterial_spot',
+    'Tomato___Early_blight',
+    'Tomato___Late_blight',
+    'Tomato___Leaf_Mold',
+    'Tomato___Septoria_leaf_spot',
+    'Tomato___Spider_mites Two-spotted_spider_mite',
+    'Tomato___Target_Spot',
+    'Tomato___Tomato_Yellow_Leaf_Curl_Virus',
+    'Tomato___Tomato_mosaic_virus',
+    'Tomato___healthy'
+]
+
+TOP_K = 3
+# Softmax temperature override; without it the temperature saved for the
+# model is used, or 1.0 (the model's probabilities unchanged) if none is
+TEMPERATURE = float(os.environ["CROP_TEMPERATURE"]) if os.environ.get("CROP_TEMPERATURE") else None
+# Top-1 probability below which a photo is re-scored with test-time
+# augmentation (see benchmarks/tta.py for what that costs)
+TTA_THRESHOLD = float(os.environ.get("CROP_TTA_THRESHOLD", 0.6))
+
+DEFAULT_TREATMENT = {
+    'description': 'No information available for this disease',
+    'treatment': {
+        'prevention': ['Consult local agricultural extension officer'],
+        'organic': [],
+        'chemical': []
+    }
+}
+
+
+def lookup_treatment(disease_name, online=False):
+    """(treatment info, knowledge-base version) for a label.
+
+    Labels missing from the knowledge base get DEFAULT_TREATMENT and a
+    version of None. online=True lets the knowledge base refresh itself
+    from its remote source in the background.
+    """
+    info, version = get_kb().lookup(disease_name, online=online)
+    if info is None:
+        return DEFAULT_TREATMENT, None
+    return info, version
+
+
+def get_treatment_info(disease_name, online=False):
+    """Treatment info for a label from the treatment knowledge base"""
+    return lookup_treatment(disease_name, online)[0]
+
+
+def load_image_array(source):
+    """Decode an image (path, bytes or file object) to float32 (128, 128, 3)"""
+    return load_image(source).astype(np.float32)
+
+
+def temperature_path(model_path=MODEL_PATH):
+    """Where the fitted temperature for a model file is saved: <model>.temperature.json"""
+    return Path(model_path).with_suffix(".temperature.json")
+
+
+def save_temperature(temperature, model_path=MODEL_PATH, **details):
+    """Save a fitted temperature next to model_path, tied to the file's content hash"""
+    path = temperature_path(model_path)
+    record = {"temperature": temperature, "model_digest": file_digest(model_path), **details}
+    path.write_text(json.dumps(record, indent=2))
+    return path
+
+
+# (temperature file, its mtime) -> (temperature, digest of the model it was fitted on) or None
+_saved_temperature = {}
+# (model file, its mtime) -> content hash
+_model_digests = {}
+_saved_temperature_lock = threading.Lock()
+
+
+def _read_temperature(path):
+    try:
+        key = (str(path), path.stat().st_mtime_ns)
+    except OSError:
+        return None
+    with _saved_temperature_lock:
+        if key not in _saved_temperature:
+            try:
+                saved = json.loads(path.read_text())
+                _saved_temperature[key] = (float(saved["temperature"]), saved.get("model_digest"))
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Ignoring {path}: {e}")
+                _saved_temperature[key] = None
+        return _saved_temperature[key]
+
+
+def _model_digest(model_path):
+    key = (str(model_path), Path(model_path).stat().st_mtime_ns)
+    with _saved_temperature_lock:
+        if key not in _model_digests:
+            _model_digests[key] = file_digest(model_path)
+        return _model_digests[key]
+
+
+def saved_temperature(model_path=MODEL_PATH, digest=None):
+    """Temperature saved next to model_path, or None if there is none or it was fitted on another model.
+
+    With digest, the temperature must have been fitted on the model with
+    that content hash (which model_path need not hold any more); otherwise
+    on model_path's current content.
+    """
+    saved = _read_temperature(temperature_path(model_path))
+    if saved is None:
+        return None
+    temperature, fitted_on = saved
+    if digest is None:
+        try:
+            digest = _model_digest(model_path)
+        except OSError:
+            return None
+    # A temperature only fits the model it was measured on
+    return temperature if fitted_on == digest else None
+
+
+def current_temperature(model_path=None, digest=None):
+    """Temperature for a model's output: CROP_TEMPERATURE if set, else the one saved for the model, else 1.0.
+
+    The model is given by its file or, for a result tagged with the model
+    that served it, its content hash; by default it is MODEL_PATH. A digest
+    is looked up next to the file it was loaded from in this process, and
+    next to MODEL_PATH (which inference pool workers serve by default).
+    """
+    if TEMPERATURE is not None:
+        return TEMPERATURE
+    saved = None
+    if model_path is not None:
+        saved = saved_temperature(model_path, digest)
+    elif digest is not None:
+        for path in (loaded_model_path(digest), MODEL_PATH):
+            if path is not None and saved is None:
+                saved = saved_temperature(path, digest)
+    else:
+        saved = saved_temperature(MODEL_PATH)
+    return saved if saved is not None else 1.0
+
+
+def calibrate(probabilities, temperature=None, model_path=None, digest=None):
+    """Temperature-scale softmax output (one row per image).
+
+    Without temperature, uses the one for the model that produced the
+    output, given as for current_temperature().
+    """
+    if temperature is None:
+        temperature = current_temperature(model_path, digest)
+    if temperature <= 0:
+        raise ValueError(f"Temperature must be positive, got {temperature}")
+    probabilities = np.asarray(probabilities, dtype=np.float32)
+    if temperature == 1:
+        return probabilities
+    # log(p) equals the logits up to a per-row constant, which softmax ignores
+    logits = np.log(np.clip(probabilities, 1e-12, 1.0)) / temperature
+    logits -= logits.max(axis=-1, keepdims=True)
+    scaled = np.exp(logits)
+    return scaled / scaled.sum(axis=-1, keepdims=True)
+
+
+def negative_log_likelihood(probabilities, labels, temperature):
+    """Mean NLL of the true labels after scaling raw probabilities by temperature"""
+    p = calibrate(probabilities, temperature)[np.arange(len(labels)), labels]
+    return float(-np.mean(np.log(np.clip(p, 1e-12, 1.0))))
+
+
+def fit_temperature(probabilities, labels, candidates=None):
+    """Temperature minimizing negative log-likelihood of the true labels (raw probabilities)"""
+    if candidates is None:
+        candidates = np.geomspace(0.25, 8, 64)
+    probabilities = np.asarray(probabilities, dtype=np.float32)
+    return float(min(candidates, key=lambda t: negative_log_likelihood(probabilities, labels, t)))
+
+
+def top_k(probabilities, k=TOP_K):
+    """[(label, probability), ...] for the k most likely classes of one image"""
+    order = np.argsort(probabilities)[::-1][:k]
+    return [(CLASS_NAMES[i], float(probabilities[i])) for i in order]
+
+
+def _forward(images, model):
+    """(softmax output, digest of the shared model or None if model was given)"""
+    digest = None
+    if model is None:
+        model, digest = get_registry().current()
+    return np.asarray(model(fill_batch(images), training=False)), digest
+
+
+def predict_proba_batch(images, model=None, model_path=None):
+    """Calibrated probabilities, shape (len(images), len(CLASS_NAMES)).
+
+    model_path is the file a given model was loaded from, whose saved
+    temperature is used (default MODEL_PATH).
+    """
+    probabilities, digest = _forward(images, model)
+    return calibrate(probabilities, model_path=model_path, digest=digest)
+
+
+def predict_tta(image, model=None, model_path=None):
+    """Calibrated probabilities for one image, averaged over its tta_views().
+
+    All views go through the model as a single batch.
+    """
+    probabilities, digest = _forward(tta_views(image), model)
+    return calibrate(probabilities.mean(axis=0), model_path=model_path, digest=digest)
+
+
+def predict_batch(images, model=None):
+    """One forward pass over a list of (128, 128, 3) images; returns class indices"""
+    return np.argmax(_forward(images, model)[0], axis=1)
+
+
+def predict_top_k(source, k=TOP_K, tta=False, model=None, model_path=None):
+    """[(label, probability), ...] for a single image"""
+    image = load_image(source)
+    if tta:
+        probabilities = predict_tta(image, model, model_path)
+    else:
+        probabilities = predict_proba_batch([image], model, model_path)[0]
+    return top_k(probabilities, k)
+
+
+def predict(source, model=None):
+    """Label for a single image"""
+    return CLASS_NAMES[int(predict_batch([load_image(source)], model)[0])]
@@ -0,0 +1,178 @@
+"""In-process micro-batching scheduler for model inference.
+
+Concurrent model_prediction calls (one per Streamlit session thread) put
+their preprocessed image on a shared queue. A single worker thread drains
+the queue into batches bounded by MAX_BATCH_SIZE and MAX_WAIT, runs one
+forward pass per batch and hands each caller back its own row of class
+probabilities.
+
+Each batch runs on the (model, digest) pair current when it starts, and
+predict_served() reports that digest, so callers can tag and cache a
+result under the model that actually computed it even while a new model
+is being swapped in.
+
+With CROP_INFERENCE_SOCKET set, get_batcher() instead returns a client
+for the multi-process pool in inference_pool.py, which has the same
+predict / predict_many / predict_served / stats / model_digest interface.
+"""
+import queue
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future
+
+import numpy as np
+
+import metrics
+from model_registry import MAX_BATCH_SIZE, get_registry
+from preprocessing import BatchBuffer
+
+# Longest time (seconds) the first request in a batch waits for company
+MAX_WAIT = 0.010
+
+
+def _bucket(n):
+    """Power-of-two histogram bucket label: 0, 1, 2-3, 4-7, ..."""
+    if n < 2:
+        return str(n)
+    low = 1 << (n.bit_length() - 1)
+    return f"{low}-{2 * low - 1}"
+
+
+class InferenceBatcher:
+    def __init__(self, get_current, max_batch_size=MAX_BATCH_SIZE, max_wait=MAX_WAIT):
+        # Returns (model, digest), e.g. ModelRegistry.current
+        self.get_current = get_current
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        # Only the worker thread touches this
+        self._buffer = BatchBuffer(max_batch_size)
+        self._start_lock = threading.Lock()
+        self._thread = None
+        self._stats_lock = threading.Lock()
+        self._batch_sizes = Counter()
+        self._queue_depths = Counter()
+        self._requests = 0
+        self._batches = 0
+
+    def submit(self, image_array):
+        """Queue one (128, 128, 3) uint8 or float array.
+
+        The Future resolves to (probabilities, digest of the model that computed them).
+        """
+        self._ensure_started()
+        future = Future()
+        self._queue.put((image_array, future, time.perf_counter()))
+        return future
+
+    def predict(self, image_array, timeout=None):
+        return self.submit(image_array).result(timeout=timeout)[0]
+
+    def predict_many(self, image_arrays, timeout=None):
+        """(len(image_arrays), classes) probabilities.
+
+        The arrays are queued back to back, so unless the batch fills up
+        they share one forward pass (used for test-time augmentation).
+        """
+        futures = [self.submit(image_array) for image_array in image_arrays]
+        return np.stack([future.result(timeout=timeout)[0] for future in futures])
+
+    def predict_served(self, image_arrays, timeout=None):
+        """(probabilities, digest) like predict_many(), with the digest of the model that served them.
+
+        If a model swap splits the arrays over two models, they are scored again.
+        """
+        while True:
+            futures = [self.submit(image_array) for image_array in image_arrays]
+            results = [future.result(timeout=timeout) for future in futures]
+            digests = {digest for _, digest in results}
+            if len(digests) == 1:
+                return np.stack([row for row, _ in results]), digests.pop()
+
+    def model_digest(self):
+        """Content hash of the current model, loading it if needed"""
+        return self.get_current()[1]
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "requests": self._requests,
+                "batches": self._batches,
+                "queue_depth": self._queue.qsize(),
+                "batch_size_histogram": dict(sorted(self._batch_sizes.items())),
+                "queue_depth_histogram": dict(self._queue_depths),
+            }
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="inference-batcher", daemon=True
+                )
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            with self._stats_lock:
+                self._requests += len(batch)
+                self._batches += 1
+                self._batch_sizes[len(batch)] += 1
+                self._queue_depths[_bucket(self._queue.qsize())] += 1
+
+            self._run_batch(batch)
+
+    def _run_batch(self, batch):
+        started = time.perf_counter()
+        registry = metrics.get_metrics()
+        for _, _, enqueued in batch:
+            registry.observe("batcher.queue_wait", started - enqueued)
+        registry.inc("inference_batches_total")
+        registry.inc("inference_images_total", len(batch))
+        try:
+            with metrics.span("batcher.forward"):
+                x = self._buffer.fill([image for image, _, _ in batch])
+                model, digest = self.get_current()
+                # Copied so results don't alias the model's output buffer
+                probabilities = np.array(model(x, training=False), dtype=np.float32)
+        except Exception as e:
+            registry.inc("inference_errors_total")
+            for _, future, _ in batch:
+                future.set_exception(e)
+            return
+
+        for (_, future, _), row in zip(batch, probabilities):
+            future.set_result((row, digest))
+
+
+_batcher = None
+_batcher_lock = threading.Lock()
+
+
+def get_batcher():
+    """Return the process-wide batcher (or inference pool client), creating it on first call"""
+    global _batcher
+    if _batcher is None:
+        with _batcher_lock:
+            if _batcher is None:
+                from inference_pool import POOL_SOCKET, get_pool_client
+                if POOL_SOCKET:
+                    _batcher = get_pool_client()
+                else:
+                    registry = get_registry()
+                    _batcher = InferenceBatcher(registry.current)
+                    metrics.get_metrics().set_gauge("inference_queue_depth", _batcher._queue.qsize)
+    return _batcher
@@ -0,0 +1,420 @@
+"""Multi-process inference pool behind Unix sockets.
+
+    python -m inference_pool --workers 4 --socket /tmp/crop-inference.sock
+    CROP_INFERENCE_SOCKET=/tmp/crop-inference.sock streamlit run app3.py
+
+Normally every Streamlit server process loads its own copy of the model
+and runs inference under its own GIL. In this mode a pool of worker
+processes serves one Unix socket each (<socket>.0 ... <socket>.N-1), and
+each worker runs its own InferenceBatcher. Concurrent requests from every
+app process are then batched per worker and spread over N cores.
+get_batcher() returns a PoolClient when CROP_INFERENCE_SOCKET is set, so
+app3.py dispatches to the pool without any other change.
+
+The workers share one copy of the weights instead of loading their own.
+A .keras model is converted once to a float32 .tflite file in
+local_cache/, and every worker memory-maps that same file
+(TFLiteModel(shared_weights=True)). Its pages then sit in the OS page
+cache once, however many workers there are. Workers still report the
+digest of the source model file, so results are keyed the same way as
+when the app serves that model itself.
+
+Wire format (integers big-endian):
+
+    request   op:u8 count:u32 [count * 128*128*3 uint8 pixels]
+    response  status:u8 length:u32 payload
+
+op 0 (predict) answers with the model digest (DIGEST_BYTES of ASCII hex)
+followed by count rows of float32 probabilities, and op 1 (stats) with
+the worker's batcher stats as JSON. A non-zero status
+carries a UTF-8 error message instead.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+
+import numpy as np
+
+import metrics
+from inference_batcher import InferenceBatcher
+from model_registry import INPUT_SHAPE, MODEL_PATH, file_digest
+
+POOL_SOCKET = os.environ.get("CROP_INFERENCE_SOCKET", "")
+POOL_WORKERS = int(os.environ.get("CROP_INFERENCE_WORKERS", max(1, (os.cpu_count() or 2) // 2)))
+SHARED_MODEL_DIR = Path("local_cache")
+DEFAULT_SOCKET = "/tmp/crop-inference.sock"
+REQUEST_TIMEOUT = 30
+START_TIMEOUT = 120
+# How long a PoolClient trusts the model digest it last got from a worker
+DIGEST_TTL = 5.0
+
+OP_PREDICT = 0
+OP_STATS = 1
+REQUEST_HEADER = struct.Struct("!BI")
+RESPONSE_HEADER = struct.Struct("!BI")
+IMAGE_BYTES = int(np.prod(INPUT_SHAPE))
+# Hex SHA-256 at the start of every predict response
+DIGEST_BYTES = 64
+
+
+def _recv_exact(sock, size):
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:], size - received)
+        if n == 0:
+            raise ConnectionError("inference pool connection closed")
+        received += n
+    return buffer
+
+
+def worker_socket_paths(base, workers):
+    return [f"{base}.{i}" for i in range(workers)]
+
+
+def prepare_shared_model(model_path, cache_dir=SHARED_MODEL_DIR):
+    """Path of a .tflite file every worker can memory-map.
+
+    .tflite models are used as they are; .keras models are converted once
+    per content hash and the result kept in cache_dir.
+    """
+    model_path = Path(model_path)
+    if model_path.suffix == ".tflite":
+        return model_path.resolve()
+
+    from model_export import export
+
+    target = Path(cache_dir) / f"pool_{file_digest(model_path)[:16]}.tflite"
+    if not target.exists():
+        target.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = target.with_suffix(".tmp")
+        export(model_path, "float32", tmp_path)
+        os.replace(tmp_path, target)
+    return target.resolve()
+
+
+# -- worker process ---------------------------------------------------------
+
+def _worker_main(socket_path, model_path, threads, digest):
+    """Serve model_path at socket_path; digest is the source model's content hash"""
+    from model_registry import TFLiteModel
+
+    # Spawned workers inherit CROP_METRICS_*; the supervising process owns
+    # the exporters, and worker numbers are available via op 1 instead
+    metrics.METRICS_PORT = 0
+    metrics.METRICS_FILE = ""
+
+    model = TFLiteModel(model_path, num_threads=threads, shared_weights=True)
+    batcher = InferenceBatcher(lambda: (model, digest))
+    batcher.predict(np.zeros(INPUT_SHAPE, dtype=np.uint8))
+
+    class Handler(socketserver.BaseRequestHandler):
+        def handle(self):
+            sock = self.request
+            while True:
+                try:
+                    op, count = REQUEST_HEADER.unpack(_recv_exact(sock, REQUEST_HEADER.size))
+                    body = _recv_exact(sock, count * IMAGE_BYTES) if op == OP_PREDICT else b""
+                except ConnectionError:
+                    return
+                try:
+                    if op == OP_PREDICT:
+                        images = np.frombuffer(body, dtype=np.uint8).reshape(count, *INPUT_SHAPE)
+                        probabilities, served = batcher.predict_served(list(images), timeout=REQUEST_TIMEOUT)
+                        payload = served.encode() + probabilities.tobytes()
+                    elif op == OP_STATS:
+                        stats = {**batcher.stats(), "pid": os.getpid(), "model_digest": digest}
+                        payload = json.dumps(stats).encode()
+                    else:
+                        raise ValueError(f"Unknown inference pool op {op}")
+                    status = 0
+                except Exception as e:
+                    status, payload = 1, str(e).encode()
+                sock.sendall(RESPONSE_HEADER.pack(status, len(payload)))
+                sock.sendall(payload)
+
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    # The socket only appears once the model is loaded and warm, which is
+    # what the pool and clients take as "ready"
+    server = socketserver.ThreadingUnixStreamServer(socket_path, Handler)
+    server.daemon_threads = True
+    signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=server.shutdown).start())
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+
+# -- supervisor ---------------------------------------------------------------
+
+class InferencePool:
+    """Starts the worker processes and restarts any that die"""
+
+    def __init__(self, socket_base=DEFAULT_SOCKET, workers=POOL_WORKERS, model_path=MODEL_PATH,
+                 threads_per_worker=1):
+        self.socket_base = str(socket_base)
+        self.socket_paths = worker_socket_paths(self.socket_base, workers)
+        self.model_path = model_path
+        self.threads_per_worker = threads_per_worker
+        self.shared_model_path = None
+        # Content hash of model_path (not of the converted .tflite file)
+        self.model_digest = None
+        self.processes = []
+        self._stop = threading.Event()
+        # spawn: TensorFlow/TFLite is not fork-safe once initialised
+        self._ctx = multiprocessing.get_context("spawn")
+
+    def _spawn(self, socket_path):
+        process = self._ctx.Process(
+            target=_worker_main,
+            args=(socket_path, str(self.shared_model_path), self.threads_per_worker, self.model_digest),
+            name=f"inference-worker-{socket_path.rsplit('.', 1)[-1]}",
+            daemon=True,
+        )
+        process.start()
+        return process
+
+    def start(self, timeout=START_TIMEOUT):
+        self.model_digest = file_digest(self.model_path)
+        self.shared_model_path = prepare_shared_model(self.model_path)
+        for path in self.socket_paths:
+            if os.path.exists(path):
+                os.unlink(path)  # left over from a previous run
+        self.processes = [self._spawn(path) for path in self.socket_paths]
+        self.wait_ready(timeout)
+        return self
+
+    def wait_ready(self, timeout=START_TIMEOUT):
+        deadline = time.monotonic() + timeout
+        while not all(os.path.exists(path) for path in self.socket_paths):
+            if any(not process.is_alive() for process in self.processes):
+                raise RuntimeError("An inference worker exited during startup")
+            if time.monotonic() > deadline:
+                raise TimeoutError("Inference workers didn't start in time")
+            time.sleep(0.05)
+
+    def supervise(self, interval=1.0):
+        """Block until stop(), restarting workers that have died"""
+        while not self._stop.wait(interval):
+            for i, process in enumerate(self.processes):
+                if not process.is_alive():
+                    print(f"Inference worker {i} exited ({process.exitcode}); restarting", file=sys.stderr)
+                    self.processes[i] = self._spawn(self.socket_paths[i])
+
+    def stop(self, timeout=10):
+        self._stop.set()
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+        for process in self.processes:
+            process.join(timeout)
+        for path in self.socket_paths:
+            if os.path.exists(path):
+                os.unlink(path)
+
+    def pids(self):
+        return [process.pid for process in self.processes]
+
+
+# -- client -----------------------------------------------------------------
+
+class PoolClient:
+    """Dispatches to the pool with the same interface as InferenceBatcher.
+
+    Each request goes to the worker with the fewest requests in flight from
+    this process. Connections are kept open and reused; a failed request
+    is retried once on another connection.
+    """
+
+    def __init__(self, socket_base=POOL_SOCKET, timeout=REQUEST_TIMEOUT):
+        self.socket_base = str(socket_base)
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._in_flight = {}
+        self._digest = None
+        self._digest_checked = 0.0
+        self._discover()
+
+    @property
+    def workers(self):
+        return sorted(self._in_flight)
+
+    def _discover(self):
+        base = Path(self.socket_base)
+        found = [
+            str(path) for path in base.parent.glob(base.name + ".*")
+            if path.suffix[1:].isdigit() and path.is_socket()
+        ]
+        with self._lock:
+            for path in found:
+                self._in_flight.setdefault(path, 0)
+                self._idle.setdefault(path, [])
+            for path in set(self._in_flight) - set(found):
+                for sock in self._idle.pop(path, []):
+                    sock.close()
+                del self._in_flight[path]
+
+    def _acquire(self):
+        with self._lock:
+            if not self._in_flight:
+                raise ConnectionError(f"No inference workers listening at {self.socket_base}.*")
+            path = min(self._in_flight, key=self._in_flight.get)
+            self._in_flight[path] += 1
+            sock = self._idle[path].pop() if self._idle[path] else None
+        if sock is None:
+            try:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.settimeout(self.timeout)
+                sock.connect(path)
+            except OSError:
+                sock.close()
+                self._release(path, None)
+                raise
+        return path, sock
+
+    def _release(self, path, sock):
+        with self._lock:
+            if path in self._in_flight:
+                self._in_flight[path] -= 1
+                if sock is not None:
+                    self._idle[path].append(sock)
+                    return
+        if sock is not None:
+            sock.close()
+
+    def _call(self, op, count=0, body=b""):
+        for attempt in range(2):
+            path, sock = None, None
+            try:
+                path, sock = self._acquire()
+                sock.sendall(REQUEST_HEADER.pack(op, count))
+                if body:
+                    sock.sendall(body)
+                status, length = RESPONSE_HEADER.unpack(_recv_exact(sock, RESPONSE_HEADER.size))
+                payload = _recv_exact(sock, length)
+            except OSError:
+                metrics.inc("inference_pool_errors_total")
+                if sock is not None:
+                    sock.close()
+                    self._release(path, None)
+                if attempt:
+                    raise
+                # The worker may have been restarted or the pool resized
+                self._discover()
+                continue
+            self._release(path, sock)
+            if status:
+                raise RuntimeError(f"Inference worker error: {bytes(payload).decode()}")
+            return payload
+
+    def predict_served(self, image_arrays, timeout=None):
+        """((len(image_arrays), classes) probabilities, digest of the model that served them)"""
+        body = b"".join(np.ascontiguousarray(image, dtype=np.uint8).tobytes() for image in image_arrays)
+        metrics.inc("inference_pool_requests_total")
+        payload = self._call(OP_PREDICT, len(image_arrays), body)
+        digest = bytes(payload[:DIGEST_BYTES]).decode()
+        probabilities = np.frombuffer(payload, dtype=np.float32, offset=DIGEST_BYTES)
+        return probabilities.reshape(len(image_arrays), -1), digest
+
+    def predict_many(self, image_arrays, timeout=None):
+        """(len(image_arrays), classes) probabilities for uint8 (128, 128, 3) arrays"""
+        return self.predict_served(image_arrays, timeout)[0]
+
+    def predict(self, image_array, timeout=None):
+        return self.predict_many([image_array], timeout)[0]
+
+    def model_digest(self):
+        """Content hash of the model file the pool was started with"""
+        if self._digest is None or time.monotonic() - self._digest_checked >= DIGEST_TTL:
+            self._digest = json.loads(bytes(self._call(OP_STATS)))["model_digest"]
+            self._digest_checked = time.monotonic()
+        return self._digest
+
+    def worker_stats(self):
+        """Stats from every reachable worker, keyed by socket path"""
+        self._discover()
+        stats = {}
+        for path in self.workers:
+            try:
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                    sock.settimeout(self.timeout)
+                    sock.connect(path)
+                    sock.sendall(REQUEST_HEADER.pack(OP_STATS, 0))
+                    status, length = RESPONSE_HEADER.unpack(_recv_exact(sock, RESPONSE_HEADER.size))
+                    stats[path] = json.loads(bytes(_recv_exact(sock, length)))
+            except OSError:
+                continue
+        return stats
+
+    def stats(self):
+        """Batcher stats summed over all workers (same keys as InferenceBatcher.stats)"""
+        per_worker = self.worker_stats()
+        batch_sizes, queue_depths = Counter(), Counter()
+        for stats in per_worker.values():
+            batch_sizes.update(stats["batch_size_histogram"])
+            queue_depths.update(stats["queue_depth_histogram"])
+        return {
+            "workers": len(per_worker),
+            "requests": sum(stats["requests"] for stats in per_worker.values()),
+            "batches": sum(stats["batches"] for stats in per_worker.values()),
+            "queue_depth": sum(stats["queue_depth"] for stats in per_worker.values()),
+            "batch_size_histogram": dict(sorted(batch_sizes.items(), key=lambda item: int(item[0]))),
+            "queue_depth_histogram": dict(queue_depths),
+        }
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_pool_client():
+    """Return the process-wide client for the pool at CROP_INFERENCE_SOCKET"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = PoolClient()
+    return _client
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Multi-process inference pool behind Unix sockets")
+    parser.add_argument("--socket", default=POOL_SOCKET or DEFAULT_SOCKET,
+                        help="socket path prefix; worker i listens on <socket>.<i>")
+    parser.add_argument("-w", "--workers", type=int, default=POOL_WORKERS)
+    parser.add_argument("-m", "--model", default=str(MODEL_PATH), help="model file (.keras or .tflite)")
+    parser.add_argument("--threads-per-worker", type=int, default=1,
+                        help="TFLite threads per worker process")
+    args = parser.parse_args(argv)
+
+    pool = InferencePool(args.socket, args.workers, args.model, args.threads_per_worker)
+    pool.start()
+    print(f"{args.workers} inference workers ready at {args.socket}.0-{args.workers - 1} "
+          f"(model {pool.shared_model_path})", file=sys.stderr)
+    signal.signal(signal.SIGTERM, lambda *_: pool._stop.set())
+    try:
+        pool.supervise()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pool.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
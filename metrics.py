@@ -0,0 +1,241 @@
+"""Tracing spans, counters and a Prometheus-style export.
+
+Hot paths wrap their stages in span():
+
+    with metrics.span("predict.decode"):
+        ...
+
+Every span's duration goes into a histogram labelled with the span name.
+When the current thread has an active trace() (one per Predict click,
+say), spans are also recorded there in order and with their nesting
+depth, which is what the sidebar timing breakdown shows. inc() bumps a
+counter, and set_gauge() registers a callback read at export time.
+
+render() returns the Prometheus text exposition format. It is served
+over HTTP on CROP_METRICS_PORT (GET /metrics) and/or written every
+FILE_INTERVAL seconds to CROP_METRICS_FILE (e.g. for node_exporter's
+textfile collector); both are off unless the variable is set.
+"""
+import atexit
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+METRICS_PORT = int(os.environ.get("CROP_METRICS_PORT", 0))
+METRICS_FILE = os.environ.get("CROP_METRICS_FILE", "")
+FILE_INTERVAL = 15
+PREFIX = "crop_"
+
+# Histogram bucket upper bounds in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_local = threading.local()
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in sorted(labels.items())) + "}"
+
+
+class Trace:
+    """Spans recorded on one thread between trace() entry and exit"""
+
+    def __init__(self, name):
+        self.name = name
+        self.spans = []  # [name, depth, milliseconds] in start order
+        self.depth = 0
+        self.started = time.perf_counter()
+        self.total_ms = None
+
+    def breakdown(self):
+        """[{"span", "depth", "ms"}] plus the total, for display"""
+        return {
+            "name": self.name,
+            "total_ms": self.total_ms,
+            "spans": [{"span": name, "depth": depth, "ms": ms} for name, depth, ms in self.spans],
+        }
+
+
+class Metrics:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._counters = {}
+        # span name -> [bucket counts..., +Inf count], sum
+        self._histograms = {}
+        self._gauges = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set_gauge(self, name, read):
+        """Export read() as a gauge; read is called on every render()"""
+        self._gauges[name] = read
+
+    def observe(self, span_name, seconds):
+        with self._lock:
+            counts, total = self._histograms.get(span_name, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, seconds)] += 1
+            self._histograms[span_name] = (counts, total + seconds)
+
+    @contextmanager
+    def span(self, name):
+        trace = getattr(_local, "trace", None)
+        entry = None
+        if trace is not None:
+            entry = [name, trace.depth, None]
+            trace.spans.append(entry)
+            trace.depth += 1
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.observe(name, elapsed)
+            if entry is not None:
+                entry[2] = round(elapsed * 1000, 3)
+                trace.depth -= 1
+
+    @contextmanager
+    def trace(self, name):
+        """Collect this thread's spans; nested trace() calls join the outer one"""
+        outer = getattr(_local, "trace", None)
+        if outer is not None:
+            with self.span(name):
+                yield outer
+            return
+        trace = _local.trace = Trace(name)
+        try:
+            with self.span(name):
+                yield trace
+        finally:
+            _local.trace = None
+            trace.total_ms = round((time.perf_counter() - trace.started) * 1000, 3)
+
+    def render(self):
+        """Prometheus text exposition of every counter, gauge and span histogram"""
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {name: (list(counts), total) for name, (counts, total) in self._histograms.items()}
+
+        lines = []
+        for name in sorted({name for name, _ in counters}):
+            lines.append(f"# TYPE {PREFIX}{name} counter")
+            for (counter, labels), value in sorted(counters.items()):
+                if counter == name:
+                    lines.append(f"{PREFIX}{name}{labels} {value}")
+
+        for name, read in sorted(self._gauges.items()):
+            try:
+                value = read()
+            except Exception:
+                continue
+            lines.append(f"# TYPE {PREFIX}{name} gauge")
+            lines.append(f"{PREFIX}{name} {value}")
+
+        if histograms:
+            metric = f"{PREFIX}span_duration_seconds"
+            lines.append(f"# HELP {metric} Time spent in each traced stage")
+            lines.append(f"# TYPE {metric} histogram")
+            for span_name, (counts, total) in sorted(histograms.items()):
+                cumulative = 0
+                for bound, count in zip((*self.buckets, "+Inf"), counts):
+                    cumulative += count
+                    lines.append(f'{metric}_bucket{{span="{span_name}",le="{bound}"}} {cumulative}')
+                lines.append(f'{metric}_sum{{span="{span_name}"}} {total:.6f}')
+                lines.append(f'{metric}_count{{span="{span_name}"}} {cumulative}')
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """{span: {"count", "mean_ms"}} for quick display"""
+        with self._lock:
+            return {
+                name: {"count": sum(counts), "mean_ms": round(total * 1000 / max(sum(counts), 1), 3)}
+                for name, (counts, total) in sorted(self._histograms.items())
+            }
+
+    # -- exporters ---------------------------------------------------------
+
+    def serve(self, port, host="0.0.0.0"):
+        """Serve GET /metrics on a daemon thread; returns the server"""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                data = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+        return server
+
+    def write_file(self, path):
+        """Atomically replace path with the current exposition"""
+        path = Path(path)
+        tmp_path = path.with_name(path.name + ".tmp")
+        tmp_path.write_text(self.render())
+        os.replace(tmp_path, path)
+
+    def write_periodically(self, path, interval=FILE_INTERVAL):
+        def run():
+            while True:
+                try:
+                    self.write_file(path)
+                except OSError as e:
+                    print(f"Couldn't write metrics file: {e}")
+                time.sleep(interval)
+
+        threading.Thread(target=run, name="metrics-file", daemon=True).start()
+        # Final snapshot so short-lived processes (CLI runs) leave their numbers behind
+        atexit.register(self.write_file, path)
+
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+
+def get_metrics():
+    """Return the process-wide metrics, starting the configured exporters once"""
+    global _metrics
+    if _metrics is None:
+        with _metrics_lock:
+            if _metrics is None:
+                metrics = Metrics()
+                if METRICS_PORT:
+                    try:
+                        metrics.serve(METRICS_PORT)
+                    except OSError as e:
+                        print(f"Couldn't serve metrics on port {METRICS_PORT}: {e}")
+                if METRICS_FILE:
+                    metrics.write_periodically(METRICS_FILE)
+                _metrics = metrics
+    return _metrics
+
+
+def span(name):
+    return get_metrics().span(name)
+
+
+def trace(name):
+    return get_metrics().trace(name)
+
+
+def inc(name, value=1, **labels):
+    get_metrics().inc(name, value, **labels)
@@ -0,0 +1,170 @@
+"""Local stand-in for the cloud sync API.
+
+    python -m mock_cloud --port 8765
+    CROP_SYNC_URL=http://127.0.0.1:8765 streamlit run app3.py
+
+Endpoints:
+
+    POST /sync     {"device_id", "predictions": [...], "feedback": [...]}
+                   stores records by id (re-sent records are ignored) and
+                   returns {"accepted": n}
+
+    GET /updates?cursor=<n>&limit=<n>&device_id=<id>
+                   records stored after cursor that came from other
+                   devices: {"predictions", "feedback", "next_cursor",
+                   "has_more"}; gzip-compressed when the client accepts it
+
+Every stored record gets the next value of a server-wide sequence
+number, which is what the update cursor counts in.
+
+Set fail_rate to make a fraction of requests return 503, to exercise the
+sync worker's retry and backoff, and lose_rate to make a fraction of
+/sync requests store their records but still answer 503, as if the
+response had been lost on the way back.
+"""
+import argparse
+import bisect
+import gzip
+import json
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+MAX_PAGE_SIZE = 1000
+
+
+class MockCloud:
+    """In-memory server state, shared by all request handler threads"""
+
+    def __init__(self, fail_rate=0.0, lose_rate=0.0):
+        self.fail_rate = fail_rate
+        self.lose_rate = lose_rate
+        self.lock = threading.Lock()
+        self.predictions = {}
+        self.feedback = {}
+        self.requests = 0
+        # Change log in sequence order; _seqs mirrors it for bisect
+        self._log = []
+        self._seqs = []
+
+    def _store(self, kind, record, device_id):
+        table = self.predictions if kind == "predictions" else self.feedback
+        if record["id"] in table:
+            return False
+        record = {**record, "synced": True}
+        table[record["id"]] = record
+        seq = len(self._log) + 1
+        self._log.append((seq, kind, device_id, record))
+        self._seqs.append(seq)
+        return True
+
+    def accept(self, payload):
+        with self.lock:
+            self.requests += 1
+            device_id = payload.get("device_id")
+            accepted = 0
+            for kind in ("predictions", "feedback"):
+                for record in payload.get(kind, []):
+                    accepted += self._store(kind, record, device_id)
+            return accepted
+
+    def updates(self, cursor, limit, device_id=None):
+        """One page of the change log after cursor, skipping device_id's own records"""
+        with self.lock:
+            self.requests += 1
+            page = {"predictions": [], "feedback": []}
+            next_cursor = cursor
+            i = bisect.bisect_right(self._seqs, cursor)
+            returned = 0
+            while i < len(self._log) and returned < limit:
+                seq, kind, origin, record = self._log[i]
+                if origin != device_id:
+                    page[kind].append(record)
+                    returned += 1
+                next_cursor = seq
+                i += 1
+            page["next_cursor"] = next_cursor
+            page["has_more"] = i < len(self._log)
+            return page
+
+
+def make_handler(cloud):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def _send_json(self, status, body):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            if "gzip" in self.headers.get("Accept-Encoding", ""):
+                data = gzip.compress(data, compresslevel=6)
+                self.send_header("Content-Encoding", "gzip")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _read_json(self):
+            length = int(self.headers.get("Content-Length", 0))
+            return json.loads(self.rfile.read(length) or b"{}")
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if random.random() < cloud.fail_rate:
+                self._send_json(503, {"error": "unavailable"})
+            elif url.path == "/updates":
+                query = parse_qs(url.query)
+                cursor = int(query.get("cursor", ["0"])[0])
+                limit = min(int(query.get("limit", [str(MAX_PAGE_SIZE)])[0]), MAX_PAGE_SIZE)
+                device_id = query.get("device_id", [None])[0]
+                self._send_json(200, cloud.updates(cursor, limit, device_id))
+            else:
+                self._send_json(404, {"error": "not found"})
+
+        def do_POST(self):
+            if random.random() < cloud.fail_rate:
+                self._send_json(503, {"error": "unavailable"})
+            elif self.path == "/sync":
+                accepted = cloud.accept(self._read_json())
+                if random.random() < cloud.lose_rate:
+                    self._send_json(503, {"error": "unavailable"})
+                else:
+                    self._send_json(200, {"accepted": accepted})
+            else:
+                self._send_json(404, {"error": "not found"})
+
+    return Handler
+
+
+def start_server(cloud=None, host="127.0.0.1", port=0):
+    """Serve cloud on a background thread; returns (server, base_url).
+
+    port=0 picks a free port. Call server.shutdown() when done.
+    """
+    cloud = cloud or MockCloud()
+    server = ThreadingHTTPServer((host, port), make_handler(cloud))
+    server.cloud = cloud
+    threading.Thread(target=server.serve_forever, name="mock-cloud", daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local stand-in for the cloud sync API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--fail-rate", type=float, default=0.0,
+                        help="fraction of requests answered with 503")
+    args = parser.parse_args(argv)
+
+    cloud = MockCloud(fail_rate=args.fail_rate)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(cloud))
+    print(f"Mock cloud listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+"""Export the Keras model to TFLite for CPU-only serving, and compare backends.
+
+    # dynamic-range quantized (weights int8, activations float)
+    python -m model_export --mode dynamic
+
+    # full int8, calibrated against real leaf photos
+    python -m model_export --mode int8 --calibration-dir samples/
+
+    # latency / top-1 agreement of exported models against the Keras original
+    python -m model_export --compare samples/ trained_model2_dynamic.tflite trained_model2_int8.tflite
+
+    # fit the softmax temperature on photos in folders named after the
+    # class labels; saved as trained_model2.temperature.json
+    python -m model_export --fit-temperature labelled/
+
+Serve an exported model by pointing CROP_MODEL_PATH at the .tflite file
+(see model_registry.py). Fit its temperature with --model pointing at it,
+since a temperature is only used with the model file it was fitted on.
+"""
+import argparse
+import json
+import sys
+import time
+from pathlib import Path, PurePosixPath
+
+import numpy as np
+
+import diagnosis
+from model_registry import MODEL_PATH, load_model
+from preprocessing import fill_batch, load_image
+from score_images import find_images
+
+MODES = ("float32", "dynamic", "float16", "int8")
+CALIBRATION_LIMIT = 200
+COMPARE_LIMIT = 500
+COMPARE_BATCH_SIZE = 32
+FIT_LIMIT = 5000
+REPORT_PATH = Path("model_export_report.json")
+
+
+def load_samples(directory, limit):
+    """Up to limit preprocessed uint8 images from a directory tree"""
+    directory = Path(directory)
+    samples = []
+    for path in find_images(directory)[:limit]:
+        try:
+            samples.append(load_image(directory / path, cache=False))
+        except Exception as e:
+            print(f"Skipping {path}: {e}", file=sys.stderr)
+    return samples
+
+
+def load_labelled_samples(directory, limit):
+    """(uint8 images, class indices) for photos whose folder is named after a class label.
+
+    Takes up to limit photos evenly spread over the (sorted) tree, so every
+    class is represented.
+    """
+    directory = Path(directory)
+    paths = [path for path in find_images(directory)
+             if PurePosixPath(path).parent.name in diagnosis.CLASS_NAMES]
+    paths = paths[::max(1, len(paths) // limit)][:limit]
+    images, labels = [], []
+    for path in paths:
+        try:
+            images.append(load_image(directory / path, cache=False))
+        except Exception as e:
+            print(f"Skipping {path}: {e}", file=sys.stderr)
+            continue
+        labels.append(diagnosis.CLASS_NAMES.index(PurePosixPath(path).parent.name))
+    return images, np.array(labels, dtype=np.int64)
+
+
+def fit_model_temperature(model_path, sample_dir, limit=FIT_LIMIT, batch_size=COMPARE_BATCH_SIZE):
+    """Fit the softmax temperature of model_path on labelled photos and save it next to the model"""
+    images, labels = load_labelled_samples(sample_dir, limit)
+    if not len(images):
+        raise ValueError(f"No photos in folders named after class labels under {sample_dir}")
+    # Raw softmax output: calibrate() must not have scaled it already
+    probabilities, _ = _run(load_model(model_path), images, batch_size)
+    temperature = diagnosis.fit_temperature(probabilities, labels)
+    details = {
+        "samples": len(images),
+        "nll_before": round(diagnosis.negative_log_likelihood(probabilities, labels, 1.0), 4),
+        "nll_after": round(diagnosis.negative_log_likelihood(probabilities, labels, temperature), 4),
+        "fitted_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    path = diagnosis.save_temperature(temperature, model_path, **details)
+    return path, temperature, details
+
+
+def convert(keras_model, mode, calibration_images=None):
+    """TFLite flatbuffer bytes for keras_model in the given quantization mode"""
+    import tensorflow as tf
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(keras_model)
+    if mode == "float32":
+        pass
+    elif mode == "dynamic":
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    elif mode == "float16":
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif mode == "int8":
+        if not calibration_images:
+            raise ValueError("int8 export needs calibration images (--calibration-dir)")
+
+        def representative_dataset():
+            for image in calibration_images:
+                yield [image[np.newaxis].astype(np.float32)]
+
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = representative_dataset
+        # Input/output stay float32 so callers don't need to know the scales
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    else:
+        raise ValueError(f"Unknown mode {mode!r}, expected one of {MODES}")
+    return converter.convert()
+
+
+def export(model_path, mode, output_path=None, calibration_dir=None,
+           calibration_limit=CALIBRATION_LIMIT):
+    """Convert model_path and write the .tflite file; returns its path"""
+    model_path = Path(model_path)
+    if output_path is None:
+        output_path = model_path.with_name(f"{model_path.stem}_{mode}.tflite")
+    calibration_images = load_samples(calibration_dir, calibration_limit) if calibration_dir else None
+
+    flatbuffer = convert(load_model(model_path), mode, calibration_images)
+    Path(output_path).write_bytes(flatbuffer)
+    return Path(output_path)
+
+
+def _run(model, samples, batch_size):
+    """(probabilities, per-batch latencies in ms) over all samples"""
+    outputs, latencies = [], []
+    for i in range(0, len(samples), batch_size):
+        batch = fill_batch(samples[i:i + batch_size])
+        start = time.perf_counter()
+        outputs.append(np.asarray(model(batch, training=False)))
+        latencies.append((time.perf_counter() - start) * 1000)
+    return np.concatenate(outputs), latencies
+
+
+def _latency_summary(latencies, images):
+    """Per-batch latency percentiles and throughput over images run in those batches"""
+    latencies = np.asarray(latencies)
+    return {
+        "p50_ms": round(float(np.percentile(latencies, 50)), 3),
+        "p95_ms": round(float(np.percentile(latencies, 95)), 3),
+        # Not batch_size / mean latency: the last batch may be partial
+        "images_per_second": round(images * 1000 / float(latencies.sum()), 1),
+    }
+
+
+def compare(reference_path, candidate_paths, sample_dir, limit=COMPARE_LIMIT,
+            batch_size=COMPARE_BATCH_SIZE):
+    """Latency and top-1 agreement of each candidate against the reference model"""
+    samples = load_samples(sample_dir, limit)
+    if not samples:
+        raise ValueError(f"No images found under {sample_dir}")
+
+    reference = load_model(reference_path)
+    # Warm both paths so tracing/allocation isn't counted as latency
+    _run(reference, samples[:batch_size], batch_size)
+    reference_probs, reference_latencies = _run(reference, samples, batch_size)
+    reference_top1 = reference_probs.argmax(axis=1)
+
+    report = {
+        "samples": len(samples),
+        "batch_size": batch_size,
+        "models": [{
+            "path": str(reference_path),
+            "size_bytes": Path(reference_path).stat().st_size,
+            "top1_agreement": 1.0,
+            **_latency_summary(reference_latencies, len(samples)),
+        }],
+    }
+    for path in candidate_paths:
+        model = load_model(path)
+        _run(model, samples[:batch_size], batch_size)
+        probs, latencies = _run(model, samples, batch_size)
+        report["models"].append({
+            "path": str(path),
+            "size_bytes": Path(path).stat().st_size,
+            "top1_agreement": round(float((probs.argmax(axis=1) == reference_top1).mean()), 4),
+            "max_abs_prob_diff": round(float(np.abs(probs - reference_probs).max()), 4),
+            **_latency_summary(latencies, len(samples)),
+        })
+    return report
+
+
+def format_report(report):
+    lines = [
+        f"{report['samples']} samples, batch size {report['batch_size']}",
+        "",
+        "| model | size (MB) | top-1 agreement | p50 ms | p95 ms | images/s |",
+        "|---|---|---|---|---|---|",
+    ]
+    for row in report["models"]:
+        lines.append(
+            f"| {row['path']} | {row['size_bytes'] / 1e6:.1f} | {row['top1_agreement']:.2%} "
+            f"| {row['p50_ms']} | {row['p95_ms']} | {row['images_per_second']} |"
+        )
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--model", default=str(MODEL_PATH), help="source Keras model")
+    parser.add_argument("--mode", choices=MODES, default="dynamic")
+    parser.add_argument("--output", help="output .tflite path (default: <model>_<mode>.tflite)")
+    parser.add_argument("--calibration-dir", help="sample images for int8 calibration")
+    parser.add_argument("--calibration-limit", type=int, default=CALIBRATION_LIMIT)
+    parser.add_argument("--compare", metavar="SAMPLE_DIR",
+                        help="compare the given .tflite models against --model instead of exporting")
+    parser.add_argument("--report", default=str(REPORT_PATH), help="where --compare writes its JSON report")
+    parser.add_argument("--batch-size", type=int, default=COMPARE_BATCH_SIZE)
+    parser.add_argument("--fit-temperature", metavar="SAMPLE_DIR",
+                        help="fit --model's softmax temperature on labelled photos and save it next to it")
+    parser.add_argument("--fit-limit", type=int, default=FIT_LIMIT)
+    parser.add_argument("candidates", nargs="*", help="models to compare (with --compare)")
+    args = parser.parse_args(argv)
+
+    if args.fit_temperature:
+        path, temperature, details = fit_model_temperature(
+            args.model, args.fit_temperature, args.fit_limit, args.batch_size
+        )
+        print(f"Temperature {temperature:.3f} on {details['samples']} photos (NLL "
+              f"{details['nll_before']} -> {details['nll_after']}); saved to {path}")
+        return 0
+
+    if args.compare:
+        report = compare(args.model, args.candidates, args.compare, batch_size=args.batch_size)
+        Path(args.report).write_text(json.dumps(report, indent=2))
+        print(format_report(report))
+        return 0
+
+    output = export(args.model, args.mode, args.output, args.calibration_dir, args.calibration_limit)
+    print(f"Wrote {output} ({output.stat().st_size / 1e6:.1f} MB)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,299 @@
+"""Process-wide model registry shared by every Streamlit session.
+
+Streamlit re-executes app3.py on every interaction, but imported modules
+stay in sys.modules, so the registry below lives for the whole process.
+The model is loaded once, warmed with a dummy inference and only swapped
+when the model file's mtime and content hash actually change.
+
+Every model loaded is also archived under its version (the start of its
+content hash) in local_cache/models/, so any version a stored prediction
+names can be loaded again (see model_versions.py).
+
+TensorFlow is only imported when a model is first loaded, so importing
+this module (and everything built on it) stays cheap for pages such as
+the login form that never run inference.
+"""
+import hashlib
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+
+import metrics
+
+# CROP_MODEL_PATH selects the serving backend by file type: a .keras file
+# runs through Keras, a .tflite file (see model_export.py) through TFLite
+MODEL_PATH = Path(os.environ.get("CROP_MODEL_PATH", "trained_model2.keras"))
+LOCAL_CACHE_PATH = Path("local_cache/model").with_suffix(MODEL_PATH.suffix)
+INPUT_SHAPE = (128, 128, 3)
+# Archived copies live in this folder next to the local cache copy
+ARCHIVE_DIRNAME = "models"
+VERSION_LENGTH = 12
+
+# Largest batch a TFLite interpreter is allocated for (InferenceBatcher's
+# MAX_BATCH_SIZE); see TFLiteModel
+MAX_BATCH_SIZE = 32
+
+# How often (seconds) get() is allowed to stat the model file for changes
+CHECK_INTERVAL = 5.0
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """SHA-256 of a file, read in chunks so large models don't sit in memory"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# digest -> file each model loaded in this process came from, so a result
+# tagged with a digest can be traced back to the files kept next to it
+_loaded_paths = {}
+
+
+def loaded_model_path(digest):
+    """File a model with this content hash was loaded from in this process, or None"""
+    return _loaded_paths.get(digest)
+
+
+def model_version(digest):
+    """Short version id of a model from its file's SHA-256"""
+    return digest[:VERSION_LENGTH] if digest else None
+
+
+class ModelRegistry:
+    """Holds the resident model and hot-swaps it when the file changes.
+
+    Readers never take a lock: current() returns whatever (model, digest)
+    pair is published, so requests already in flight keep using the model
+    they got while a replacement is loaded on a background thread, and a
+    digest always belongs to the model it was returned with.
+    """
+
+    def __init__(self, model_path=MODEL_PATH, cache_path=LOCAL_CACHE_PATH,
+                 check_interval=CHECK_INTERVAL):
+        self.model_path = Path(model_path)
+        # None disables the local cache copy (headless / read-only installs)
+        self.cache_path = Path(cache_path) if cache_path is not None else None
+        self.check_interval = check_interval
+        self._reload_lock = threading.Lock()
+        # (model, digest), published as one reference
+        self._current = None
+        self._mtime = None
+        self._last_check = 0.0
+        self._preloading = False
+        # Why the model couldn't be loaded, until a load succeeds
+        self.load_error = None
+
+    @property
+    def digest(self):
+        current = self._current
+        return current[1] if current else None
+
+    @property
+    def version(self):
+        return model_version(self.digest)
+
+    @property
+    def loaded(self):
+        return self._current is not None
+
+    def preload(self):
+        """Start loading the model on a background thread if it isn't loaded yet"""
+        if self._current is not None or self._preloading:
+            return
+        self._preloading = True
+
+        def run():
+            try:
+                self.get()
+            except Exception as e:
+                # get() recorded it in load_error; the next get() tries again
+                print(f"Model preload failed: {e}")
+            finally:
+                self._preloading = False
+
+        threading.Thread(target=run, name="model-preload", daemon=True).start()
+
+    def get(self):
+        """Return the current model, loading it on first use"""
+        return self.current()[0]
+
+    def current(self):
+        """(model, digest) of the current model, loading it on first use"""
+        if self._current is None:
+            with self._reload_lock:
+                if self._current is None:
+                    try:
+                        self._reload()
+                    except Exception as e:
+                        self.load_error = f"{type(e).__name__}: {e}"
+                        raise
+                    self.load_error = None
+        elif time.monotonic() - self._last_check >= self.check_interval:
+            self._check_in_background()
+        return self._current
+
+    def _source_path(self):
+        # The shipped model is the source of truth; the local cache copy is
+        # only used when it is missing (e.g. offline install)
+        if self.cache_path is None or self.model_path.exists():
+            return self.model_path
+        return self.cache_path
+
+    def _check_in_background(self):
+        # Only one checker at a time; everyone else keeps serving the old model
+        if not self._reload_lock.acquire(blocking=False):
+            return
+
+        def run():
+            try:
+                self._reload()
+            except Exception as e:
+                print(f"Model reload failed, keeping current model: {e}")
+            finally:
+                self._reload_lock.release()
+
+        threading.Thread(target=run, name="model-reload", daemon=True).start()
+
+    def _reload(self):
+        """Load the model if its file changed. Caller must hold _reload_lock."""
+        self._last_check = time.monotonic()
+        source = self._source_path()
+        mtime = os.stat(source).st_mtime_ns
+        if self._current is not None and mtime == self._mtime:
+            return
+
+        with metrics.span("model.digest"):
+            digest = file_digest(source)
+        if self._current is not None and digest == self._current[1]:
+            # Touched but not modified
+            self._mtime = mtime
+            return
+
+        with metrics.span("model.load"):
+            model = load_model(source)
+        with metrics.span("model.warm_up"):
+            warm_up(model)
+        if self.cache_path is not None:
+            with metrics.span("model.cache_copy"):
+                self._refresh_cache_copy(source, digest)
+        metrics.inc("model_loads_total")
+        _loaded_paths[digest] = Path(source)
+
+        # Single reference assignment: readers see either the old or the new
+        # model, each with its own digest
+        self._current = (model, digest)
+        self._mtime = mtime
+
+    def _refresh_cache_copy(self, source, digest):
+        """Archive source under its version; the shipped model also replaces the fallback copy"""
+        archive = self.cache_path.parent / ARCHIVE_DIRNAME / f"{model_version(digest)}{source.suffix}"
+        # Archived versions are immutable, so an existing copy is already right
+        targets = [] if archive.exists() else [archive]
+        if source == self.model_path:
+            targets.append(self.cache_path)
+        for target in targets:
+            try:
+                os.makedirs(target.parent, exist_ok=True)
+                tmp_path = target.with_suffix(".tmp")
+                shutil.copyfile(source, tmp_path)
+                os.replace(tmp_path, target)
+            except OSError as e:
+                print(f"Couldn't update local model cache: {e}")
+
+
+class TFLiteModel:
+    """Callable like a Keras model: model(x, training=False) -> probabilities.
+
+    Resizing an interpreter reallocates all of its tensors, and
+    micro-batches change size from one call to the next. So every
+    power-of-two batch size up to max_batch_size gets its own interpreter,
+    allocated once when first needed, and a batch is zero-padded up to
+    the next of those sizes (at most twice the work, but no reallocation
+    on the serving path). Larger inputs run in max_batch_size chunks.
+    Each interpreter has a lock because TFLite interpreters are not
+    thread-safe.
+
+    The model file is memory-mapped, so interpreters (and processes) that
+    open the same file share its weight pages. shared_weights=True also
+    skips the default XNNPACK delegate, which would otherwise repack the
+    weights into private memory for every interpreter.
+    """
+
+    def __init__(self, path, num_threads=None, shared_weights=False, max_batch_size=MAX_BATCH_SIZE):
+        try:
+            from ai_edge_litert.interpreter import Interpreter, OpResolverType
+        except ImportError:
+            import tensorflow as tf
+            Interpreter = tf.lite.Interpreter
+            OpResolverType = tf.lite.experimental.OpResolverType
+        resolver = OpResolverType.BUILTIN_WITHOUT_DEFAULT_DELEGATES if shared_weights else OpResolverType.AUTO
+        self._new_interpreter = lambda: Interpreter(
+            model_path=str(path), num_threads=num_threads, experimental_op_resolver_type=resolver
+        )
+        self.max_batch_size = max_batch_size
+        # padded batch size -> (interpreter, input index, output index, lock)
+        self._interpreters = {}
+        self._create_lock = threading.Lock()
+
+    def _interpreter(self, size):
+        entry = self._interpreters.get(size)
+        if entry is None:
+            with self._create_lock:
+                entry = self._interpreters.get(size)
+                if entry is None:
+                    interpreter = self._new_interpreter()
+                    input_details = interpreter.get_input_details()[0]
+                    interpreter.resize_tensor_input(input_details["index"], (size, *INPUT_SHAPE))
+                    interpreter.allocate_tensors()
+                    entry = (interpreter, input_details["index"],
+                             interpreter.get_output_details()[0]["index"], threading.Lock())
+                    self._interpreters[size] = entry
+        return entry
+
+    def __call__(self, x, training=False):
+        x = np.asarray(x, dtype=np.float32)
+        if len(x) > self.max_batch_size:
+            return np.concatenate([self(x[i:i + self.max_batch_size])
+                                   for i in range(0, len(x), self.max_batch_size)])
+        n = len(x)
+        size = 1 << (n - 1).bit_length()
+        if size != n:
+            x = np.concatenate([x, np.zeros((size - n, *x.shape[1:]), dtype=np.float32)])
+        interpreter, input_index, output_index, lock = self._interpreter(size)
+        with lock:
+            interpreter.set_tensor(input_index, x)
+            interpreter.invoke()
+            return interpreter.get_tensor(output_index)[:n].copy()
+
+
+def load_model(path):
+    """Load a .keras or .tflite model as something callable like a Keras model"""
+    if Path(path).suffix == ".tflite":
+        return TFLiteModel(path)
+    import tensorflow as tf
+    return tf.keras.models.load_model(path)
+
+
+def warm_up(model):
+    """Run one dummy inference so graph tracing happens before real traffic"""
+    model(np.zeros((1, *INPUT_SHAPE), dtype=np.float32), training=False)
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    """Return the process-wide registry, creating it on first call"""
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = ModelRegistry()
+    return _registry
@@ -0,0 +1,232 @@
+"""Model versions, A/B routing and shadow scoring.
+
+A model's version is the start of its file's SHA-256 (see
+model_registry.model_version), so the same weights always get the same
+version whatever the file is called. Predictions store the version that
+made them, and ModelRegistry archives every model it loads in
+local_cache/models/<version><suffix>.
+
+CROP_CANDIDATE_MODEL names a second model, either as a file path or as
+the version of an archived one. get_router() then:
+
+- routes CROP_CANDIDATE_FRACTION of users to the candidate and everyone
+  else to the primary model (the shared batcher or inference pool).
+  Routing hashes the username, so each user keeps seeing one model.
+- shadow-scores: every inference one model serves is run through the
+  other on a background executor. The user never waits for it, and
+  shadow work beyond MAX_SHADOW_PENDING is dropped rather than queued.
+
+Every served inference, with its shadow result when there is one, is
+recorded in local_cache/model_versions.db. stats() summarizes the most
+recent STATS_WINDOW of them per version: latency, and how often each
+pair of versions agreed on the top label. The candidate always runs
+in-process, even when the primary is an inference pool.
+"""
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+import db
+import metrics
+from inference_batcher import InferenceBatcher, get_batcher
+from model_registry import ARCHIVE_DIRNAME, LOCAL_CACHE_PATH, ModelRegistry, model_version
+
+CANDIDATE_MODEL = os.environ.get("CROP_CANDIDATE_MODEL", "")
+CANDIDATE_FRACTION = float(os.environ.get("CROP_CANDIDATE_FRACTION", 0.0))
+SHADOW = os.environ.get("CROP_SHADOW", "1") != "0"
+STATS_DB_PATH = Path("local_cache/model_versions.db")
+MAX_SHADOW_PENDING = 64
+STATS_WINDOW = 10000
+# Rows kept in model_versions.db; older ones are pruned every PRUNE_EVERY inserts
+MAX_ROWS = 100000
+PRUNE_EVERY = 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scores (
+    id INTEGER PRIMARY KEY,
+    created_at REAL NOT NULL,
+    images INTEGER NOT NULL,
+    served_version TEXT NOT NULL,
+    served_label INTEGER NOT NULL,
+    served_ms REAL NOT NULL,
+    shadow_version TEXT,
+    shadow_label INTEGER,
+    shadow_ms REAL
+);
+"""
+
+
+def resolve_model(spec, archive_dir=LOCAL_CACHE_PATH.parent / ARCHIVE_DIRNAME):
+    """Path of a model given as a file path or as an archived version"""
+    path = Path(spec)
+    if path.exists():
+        return path
+    matches = sorted(Path(archive_dir).glob(f"{spec}*"))
+    if len(matches) != 1:
+        raise FileNotFoundError(f"No model file or single archived version matching {spec!r}")
+    return matches[0]
+
+
+def _percentile(values, q):
+    return round(float(np.percentile(values, q)), 2) if len(values) else None
+
+
+class ModelRouter:
+    """Chooses a backend per user and shadow-scores with the other one.
+
+    Backends are anything with predict_served() and model_digest()
+    (InferenceBatcher, inference_pool.PoolClient).
+    """
+
+    def __init__(self, primary, candidate=None, candidate_fraction=CANDIDATE_FRACTION,
+                 shadow=SHADOW, stats_path=STATS_DB_PATH, max_pending=MAX_SHADOW_PENDING):
+        self.primary = primary
+        self.candidate = candidate
+        self.candidate_fraction = candidate_fraction if candidate is not None else 0.0
+        self.shadow = shadow and candidate is not None
+        self.max_pending = max_pending
+        self.stats_path = Path(stats_path)
+        self.stats_path.parent.mkdir(parents=True, exist_ok=True)
+        db.connect(self.stats_path).executescript(SCHEMA)
+        # Recording and shadow scoring both run here, off the request thread
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="model-shadow")
+        self._pending = 0
+        self._pending_lock = threading.Lock()
+        self._inserts = 0
+
+    def choose(self, key):
+        """Backend serving key (a username): the candidate for candidate_fraction of keys"""
+        if self.candidate_fraction <= 0:
+            return self.primary
+        bucket = int.from_bytes(hashlib.sha256(str(key).encode()).digest()[:8], "big") / 2 ** 64
+        return self.candidate if bucket < self.candidate_fraction else self.primary
+
+    def version(self, backend):
+        return model_version(backend.model_digest())
+
+    def predict_served(self, backend, image_arrays):
+        """backend.predict_served(), timed and recorded under the version that served it and shadow-scored"""
+        start = time.perf_counter()
+        probabilities, digest = backend.predict_served(image_arrays)
+        served_ms = (time.perf_counter() - start) * 1000
+        version = model_version(digest)
+        metrics.inc("model_predictions_total", version=version)
+
+        other = None
+        if self.shadow:
+            other = self.candidate if backend is self.primary else self.primary
+        with self._pending_lock:
+            if self._pending >= self.max_pending and other is not None:
+                # Only the shadow inference is dropped; the served row is
+                # still recorded, so counts and latency hold up under load
+                metrics.inc("shadow_dropped_total")
+                other = None
+            self._pending += 1
+        self._executor.submit(self._score, other, image_arrays, version,
+                              int(probabilities.mean(axis=0).argmax()), served_ms)
+        return probabilities, digest
+
+    def predict_many(self, backend, image_arrays):
+        return self.predict_served(backend, image_arrays)[0]
+
+    def reused(self, version):
+        """Count a prediction answered with an earlier result of version (no inference, so nothing to shadow)"""
+        metrics.inc("model_reused_total", version=version)
+
+    def _score(self, other, image_arrays, version, label, served_ms):
+        try:
+            row = [time.time(), len(image_arrays), version, label, served_ms, None, None, None]
+            if other is not None:
+                start = time.perf_counter()
+                probabilities, digest = other.predict_served(image_arrays)
+                shadow_ms = (time.perf_counter() - start) * 1000
+                shadow_label = int(probabilities.mean(axis=0).argmax())
+                row[5:] = [model_version(digest), shadow_label, shadow_ms]
+                metrics.inc("shadow_comparisons_total", agree=str(shadow_label == label).lower())
+            self._record(row)
+        except Exception as e:
+            print(f"Shadow scoring failed: {e}")
+        finally:
+            with self._pending_lock:
+                self._pending -= 1
+
+    def _record(self, row):
+        with db.connect(self.stats_path) as conn:
+            conn.execute(
+                "INSERT INTO scores (created_at, images, served_version, served_label, served_ms, "
+                "shadow_version, shadow_label, shadow_ms) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                row,
+            )
+            self._inserts += 1
+            if self._inserts % PRUNE_EVERY == 0:
+                conn.execute("DELETE FROM scores WHERE id <= (SELECT MAX(id) FROM scores) - ?",
+                             (MAX_ROWS,))
+
+    def wait(self):
+        """Block until recording and shadow scoring submitted so far has finished"""
+        self._executor.submit(lambda: None).result()
+
+    def stats(self, window=STATS_WINDOW):
+        """Per-version latency and pairwise agreement over the last window inferences.
+
+        Latency percentiles only count single-image requests, so TTA
+        batches don't skew them.
+        """
+        rows = db.connect(self.stats_path).execute(
+            "SELECT images, served_version, served_label, served_ms, shadow_version, shadow_label, "
+            "shadow_ms FROM scores ORDER BY id DESC LIMIT ?", (window,),
+        ).fetchall()
+        served, shadowed, pairs = {}, {}, {}
+        for row in rows:
+            served.setdefault(row["served_version"], []).append(row)
+            if row["shadow_version"] is not None:
+                shadowed.setdefault(row["shadow_version"], []).append(
+                    row["shadow_ms"] if row["images"] == 1 else None)
+                pair = pairs.setdefault((row["served_version"], row["shadow_version"]), [0, 0])
+                pair[0] += 1
+                pair[1] += row["served_label"] == row["shadow_label"]
+
+        candidate_version = self.version(self.candidate) if self.candidate is not None else None
+        versions = {}
+        for version in sorted(set(served) | set(shadowed)):
+            served_ms = [row["served_ms"] for row in served.get(version, []) if row["images"] == 1]
+            shadow_ms = [ms for ms in shadowed.get(version, []) if ms is not None]
+            versions[version] = {
+                "role": "candidate" if version == candidate_version else "primary",
+                "served": len(served.get(version, [])),
+                "served_p50_ms": _percentile(served_ms, 50),
+                "served_p95_ms": _percentile(served_ms, 95),
+                "shadow_scored": len(shadowed.get(version, [])),
+                "shadow_p50_ms": _percentile(shadow_ms, 50),
+                "shadow_p95_ms": _percentile(shadow_ms, 95),
+            }
+        agreement = [
+            {"served": served_version, "shadow": shadow_version, "compared": compared,
+             "agreement": round(agreed / compared, 4)}
+            for (served_version, shadow_version), (compared, agreed) in sorted(pairs.items())
+        ]
+        return {"versions": versions, "agreement": agreement}
+
+
+_router = None
+_router_lock = threading.Lock()
+
+
+def get_router():
+    """Return the process-wide router, loading the candidate model in the background"""
+    global _router
+    if _router is None:
+        with _router_lock:
+            if _router is None:
+                candidate = None
+                if CANDIDATE_MODEL:
+                    registry = ModelRegistry(resolve_model(CANDIDATE_MODEL), cache_path=None)
+                    registry.preload()
+                    candidate = InferenceBatcher(registry.current)
+                _router = ModelRouter(get_batcher(), candidate)
+    return _router
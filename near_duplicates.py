@@ -0,0 +1,220 @@
+"""Perceptual-hash index for finding re-uploads of the same leaf.
+
+Scouts often upload the same photo twice: re-compressed, slightly
+cropped or renamed. Those have different bytes, so the content-hash
+result cache misses, but their perceptual hashes are close:
+
+- pHash: the signs of the low 8x8 DCT coefficients of a 32x32
+  grayscale thumbnail, compared against their median
+- dHash: whether each cell of a 9x8 grayscale thumbnail is brighter
+  than its left neighbour
+
+Both are 64-bit and computed for a whole batch of decoded (128, 128, 3)
+images at once with NumPy (block means via reduceat, the DCT as two
+matrix products). Hashes are stored in predictions.db (image_index,
+see prediction_store.py) next to the prediction they belong to.
+
+DuplicateIndex keeps a BK-tree of pHashes per user, so a lookup within
+Hamming radius r only visits the subtrees whose edge distance is within
+r of the query's, not every stored photo. A duplicate must be within
+DUPLICATE_PHASH of the pHash, within DUPLICATE_DISTANCE of both hashes
+combined, and have been scored by the same model version in an accepted
+mode (see MODES); a whole-photo result is no answer to a tiled request,
+nor the other way round. The wider
+SIMILAR_PHASH radius finds the "similar past cases" shown in History.
+"""
+import threading
+
+import numpy as np
+
+import metrics
+from prediction_store import get_store
+
+HASH_SIZE = 8
+PHASH_INPUT = 32
+GRAY_WEIGHTS = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+# Hamming radii (out of 64 bits). Re-encoding moves the hashes by 0-2
+# bits and a 3% crop by up to ~10 (pHash) + 5 (dHash); different photos of
+# similar-looking leaves start at ~17 combined.
+DUPLICATE_PHASH = 10
+DUPLICATE_DISTANCE = 14
+SIMILAR_PHASH = 16
+SIMILAR_LIMIT = 5
+# How a prediction was made: the whole photo once, averaged over TTA views,
+# or pooled over tiles (tiling.py). Rows indexed before modes were recorded
+# have none and are never reused.
+MODES = ("plain", "tta", "tiled")
+
+
+def _dct_matrix(n):
+    """Orthonormal DCT-II matrix, so dct(x) = D @ x @ D.T for a 2-D block"""
+    k = np.arange(n)[:, None]
+    matrix = np.cos(np.pi * (2 * np.arange(n)[None, :] + 1) * k / (2 * n)) * np.sqrt(2 / n)
+    matrix[0] /= np.sqrt(2)
+    return matrix.astype(np.float32)
+
+
+_DCT = _dct_matrix(PHASH_INPUT)
+
+
+def _block_means(gray, rows, cols):
+    """(N, rows, cols) means of a near-even grid of blocks over (N, H, W)"""
+    height, width = gray.shape[1:]
+    row_edges = np.linspace(0, height, rows + 1).astype(int)
+    col_edges = np.linspace(0, width, cols + 1).astype(int)
+    sums = np.add.reduceat(np.add.reduceat(gray, row_edges[:-1], axis=1), col_edges[:-1], axis=2)
+    return sums / np.outer(np.diff(row_edges), np.diff(col_edges))
+
+
+def _pack(bits):
+    """(N, 64) booleans -> N Python ints"""
+    packed = np.packbits(bits.reshape(len(bits), -1), axis=1)
+    return [int(value) for value in packed.view(">u8").ravel()]
+
+
+def image_hashes(images):
+    """[(phash, dhash), ...] for a batch of uint8 (H, W, 3) images"""
+    gray = np.asarray(images, dtype=np.float32) @ GRAY_WEIGHTS
+
+    thumbnails = _block_means(gray, PHASH_INPUT, PHASH_INPUT)
+    low = (_DCT @ thumbnails @ _DCT.T)[:, :HASH_SIZE, :HASH_SIZE].reshape(len(gray), -1)
+    # The DC term is the mean brightness; leave it out of the median
+    phashes = _pack(low > np.median(low[:, 1:], axis=1, keepdims=True))
+
+    cells = _block_means(gray, HASH_SIZE, HASH_SIZE + 1)
+    dhashes = _pack(cells[:, :, 1:] > cells[:, :, :-1])
+    return list(zip(phashes, dhashes))
+
+
+def hamming(a, b):
+    return (a ^ b).bit_count()
+
+
+class BKTree:
+    """Burkhard-Keller tree over 64-bit hashes under Hamming distance"""
+
+    def __init__(self):
+        # node: [hash, [items], {distance: child}]
+        self._root = None
+        self.size = 0
+
+    def add(self, value, item):
+        self.size += 1
+        if self._root is None:
+            self._root = [value, [item], {}]
+            return
+        node = self._root
+        while True:
+            distance = hamming(value, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, [item], {}]
+                return
+            node = child
+
+    def search(self, value, radius):
+        """[(distance, item), ...] for every item within radius, nearest first"""
+        found = []
+        stack = [self._root] if self._root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hamming(value, node[0])
+            if distance <= radius:
+                found.extend((distance, item) for item in node[1])
+            # Triangle inequality: only children at edge distance d +- radius can match
+            for edge, child in node[2].items():
+                if distance - radius <= edge <= distance + radius:
+                    stack.append(child)
+        found.sort(key=lambda pair: pair[0])
+        return found
+
+
+class DuplicateIndex:
+    """Per-user BK-trees over the image_index rows of a PredictionStore"""
+
+    def __init__(self, store):
+        self.store = store
+        self._trees = {}
+        # prediction_id -> (username, phash, dhash, model_version, mode)
+        self._entries = {}
+        self._last_rowid = 0
+        self._lock = threading.Lock()
+
+    def _catch_up(self):
+        """Add rows written since the last call (by this or another process). Caller holds _lock."""
+        for row in self.store.image_index_since(self._last_rowid):
+            self._insert(row["prediction_id"], row["username"], row["phash"], row["dhash"],
+                         row["model_version"], row["mode"])
+            self._last_rowid = row["rowid"]
+
+    def _insert(self, prediction_id, username, phash, dhash, model_version, mode):
+        if prediction_id in self._entries:
+            return
+        self._entries[prediction_id] = (username, phash, dhash, model_version, mode)
+        self._trees.setdefault(username, BKTree()).add(phash, prediction_id)
+
+    def add(self, prediction_id, username, hashes, model_version, mode, probabilities):
+        """Index a new prediction made in mode; probabilities are kept so a duplicate can reuse them"""
+        if mode not in MODES:
+            raise ValueError(f"Unknown prediction mode {mode!r}")
+        phash, dhash = hashes
+        self.store.add_image_index(prediction_id, username, phash, dhash, model_version, mode,
+                                   np.asarray(probabilities, dtype=np.float32).tobytes())
+        with self._lock:
+            self._insert(prediction_id, username, phash, dhash, model_version, mode)
+
+    def find_duplicate(self, username, hashes, model_version, modes=MODES):
+        """Closest earlier prediction of this photo by username and model_version in one of modes, or None.
+
+        Returns {"prediction_id", "probabilities", "distance", "mode"}.
+        """
+        phash, dhash = hashes
+        with metrics.span("near_duplicates.lookup"), self._lock:
+            self._catch_up()
+            tree = self._trees.get(username)
+            candidates = tree.search(phash, DUPLICATE_PHASH) if tree else []
+            best = None
+            for distance, prediction_id in candidates:
+                _, _, other_dhash, other_version, mode = self._entries[prediction_id]
+                score = distance + hamming(dhash, other_dhash)
+                if other_version != model_version or mode not in modes or score > DUPLICATE_DISTANCE:
+                    continue
+                if best is None or score < best[0]:
+                    best = (score, prediction_id, mode)
+        metrics.inc("near_duplicate_lookups_total", result="hit" if best else "miss")
+        if best is None:
+            return None
+        probabilities = self.store.image_index_probabilities(best[1])
+        if probabilities is None:
+            return None
+        return {"prediction_id": best[1], "probabilities": np.frombuffer(probabilities, dtype=np.float32),
+                "distance": best[0], "mode": best[2]}
+
+    def similar(self, prediction_id, radius=SIMILAR_PHASH, limit=SIMILAR_LIMIT):
+        """[(distance, prediction_id), ...] of the same user's photos most like this one"""
+        with self._lock:
+            self._catch_up()
+            entry = self._entries.get(prediction_id)
+            if entry is None:
+                return []
+            username, phash = entry[:2]
+            found = self._trees[username].search(phash, radius)
+        return [(distance, other) for distance, other in found if other != prediction_id][:limit]
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+    """Return the process-wide index over the shared prediction store"""
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = DuplicateIndex(get_store())
+    return _index
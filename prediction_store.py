@@ -0,0 +1,517 @@
+"""SQLite-backed store for predictions and feedback.
+
+Replaces rewriting the whole of local_predictions.json on every save:
+each prediction or feedback entry is a single-row INSERT, and marking a
+record as synced is an in-place UPDATE. The database runs in WAL mode
+(see db.py), so concurrent sessions no longer overwrite each other.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from pathlib import Path
+
+import db
+import metrics
+import usage_stats
+
+DB_PATH = Path("predictions.db")
+LEGACY_JSON_PATH = Path("local_predictions.json")
+# Who gets the records without a username (imported from
+# local_predictions.json, which predates logins); unset, the first user
+# to log in does
+LEGACY_OWNER = os.environ.get("CROP_LEGACY_OWNER", "")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS predictions (
+    id TEXT PRIMARY KEY,
+    timestamp TEXT NOT NULL,
+    image_name TEXT,
+    prediction TEXT NOT NULL,
+    synced INTEGER NOT NULL DEFAULT 0,
+    treatment_info TEXT,
+    username TEXT,
+    treatment_id TEXT,
+    treatment_version INTEGER,
+    confidence REAL,
+    model_version TEXT
+);
+CREATE TABLE IF NOT EXISTS feedback (
+    id TEXT PRIMARY KEY,
+    timestamp TEXT NOT NULL,
+    prediction TEXT,
+    username TEXT,
+    feedback TEXT NOT NULL,
+    notes TEXT,
+    synced INTEGER NOT NULL DEFAULT 0,
+    prediction_id TEXT,
+    actual_label TEXT
+);
+CREATE TABLE IF NOT EXISTS image_index (
+    prediction_id TEXT PRIMARY KEY,
+    username TEXT,
+    phash INTEGER NOT NULL,
+    dhash INTEGER NOT NULL,
+    model_version TEXT,
+    probabilities BLOB,
+    mode TEXT
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+# Created after column upgrades so they can reference columns added later
+INDEXES = """
+CREATE INDEX IF NOT EXISTS idx_predictions_user_time
+    ON predictions (username, timestamp, id);
+CREATE INDEX IF NOT EXISTS idx_predictions_user_label_time
+    ON predictions (username, prediction, timestamp, id);
+CREATE INDEX IF NOT EXISTS idx_predictions_unsynced
+    ON predictions (synced) WHERE synced = 0;
+CREATE INDEX IF NOT EXISTS idx_feedback_unsynced
+    ON feedback (synced) WHERE synced = 0;
+"""
+
+# Columns added after the first release of predictions.db
+UPGRADE_COLUMNS = {
+    "predictions": {"username": "TEXT", "treatment_id": "TEXT", "treatment_version": "INTEGER",
+                    "confidence": "REAL", "model_version": "TEXT"},
+    "feedback": {"username": "TEXT", "prediction_id": "TEXT", "actual_label": "TEXT"},
+    "image_index": {"mode": "TEXT"},
+}
+
+# Columns written by every prediction INSERT. New records store a
+# (treatment_id, treatment_version) reference into the treatment knowledge
+# base; treatment_info only holds full payloads from older records.
+# model_version names the model that made the prediction (model_registry.model_version).
+PREDICTION_COLUMNS = ("id", "timestamp", "image_name", "prediction", "synced", "treatment_info",
+                      "username", "treatment_id", "treatment_version", "confidence", "model_version")
+INSERT_PREDICTION = (
+    f"INSERT INTO predictions ({', '.join(PREDICTION_COLUMNS)}) "
+    f"VALUES ({', '.join(':' + name for name in PREDICTION_COLUMNS)})"
+)
+
+# Columns returned by history queries; treatment details are loaded on demand
+SUMMARY_COLUMNS = "id, timestamp, image_name, prediction, synced, username, confidence, model_version"
+HISTORY_PAGE_SIZE = 20
+
+
+def new_record_id():
+    return uuid.uuid4().hex
+
+
+def _prediction_row(record):
+    return {
+        "id": record.get("id") or new_record_id(),
+        "timestamp": record.get("timestamp") or time.strftime("%Y-%m-%d %H:%M:%S"),
+        "image_name": record.get("image_name"),
+        "prediction": record["prediction"],
+        "synced": int(bool(record.get("synced", False))),
+        "treatment_info": json.dumps(record["treatment_info"]) if record.get("treatment_info") is not None else None,
+        "username": record.get("username"),
+        "treatment_id": record.get("treatment_id"),
+        "treatment_version": record.get("treatment_version"),
+        "confidence": record.get("confidence"),
+        "model_version": record.get("model_version"),
+    }
+
+
+def _feedback_row(record):
+    return {
+        "id": record.get("id") or new_record_id(),
+        "timestamp": record.get("timestamp") or time.strftime("%Y-%m-%d %H:%M:%S"),
+        "prediction": record.get("prediction"),
+        "username": record.get("username"),
+        "feedback": record["feedback"],
+        "notes": record.get("notes"),
+        "prediction_id": record.get("prediction_id"),
+        "actual_label": record.get("actual_label"),
+    }
+
+
+def _prediction_from_row(row):
+    record = dict(row)
+    record["synced"] = bool(record["synced"])
+    if record.get("treatment_info") is not None:
+        record["treatment_info"] = json.loads(record["treatment_info"])
+    else:
+        record.pop("treatment_info", None)
+    for key in ("treatment_id", "treatment_version", "confidence", "model_version"):
+        if record.get(key) is None:
+            record.pop(key, None)
+    return record
+
+
+def _signed64(value):
+    """SQLite integers are signed; store 64-bit hashes in two's complement"""
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def _upgrade_schema(conn):
+    for table, columns in UPGRADE_COLUMNS.items():
+        existing = {row["name"] for row in conn.execute(f"PRAGMA table_info({table})")}
+        for name, column_type in columns.items():
+            if name not in existing:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {column_type}")
+    conn.executescript(INDEXES)
+
+
+class PredictionStore:
+    def __init__(self, path=DB_PATH):
+        self.path = Path(path)
+        conn = self._conn()
+        conn.executescript(SCHEMA)
+        _upgrade_schema(conn)
+        # Triggers keep the dashboard's aggregates in step with every write
+        usage_stats.install(conn)
+
+    def _conn(self):
+        return db.connect(self.path)
+
+    # -- predictions -------------------------------------------------------
+
+    def add_prediction(self, record):
+        """Insert one prediction and return its record id"""
+        row = _prediction_row(record)
+        with metrics.span("store.add_prediction"), self._conn() as conn:
+            conn.execute(
+                INSERT_PREDICTION,
+                row,
+            )
+        return row["id"]
+
+    def add_predictions(self, records):
+        """Insert many predictions in a single transaction; returns their ids"""
+        rows = [_prediction_row(record) for record in records]
+        with metrics.span("store.add_predictions"), self._conn() as conn:
+            conn.executemany(
+                INSERT_PREDICTION,
+                rows,
+            )
+        return [row["id"] for row in rows]
+
+    def mark_prediction_synced(self, record_id):
+        with self._conn() as conn:
+            conn.execute("UPDATE predictions SET synced = 1 WHERE id = ?", (record_id,))
+
+    def get_prediction(self, record_id):
+        row = self._conn().execute("SELECT * FROM predictions WHERE id = ?", (record_id,)).fetchone()
+        return _prediction_from_row(row) if row else None
+
+    def list_predictions(self):
+        rows = self._conn().execute("SELECT * FROM predictions ORDER BY timestamp, rowid")
+        return [_prediction_from_row(row) for row in rows]
+
+    def history_page(self, username, cursor=None, limit=HISTORY_PAGE_SIZE,
+                     disease=None, date_from=None, date_to=None):
+        """One page of a user's predictions, newest first.
+
+        Uses keyset pagination on (timestamp, id): cursor is the
+        (timestamp, id) of the last row of the previous page, so every page
+        is an index range scan no matter how deep it is. date_from/date_to
+        are inclusive "YYYY-MM-DD" strings. Rows omit treatment details;
+        use get_treatment() when a record is opened.
+
+        Returns (rows, next_cursor); next_cursor is None on the last page.
+        """
+        clauses = ["username = ?"]
+        params = [username]
+        if disease:
+            clauses.append("prediction = ?")
+            params.append(disease)
+        if date_from:
+            clauses.append("timestamp >= ?")
+            params.append(str(date_from))
+        if date_to:
+            # Timestamps are "YYYY-MM-DD HH:MM:SS"; include the whole end day
+            clauses.append("timestamp < ?")
+            params.append(f"{date_to}~")
+        if cursor:
+            clauses.append("(timestamp, id) < (?, ?)")
+            params.extend(cursor)
+
+        with metrics.span("store.history_page"):
+            rows = self._conn().execute(
+                f"SELECT {SUMMARY_COLUMNS} FROM predictions WHERE {' AND '.join(clauses)} "
+                "ORDER BY timestamp DESC, id DESC LIMIT ?",
+                (*params, limit + 1),
+            ).fetchall()
+
+        records = [_prediction_from_row(row) for row in rows[:limit]]
+        next_cursor = None
+        if len(rows) > limit:
+            last = records[-1]
+            next_cursor = (last["timestamp"], last["id"])
+        return records, next_cursor
+
+    def claim_unowned(self, username):
+        """Give predictions and feedback without a username to username if it owns them.
+
+        The owner is LEGACY_OWNER, or else the first user this is called for,
+        kept in the meta table. Called on every login, so records without a
+        username that arrive later (from the cloud) are picked up too.
+        Returns the number of records claimed.
+        """
+        conn = self._conn()
+        with conn:
+            conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('legacy_owner', ?)",
+                         (LEGACY_OWNER or username,))
+            owner = LEGACY_OWNER or conn.execute(
+                "SELECT value FROM meta WHERE key = 'legacy_owner'"
+            ).fetchone()["value"]
+            if owner != username:
+                return 0
+            claimed = conn.execute("UPDATE predictions SET username = ? WHERE username IS NULL",
+                                   (username,)).rowcount
+            claimed += conn.execute("UPDATE feedback SET username = ? WHERE username IS NULL",
+                                    (username,)).rowcount
+        return claimed
+
+    def get_treatment(self, record_id):
+        """{"treatment_info"} for legacy records, {"treatment_id", "treatment_version"} for new ones"""
+        row = self._conn().execute(
+            "SELECT treatment_info, treatment_id, treatment_version FROM predictions WHERE id = ?",
+            (record_id,),
+        ).fetchone()
+        if row is None:
+            return None
+        if row["treatment_info"] is not None:
+            return {"treatment_info": json.loads(row["treatment_info"])}
+        return {"treatment_id": row["treatment_id"], "treatment_version": row["treatment_version"]}
+
+    def user_labels(self, username):
+        """Distinct labels a user has predictions for (for the disease filter)"""
+        rows = self._conn().execute(
+            "SELECT DISTINCT prediction FROM predictions WHERE username = ? ORDER BY prediction",
+            (username,),
+        )
+        return [row["prediction"] for row in rows]
+
+    def model_version_counts(self):
+        """{model_version: {"predictions", "mean_confidence"}} over all stored predictions"""
+        rows = self._conn().execute(
+            "SELECT model_version, COUNT(*) AS predictions, AVG(confidence) AS mean_confidence "
+            "FROM predictions WHERE model_version IS NOT NULL GROUP BY model_version"
+        )
+        return {row["model_version"]: {"predictions": row["predictions"],
+                                       "mean_confidence": row["mean_confidence"]} for row in rows}
+
+    # -- perceptual hash index (see near_duplicates.py) ----------------------
+
+    def add_image_index(self, prediction_id, username, phash, dhash, model_version, mode, probabilities):
+        """Store a prediction's 64-bit image hashes, how it was made and its probabilities (raw float32 bytes)"""
+        with self._conn() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO image_index "
+                "(prediction_id, username, phash, dhash, model_version, mode, probabilities) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (prediction_id, username, _signed64(phash), _signed64(dhash), model_version, mode,
+                 probabilities),
+            )
+
+    def image_index_since(self, rowid):
+        """Index rows added after rowid, oldest first, with unsigned hashes"""
+        rows = self._conn().execute(
+            "SELECT rowid, prediction_id, username, phash, dhash, model_version, mode "
+            "FROM image_index WHERE rowid > ? ORDER BY rowid",
+            (rowid,),
+        )
+        mask = (1 << 64) - 1
+        return [{**dict(row), "phash": row["phash"] & mask, "dhash": row["dhash"] & mask} for row in rows]
+
+    def image_index_probabilities(self, prediction_id):
+        row = self._conn().execute(
+            "SELECT probabilities FROM image_index WHERE prediction_id = ?", (prediction_id,)
+        ).fetchone()
+        return row["probabilities"] if row else None
+
+    # -- feedback ----------------------------------------------------------
+
+    def add_feedback(self, record):
+        """Insert one feedback entry and return its record id"""
+        row = {
+            "id": record.get("id") or new_record_id(),
+            "timestamp": record.get("timestamp") or time.strftime("%Y-%m-%d %H:%M:%S"),
+            "prediction": record.get("prediction"),
+            "username": record.get("username"),
+            "feedback": record["feedback"],
+            "notes": record.get("notes"),
+            "synced": int(bool(record.get("synced", False))),
+            # The record the feedback is about, and for "Incorrect" what it really was
+            "prediction_id": record.get("prediction_id"),
+            "actual_label": record.get("actual_label"),
+        }
+        with self._conn() as conn:
+            conn.execute(
+                "INSERT INTO feedback (id, timestamp, prediction, username, feedback, notes, synced, "
+                "prediction_id, actual_label) VALUES (:id, :timestamp, :prediction, :username, "
+                ":feedback, :notes, :synced, :prediction_id, :actual_label)",
+                row,
+            )
+        return row["id"]
+
+    def mark_feedback_synced(self, record_id):
+        with self._conn() as conn:
+            conn.execute("UPDATE feedback SET synced = 1 WHERE id = ?", (record_id,))
+
+    # -- sync queue --------------------------------------------------------
+    # Unsynced rows are the durable outbound queue: they survive restarts and
+    # are found through the partial synced = 0 indexes.
+
+    def unsynced_predictions(self, limit):
+        rows = self._conn().execute(
+            "SELECT * FROM predictions WHERE synced = 0 ORDER BY timestamp, id LIMIT ?", (limit,)
+        )
+        return [_prediction_from_row(row) for row in rows]
+
+    def unsynced_feedback(self, limit):
+        rows = self._conn().execute(
+            "SELECT * FROM feedback WHERE synced = 0 ORDER BY timestamp, id LIMIT ?", (limit,)
+        )
+        return [{**dict(row), "synced": False} for row in rows]
+
+    def pending_sync_count(self):
+        # Maintained by usage_stats triggers instead of counting unsynced rows
+        row = self._conn().execute(
+            "SELECT COALESCE(SUM(value), 0) FROM stats_totals WHERE key IN (?, ?)", usage_stats.TOTAL_KEYS
+        ).fetchone()
+        return row[0]
+
+    def mark_synced(self, prediction_ids=(), feedback_ids=()):
+        """Mark a whole uploaded batch as synced in one transaction"""
+        with self._conn() as conn:
+            conn.executemany("UPDATE predictions SET synced = 1 WHERE id = ?", [(i,) for i in prediction_ids])
+            conn.executemany("UPDATE feedback SET synced = 1 WHERE id = ?", [(i,) for i in feedback_ids])
+
+    def device_id(self):
+        """Stable random id for this installation, created on first use"""
+        conn = self._conn()
+        with conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO meta (key, value) VALUES ('device_id', ?)", (new_record_id(),)
+            )
+        return conn.execute("SELECT value FROM meta WHERE key = 'device_id'").fetchone()["value"]
+
+    # -- incremental pull --------------------------------------------------
+
+    def pull_cursor(self):
+        """Server cursor up to which cloud updates have been merged (0 = none)"""
+        row = self._conn().execute("SELECT value FROM meta WHERE key = 'pull_cursor'").fetchone()
+        return int(row["value"]) if row else 0
+
+    def merge_remote(self, predictions, feedback, cursor):
+        """Upsert one page of cloud records by id and advance the pull cursor.
+
+        Runs in a single transaction, so a crash mid-pull either keeps the
+        whole page and its cursor or neither; re-applying a page is a no-op.
+        Records without an id or their required field are skipped, and
+        missing timestamps are filled in as for local records. Returns the
+        number of records skipped.
+        """
+        # Written by other devices and app versions, so not trusted to be complete
+        prediction_rows = [{**_prediction_row(record), "synced": 1} for record in predictions
+                           if isinstance(record, dict) and record.get("id") and record.get("prediction")]
+        feedback_rows = [_feedback_row(record) for record in feedback
+                         if isinstance(record, dict) and record.get("id") and record.get("feedback")]
+        skipped = len(predictions) + len(feedback) - len(prediction_rows) - len(feedback_rows)
+        if skipped:
+            print(f"Skipped {skipped} malformed cloud records before cursor {cursor}")
+            metrics.inc("sync_skipped_records_total", skipped)
+        with self._conn() as conn:
+            conn.executemany(
+                INSERT_PREDICTION + " ON CONFLICT (id) DO UPDATE SET "
+                + ", ".join(f"{name} = excluded.{name}" for name in PREDICTION_COLUMNS if name != "id"),
+                prediction_rows,
+            )
+            conn.executemany(
+                "INSERT INTO feedback (id, timestamp, prediction, username, feedback, notes, synced, "
+                "prediction_id, actual_label) VALUES (:id, :timestamp, :prediction, :username, "
+                ":feedback, :notes, 1, :prediction_id, :actual_label) "
+                "ON CONFLICT (id) DO UPDATE SET timestamp = excluded.timestamp, "
+                "prediction = excluded.prediction, username = excluded.username, "
+                "feedback = excluded.feedback, notes = excluded.notes, synced = 1, "
+                "prediction_id = excluded.prediction_id, actual_label = excluded.actual_label",
+                feedback_rows,
+            )
+            # Never move the cursor backwards if two pulls overlap
+            conn.execute(
+                "INSERT INTO meta (key, value) VALUES ('pull_cursor', ?) "
+                "ON CONFLICT (key) DO UPDATE SET value = MAX(CAST(value AS INTEGER), CAST(excluded.value AS INTEGER))",
+                (str(cursor),),
+            )
+        return skipped
+
+    # -- migration ---------------------------------------------------------
+
+    def migrate_json(self, json_path=LEGACY_JSON_PATH):
+        """One-shot import of a legacy local_predictions.json file.
+
+        Runs in a single transaction and records the file's hash in the meta
+        table, so calling it again for the same file is a no-op. Returns the
+        number of records imported.
+        """
+        json_path = Path(json_path)
+        if not json_path.exists():
+            return 0
+
+        raw = json_path.read_bytes()
+        digest = hashlib.sha256(raw).hexdigest()
+        key = f"migrated:{json_path.resolve()}"
+        conn = self._conn()
+        done = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        if done and done["value"] == digest:
+            return 0
+
+        data = json.loads(raw)
+        imported = 0
+        with conn:
+            for i, record in enumerate(data.get("predictions", [])):
+                # Deterministic ids keep a re-run after a partial import idempotent
+                row = _prediction_row(record)
+                row["id"] = _legacy_id("prediction", i, record)
+                cur = conn.execute(
+                    INSERT_PREDICTION.replace("INSERT", "INSERT OR IGNORE", 1),
+                    row,
+                )
+                imported += cur.rowcount
+            for i, record in enumerate(data.get("feedback", [])):
+                cur = conn.execute(
+                    "INSERT OR IGNORE INTO feedback (id, timestamp, prediction, feedback, notes, synced) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (
+                        _legacy_id("feedback", i, record),
+                        record.get("timestamp"),
+                        record.get("prediction"),
+                        record.get("feedback"),
+                        record.get("notes"),
+                        int(bool(record.get("synced", False))),
+                    ),
+                )
+                imported += cur.rowcount
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, digest))
+        return imported
+
+
+def _legacy_id(kind, index, record):
+    payload = json.dumps([kind, index, record], sort_keys=True).encode()
+    return hashlib.sha1(payload).hexdigest()[:32]
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """Return the process-wide store, migrating the legacy JSON file once"""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                store = PredictionStore()
+                store.migrate_json()
+                _store = store
+    return _store
@@ -0,0 +1,197 @@
+"""Image decoding and resizing for model input.
+
+Phone photos are 12+ megapixels but the model only sees 128x128, so the
+decoder never materializes the full-resolution image as float32:
+
+- JPEGs are decoded at reduced scale by libjpeg via Image.draft()
+- other formats get a cheap integer box downscale via Image.reduce()
+- the result is resized straight to 128x128 and kept as uint8
+
+Images are converted to float32 only when copied into a reusable batch
+buffer (see BatchBuffer / fill_batch). Decoded images are cached by
+content hash, so re-predicting the same upload skips decoding entirely.
+"""
+import hashlib
+import io
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+from PIL import Image, ImageOps
+
+TARGET_SIZE = (128, 128)
+INPUT_SHAPE = (*TARGET_SIZE, 3)
+
+# draft()/reduce() stop at twice the target so the final resize still
+# has enough pixels to interpolate from
+DRAFT_SIZE = (2 * TARGET_SIZE[0], 2 * TARGET_SIZE[1])
+RESAMPLE = Image.BILINEAR
+
+# Transparent pixels (RGBA PNGs, GIFs with a transparent index) are
+# composited onto this colour instead of exposing whatever RGB is stored
+ALPHA_BACKGROUND = (255, 255, 255)
+
+# 128*128*3 bytes each, so 512 entries is ~25 MB
+CACHE_ENTRIES = 512
+
+# Test-time augmentation crops keep this fraction of each side
+TTA_CROP = 0.875
+
+
+def read_bytes(source):
+    """Raw bytes from a path, bytes, Streamlit UploadedFile or file object"""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return bytes(source)
+    if isinstance(source, (str, Path)):
+        return Path(source).read_bytes()
+    if hasattr(source, "getvalue"):
+        return source.getvalue()
+    source.seek(0)
+    return source.read()
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def open_rgb(data, draft_size=DRAFT_SIZE):
+    """Decode image bytes to an RGB PIL image no smaller than about draft_size.
+
+    JPEGs are decoded at reduced scale and other formats box-reduced, so a
+    12 MP photo is never fully decoded when only a small image is needed.
+    """
+    with Image.open(io.BytesIO(data)) as image:
+        # Animated GIFs: classify the first frame
+        image.seek(0)
+        # No-op for anything but JPEG
+        image.draft("RGB", draft_size)
+        image = ImageOps.exif_transpose(image)
+
+        has_alpha = image.mode in ("RGBA", "LA") or (
+            image.mode == "P" and "transparency" in image.info
+        )
+        image = image.convert("RGBA" if has_alpha else "RGB")
+
+        factor = min(image.width // draft_size[0], image.height // draft_size[1])
+        if factor >= 2:
+            image = image.reduce(factor)
+
+        if has_alpha:
+            background = Image.new("RGBA", image.size, ALPHA_BACKGROUND + (255,))
+            image = Image.alpha_composite(background, image).convert("RGB")
+        return image
+
+
+def decode(data):
+    """Decode image bytes to a uint8 (128, 128, 3) RGB array"""
+    image = open_rgb(data).resize(TARGET_SIZE, RESAMPLE)
+    return np.asarray(image, dtype=np.uint8)
+
+
+class PreprocessCache:
+    """Thread-safe LRU of decoded images keyed by content hash"""
+
+    def __init__(self, max_entries=CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+_cache = PreprocessCache()
+
+
+def load_image(source, cache=True, key=None):
+    """Decoded uint8 (128, 128, 3) array for source, served from cache when possible.
+
+    Pass key if the caller already has content_hash() of the bytes.
+    Cached arrays are shared and marked read-only.
+    """
+    data = read_bytes(source)
+    if not cache:
+        return decode(data)
+
+    if key is None:
+        key = content_hash(data)
+    image = _cache.get(key)
+    if image is None:
+        image = decode(data)
+        image.flags.writeable = False
+        _cache.put(key, image)
+    return image
+
+
+def tta_views(image):
+    """Test-time augmentation views of a (128, 128, 3) image, original first.
+
+    Flips and rotations are strided numpy views (no copies); BatchBuffer
+    materializes them when it casts to float32. The two crops are resized
+    back to 128x128.
+    """
+    height, width = image.shape[:2]
+    crop_h, crop_w = round(height * TTA_CROP), round(width * TTA_CROP)
+    top, left = (height - crop_h) // 2, (width - crop_w) // 2
+    crop = Image.fromarray(np.ascontiguousarray(image[top:top + crop_h, left:left + crop_w]))
+    crop = np.asarray(crop.resize(TARGET_SIZE, RESAMPLE), dtype=np.uint8)
+    return [
+        image,
+        image[:, ::-1],
+        image[::-1],
+        np.rot90(image, 1),
+        np.rot90(image, 2),
+        np.rot90(image, 3),
+        crop,
+        crop[:, ::-1],
+    ]
+
+
+class BatchBuffer:
+    """Reusable float32 model-input buffer.
+
+    Not thread-safe: each consumer thread needs its own (see fill_batch).
+    """
+
+    def __init__(self, capacity):
+        self.array = np.empty((capacity, *INPUT_SHAPE), dtype=np.float32)
+
+    def fill(self, images):
+        """Copy images into the buffer and return a (len(images), ...) view.
+
+        The view is overwritten by the next fill() call.
+        """
+        if len(images) > len(self.array):
+            self.array = np.empty((len(images), *INPUT_SHAPE), dtype=np.float32)
+        for i, image in enumerate(images):
+            # Casts uint8 -> float32 in place, no temporary copy
+            self.array[i] = image
+        return self.array[:len(images)]
+
+
+_local = threading.local()
+
+
+def fill_batch(images):
+    """fill() this thread's BatchBuffer with images"""
+    buffer = getattr(_local, "buffer", None)
+    if buffer is None:
+        buffer = _local.buffer = BatchBuffer(len(images))
+    return buffer.fill(images)
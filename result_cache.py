@@ -0,0 +1,156 @@
+"""Content-addressed cache of prediction results.
+
+Keyed on (SHA-256 of the image bytes, SHA-256 of the model file), so a
+repeated Predict on the same upload returns instantly and a new
+trained_model2.keras automatically misses. Recent results live in an
+in-memory LRU; everything is also written to a small SQLite table so
+results survive restarts. Results are kept for the LIVE_MODELS most
+recently used models (a primary and an A/B candidate serve side by
+side); entries for any other model are purged when a new model hash
+pushes it out. After a restart the live models are the ones whose
+results were written most recently.
+
+Values are the model's raw (uncalibrated) class probabilities, so
+changing the temperature or top-k needs no purge. Callers may extend the
+image key (e.g. "<hash>:tta") to cache other scoring modes.
+"""
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+
+import db
+import metrics
+
+CACHE_DB_PATH = Path("local_cache/prediction_results.db")
+MEMORY_ENTRIES = 1024
+# Models whose results are kept; room for a reload while a candidate runs
+LIVE_MODELS = 3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    image_hash TEXT NOT NULL,
+    model_hash TEXT NOT NULL,
+    class_index INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (image_hash, model_hash)
+);
+"""
+
+# Rows cached before probabilities were stored have none and count as misses
+UPGRADE_COLUMNS = {"probabilities": "BLOB"}
+
+
+class ResultCache:
+    def __init__(self, path=CACHE_DB_PATH, memory_entries=MEMORY_ENTRIES, live_models=LIVE_MODELS):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.memory_entries = memory_entries
+        self.live_models = live_models
+        # (model_hash, image_hash) -> probabilities
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        # Live model hashes, least recently used first
+        self._model_hashes = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        conn = self._conn()
+        conn.executescript(SCHEMA)
+        existing = {row["name"] for row in conn.execute("PRAGMA table_info(results)")}
+        for name, column_type in UPGRADE_COLUMNS.items():
+            if name not in existing:
+                conn.execute(f"ALTER TABLE results ADD COLUMN {name} {column_type}")
+        # Pick up where the last run left off, so the first request after a
+        # restart doesn't purge the results of the other live models
+        rows = conn.execute(
+            "SELECT model_hash, MAX(created_at) AS last_used FROM results "
+            "GROUP BY model_hash ORDER BY last_used DESC LIMIT ?",
+            (live_models,),
+        ).fetchall()
+        for row in reversed(rows):
+            self._model_hashes[row["model_hash"]] = None
+
+    def _conn(self):
+        return db.connect(self.path)
+
+    def _use_model(self, model_hash):
+        """Mark model_hash live, dropping results of models that fall out. Caller holds _lock."""
+        if model_hash in self._model_hashes:
+            self._model_hashes.move_to_end(model_hash)
+            return
+        self._model_hashes[model_hash] = None
+        while len(self._model_hashes) > self.live_models:
+            self._model_hashes.popitem(last=False)
+        live = list(self._model_hashes)
+        for key in [key for key in self._memory if key[0] not in self._model_hashes]:
+            del self._memory[key]
+        # Also clears out models from earlier runs the first time a model is seen
+        with self._conn() as conn:
+            conn.execute(
+                f"DELETE FROM results WHERE model_hash NOT IN ({', '.join('?' * len(live))})", live
+            )
+
+    def get(self, image_hash, model_hash):
+        """Cached float32 probabilities (read-only), or None on a miss"""
+        key = (model_hash, image_hash)
+        with self._lock:
+            self._use_model(model_hash)
+            value = self._memory.get(key)
+            if value is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                metrics.inc("result_cache_requests_total", result="memory_hit")
+                return value
+
+        row = self._conn().execute(
+            "SELECT probabilities FROM results WHERE image_hash = ? AND model_hash = ?",
+            (image_hash, model_hash),
+        ).fetchone()
+        with self._lock:
+            if row is None or row["probabilities"] is None:
+                self.misses += 1
+                metrics.inc("result_cache_requests_total", result="miss")
+                return None
+            self.hits += 1
+            metrics.inc("result_cache_requests_total", result="disk_hit")
+            probabilities = np.frombuffer(row["probabilities"], dtype=np.float32)
+            self._remember(key, probabilities)
+            return probabilities
+
+    def put(self, image_hash, model_hash, probabilities):
+        probabilities = np.array(probabilities, dtype=np.float32)
+        probabilities.flags.writeable = False
+        with self._lock:
+            self._use_model(model_hash)
+            self._remember((model_hash, image_hash), probabilities)
+        with self._conn() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO results "
+                "(image_hash, model_hash, class_index, probabilities, created_at) VALUES (?, ?, ?, ?, ?)",
+                (image_hash, model_hash, int(np.argmax(probabilities)), probabilities.tobytes(), time.time()),
+            )
+
+    def _remember(self, key, probabilities):
+        self._memory[key] = probabilities
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "memory_entries": len(self._memory)}
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_result_cache():
+    """Return the process-wide result cache"""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ResultCache()
+    return _cache
@@ -0,0 +1,168 @@
+"""Headless batch scoring of a directory tree of leaf photos.
+
+    python -m score_images photos/ --output results.jsonl --workers 4
+
+Images are scored in batches across a pool of worker processes, each of
+which loads the model once. Every finished batch is appended to the
+output JSONL and flushed, so the output file doubles as the checkpoint:
+re-running the same command after an interruption skips images that
+already have a result.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+from pathlib import Path
+
+from bulk_diagnosis import IMAGE_EXTENSIONS
+
+BATCH_SIZE = 32
+
+# Set in each worker process by _init_worker
+_model = None
+_model_path = None
+
+
+def find_images(root):
+    """Image paths under root, relative to it, in a stable order"""
+    root = Path(root)
+    found = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if Path(filename).suffix.lower() in IMAGE_EXTENSIONS:
+                found.append((Path(dirpath) / filename).relative_to(root).as_posix())
+    return found
+
+
+def load_checkpoint(output_path):
+    """Paths already scored in output_path.
+
+    A run killed mid-write can leave a partial last line; it is truncated
+    away so appending resumes on a clean line boundary.
+    """
+    done = set()
+    if not output_path.exists():
+        return done
+
+    good_bytes = 0
+    with open(output_path, "rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                done.add(json.loads(line)["path"])
+            except (ValueError, KeyError):
+                break
+            good_bytes += len(line)
+    with open(output_path, "r+b") as f:
+        f.truncate(good_bytes)
+    return done
+
+
+def _init_worker(model_path, threads):
+    global _model, _model_path
+    import tensorflow as tf
+
+    if threads:
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(1)
+
+    from model_registry import ModelRegistry
+    _model = ModelRegistry(model_path, cache_path=None).get()
+    # Probabilities are scaled by the temperature saved for this model
+    _model_path = model_path
+
+
+def _score_batch(task):
+    from diagnosis import CLASS_NAMES, get_treatment_info, predict_proba_batch, top_k
+    from preprocessing import load_image
+
+    root, paths, with_treatments = task
+    arrays, results = [], []
+    for path in paths:
+        try:
+            # Every file is seen once, so skip the decode cache
+            arrays.append(load_image(Path(root) / path, cache=False))
+            results.append({"path": path, "prediction": None, "error": None})
+        except Exception as e:
+            results.append({"path": path, "prediction": None, "error": str(e)})
+
+    ok = [result for result in results if result["error"] is None]
+    if ok:
+        for result, probabilities in zip(ok, predict_proba_batch(arrays, _model, _model_path)):
+            index = int(probabilities.argmax())
+            result["class_index"] = index
+            result["prediction"] = CLASS_NAMES[index]
+            result["confidence"] = round(float(probabilities[index]), 4)
+            result["top_k"] = [[label, round(p, 4)] for label, p in top_k(probabilities)]
+            if with_treatments:
+                result["treatment_info"] = get_treatment_info(result["prediction"])
+    return results
+
+
+def score_directory(root, output_path, model_path, workers=1, batch_size=BATCH_SIZE,
+                    threads_per_worker=None, with_treatments=False, progress=None):
+    """Score every image under root into output_path; returns how many were scored"""
+    output_path = Path(output_path)
+    done = load_checkpoint(output_path)
+    pending = [path for path in find_images(root) if path not in done]
+    if not pending:
+        return 0
+
+    tasks = [
+        (str(root), pending[i:i + batch_size], with_treatments)
+        for i in range(0, len(pending), batch_size)
+    ]
+    scored = 0
+    # spawn: TensorFlow is not fork-safe once initialised
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(workers, initializer=_init_worker, initargs=(str(model_path), threads_per_worker)) as pool, \
+            open(output_path, "a") as out:
+        for results in pool.imap_unordered(_score_batch, tasks):
+            out.writelines(json.dumps(result) + "\n" for result in results)
+            out.flush()
+            os.fsync(out.fileno())
+            scored += len(results)
+            if progress:
+                progress(scored, len(pending))
+    return scored
+
+
+def main(argv=None):
+    from model_registry import MODEL_PATH
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("root", help="directory to scan recursively for images")
+    parser.add_argument("-o", "--output", default="results.jsonl",
+                        help="JSONL output, also used as the resume checkpoint")
+    parser.add_argument("-m", "--model", default=str(MODEL_PATH), help="model file (.keras or .tflite)")
+    parser.add_argument("-w", "--workers", type=int, default=max(1, (os.cpu_count() or 2) // 2),
+                        help="number of worker processes")
+    parser.add_argument("-b", "--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--threads-per-worker", type=int, default=None,
+                        help="TensorFlow intra-op threads per worker (default: TF decides)")
+    parser.add_argument("--treatments", action="store_true",
+                        help="include local treatment info in each result")
+    args = parser.parse_args(argv)
+
+    def progress(done, total):
+        print(f"\r{done}/{total} images scored", end="", file=sys.stderr, flush=True)
+
+    scored = score_directory(
+        args.root, args.output, args.model,
+        workers=args.workers,
+        batch_size=args.batch_size,
+        threads_per_worker=args.threads_per_worker,
+        with_treatments=args.treatments,
+        progress=progress,
+    )
+    if scored:
+        print(file=sys.stderr)
+    print(f"Scored {scored} new images into {args.output}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
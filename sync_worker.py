@@ -0,0 +1,197 @@
+"""Background two-way sync of predictions and feedback with the cloud.
+
+The unsynced rows in predictions.db are the outbound queue. A daemon
+thread drains them in bulk uploads of up to BATCH_SIZE records to
+SYNC_URL + "/sync", marks each accepted batch as synced in a single
+transaction, and retries failures with exponential backoff plus jitter.
+Record ids make uploads idempotent, so a batch that is re-sent after a
+lost response is harmless.
+
+After each upload the worker pulls records from other devices with
+pull_updates(): pages of at most PULL_PAGE_SIZE records after this
+device's stored cursor, gzip-compressed, each merged by record id in one
+transaction together with the new cursor. Transfer and merge cost thus
+depend on what changed since the last pull, not on the total history.
+
+The worker is off unless CROP_SYNC_URL is set; records then simply stay
+"Local only". mock_cloud.py provides a local stand-in server.
+"""
+import os
+import random
+import threading
+
+import requests
+
+import metrics
+from connectivity import get_monitor
+from prediction_store import get_store
+
+SYNC_URL = os.environ.get("CROP_SYNC_URL", "").rstrip("/")
+BATCH_SIZE = 100
+PULL_PAGE_SIZE = 500
+REQUEST_TIMEOUT = 10
+# Re-check for work this often even if nobody calls notify()
+POLL_INTERVAL = 60
+BACKOFF_MIN = 2
+BACKOFF_MAX = 300
+
+
+class SyncWorker:
+    def __init__(self, store, base_url=SYNC_URL, is_online=None, batch_size=BATCH_SIZE,
+                 poll_interval=POLL_INTERVAL, backoff_min=BACKOFF_MIN, backoff_max=BACKOFF_MAX):
+        self.store = store
+        self.base_url = base_url
+        self.is_online = is_online or (lambda: get_monitor().is_online())
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        self.session = requests.Session()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._pull_lock = threading.Lock()
+        self.uploaded = 0
+        self.pulled = 0
+        self.failures = 0
+        self.last_error = None
+
+    @property
+    def enabled(self):
+        return bool(self.base_url)
+
+    def start(self):
+        if not self.enabled or self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="sync-worker", daemon=True)
+                self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def notify(self):
+        """New local records were committed; drain now rather than at the next poll"""
+        self._wake.set()
+
+    def sync_once(self):
+        """Upload one batch; returns the number of records the server accepted"""
+        predictions = self.store.unsynced_predictions(self.batch_size)
+        feedback = self.store.unsynced_feedback(self.batch_size - len(predictions))
+        if not predictions and not feedback:
+            return 0
+
+        with metrics.span("sync.upload"):
+            response = self.session.post(
+                f"{self.base_url}/sync",
+                json={
+                    "device_id": self.store.device_id(),
+                    "predictions": predictions,
+                    "feedback": feedback,
+                },
+                timeout=REQUEST_TIMEOUT,
+            )
+            response.raise_for_status()
+        self.store.mark_synced(
+            [record["id"] for record in predictions],
+            [record["id"] for record in feedback],
+        )
+        count = len(predictions) + len(feedback)
+        self.uploaded += count
+        metrics.inc("sync_uploaded_records_total", count)
+        return count
+
+    def pull_updates(self, page_size=PULL_PAGE_SIZE):
+        """Merge cloud records newer than this device's cursor.
+
+        Returns {"records", "pages", "bytes", "skipped"}; bytes is the
+        on-the-wire (compressed) response size and skipped counts malformed
+        records left out of the merge.
+        """
+        stats = {"records": 0, "pages": 0, "bytes": 0, "skipped": 0}
+        with self._pull_lock, metrics.span("sync.pull"):
+            cursor = self.store.pull_cursor()
+            device_id = self.store.device_id()
+            while True:
+                response = self.session.get(
+                    f"{self.base_url}/updates",
+                    params={"cursor": cursor, "limit": page_size, "device_id": device_id},
+                    headers={"Accept-Encoding": "gzip"},
+                    timeout=REQUEST_TIMEOUT,
+                )
+                response.raise_for_status()
+                page = response.json()
+                stats["skipped"] += self.store.merge_remote(
+                    page["predictions"], page["feedback"], page["next_cursor"]
+                )
+
+                stats["pages"] += 1
+                stats["records"] += len(page["predictions"]) + len(page["feedback"])
+                stats["bytes"] += int(response.headers.get("Content-Length", len(response.content)))
+                cursor = page["next_cursor"]
+                if not page["has_more"]:
+                    break
+        self.pulled += stats["records"]
+        metrics.inc("sync_pulled_records_total", stats["records"])
+        metrics.inc("sync_pulled_bytes_total", stats["bytes"])
+        return stats
+
+    def _run(self):
+        backoff = self.backoff_min
+        while not self._stop.is_set():
+            # Cleared before looking for work so a notify() during the upload isn't lost
+            self._wake.clear()
+            delay = self.poll_interval
+            if self.is_online():
+                try:
+                    if self.sync_once() == self.batch_size:
+                        # Full batch: there is probably more waiting
+                        delay = 0
+                    else:
+                        self.pull_updates()
+                    backoff = self.backoff_min
+                    self.last_error = None
+                # Anything else too (e.g. a sqlite3 error): the thread must
+                # outlive one bad request, or nothing would sync again
+                except Exception as e:
+                    self.failures += 1
+                    self.last_error = str(e)
+                    metrics.inc("sync_failures_total")
+                    # Sleep out the backoff even if new records arrive meanwhile
+                    self._stop.wait(backoff * random.uniform(0.5, 1.5))
+                    backoff = min(backoff * 2, self.backoff_max)
+                    continue
+
+            if delay:
+                self._wake.wait(delay)
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "pending": self.store.pending_sync_count(),
+            "uploaded": self.uploaded,
+            "pulled": self.pulled,
+            "failures": self.failures,
+            "last_error": self.last_error,
+        }
+
+
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def get_sync_worker():
+    """Return the process-wide sync worker, started on first call"""
+    global _worker
+    if _worker is None:
+        with _worker_lock:
+            if _worker is None:
+                _worker = SyncWorker(get_store())
+                _worker.start()
+                metrics.get_metrics().set_gauge("sync_pending_records", _worker.store.pending_sync_count)
+    return _worker
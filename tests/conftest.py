@@ -0,0 +1,39 @@
+"""Shared fixtures: a fresh prediction store and a local mock cloud server.
+
+The app's modules live at the top of the repository, not in a package,
+so the repository root is put on sys.path here.
+"""
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import mock_cloud  # noqa: E402
+from prediction_store import PredictionStore  # noqa: E402
+
+
+@pytest.fixture
+def store(tmp_path):
+    return PredictionStore(tmp_path / "predictions.db")
+
+
+@pytest.fixture
+def cloud():
+    """(MockCloud, base_url) of a server running for the duration of the test"""
+    server, base_url = mock_cloud.start_server()
+    yield server.cloud, base_url
+    server.shutdown()
+    server.server_close()
+
+
+def make_prediction(i, **fields):
+    return {"id": f"p{i:05d}", "timestamp": f"2026-01-01 00:{i // 60 % 60:02d}:{i % 60:02d}",
+            "image_name": f"leaf{i}.jpg", "prediction": "Tomato___healthy", "username": "alice",
+            **fields}
+
+
+def make_feedback(i, **fields):
+    return {"id": f"f{i:05d}", "timestamp": f"2026-01-01 01:{i // 60 % 60:02d}:{i % 60:02d}",
+            "prediction": "Tomato___healthy", "username": "alice", "feedback": "Correct", **fields}
@@ -0,0 +1,47 @@
+"""Temperatures saved next to model files (diagnosis.save_temperature)"""
+import numpy as np
+import pytest
+
+import diagnosis
+import model_registry
+
+
+@pytest.fixture
+def models(tmp_path, monkeypatch):
+    """Two stand-in model files, the first one as MODEL_PATH"""
+    monkeypatch.setattr(diagnosis, "TEMPERATURE", None)
+    primary, candidate = tmp_path / "primary.keras", tmp_path / "candidate.keras"
+    primary.write_bytes(b"primary weights")
+    candidate.write_bytes(b"candidate weights")
+    monkeypatch.setattr(diagnosis, "MODEL_PATH", primary)
+    return primary, candidate
+
+
+def test_each_model_gets_its_own_temperature(models, monkeypatch):
+    primary, candidate = models
+    diagnosis.save_temperature(2.0, primary)
+    diagnosis.save_temperature(0.5, candidate)
+    candidate_digest = model_registry.file_digest(candidate)
+
+    assert diagnosis.current_temperature() == 2.0
+    assert diagnosis.current_temperature(candidate) == 0.5
+    assert diagnosis.current_temperature(digest=model_registry.file_digest(primary)) == 2.0
+    # A digest is traced to the file it was loaded from in this process
+    assert diagnosis.current_temperature(digest=candidate_digest) == 1.0
+    monkeypatch.setitem(model_registry._loaded_paths, candidate_digest, candidate)
+    assert diagnosis.current_temperature(digest=candidate_digest) == 0.5
+
+    probabilities = np.array([[0.7, 0.2, 0.1]], dtype=np.float32)
+    assert np.allclose(diagnosis.calibrate(probabilities, digest=candidate_digest),
+                       diagnosis.calibrate(probabilities, 0.5))
+
+
+def test_temperature_of_another_model_is_ignored(models):
+    primary, _ = models
+    diagnosis.save_temperature(2.0, primary)
+    primary.write_bytes(b"retrained weights")
+
+    assert diagnosis.current_temperature() == 1.0
+    assert diagnosis.current_temperature(digest="0" * 64) == 1.0
+    with pytest.raises(ValueError):
+        diagnosis.calibrate([[0.5, 0.5]], 0)
@@ -0,0 +1,37 @@
+"""ModelRouter recording and shadow scoring with stand-in backends"""
+import numpy as np
+
+from model_versions import ModelRouter
+
+
+class FakeBackend:
+    def __init__(self, digest, label):
+        self.digest = digest
+        self.label = label
+        self.calls = 0
+
+    def model_digest(self):
+        return self.digest
+
+    def predict_served(self, image_arrays):
+        self.calls += 1
+        probabilities = np.zeros((len(image_arrays), 10), dtype=np.float32)
+        probabilities[:, self.label] = 1.0
+        return probabilities, self.digest
+
+
+def test_full_shadow_backlog_still_records_served_rows(tmp_path):
+    primary, candidate = FakeBackend("a" * 64, 1), FakeBackend("b" * 64, 2)
+    router = ModelRouter(primary, candidate, shadow=True, stats_path=tmp_path / "versions.db",
+                         max_pending=0)
+    image = np.zeros((128, 128, 3), dtype=np.uint8)
+
+    for _ in range(5):
+        router.predict_served(primary, [image])
+    router.wait()
+
+    stats = router.stats()["versions"]
+    assert stats["a" * 12]["served"] == 5
+    # The shadow inferences were all dropped
+    assert candidate.calls == 0
+    assert router.stats()["agreement"] == []
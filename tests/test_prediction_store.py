@@ -0,0 +1,36 @@
+"""PredictionStore: records without a username (legacy JSON import)"""
+import json
+
+import prediction_store
+from conftest import make_feedback, make_prediction
+
+
+def write_legacy_json(path, predictions):
+    records = [{key: value for key, value in make_prediction(i).items() if key not in ("id", "username")}
+               for i in range(predictions)]
+    path.write_text(json.dumps({"predictions": records, "feedback": []}))
+
+
+def test_first_user_to_log_in_owns_imported_records(store, tmp_path):
+    write_legacy_json(tmp_path / "local_predictions.json", 3)
+    assert store.migrate_json(tmp_path / "local_predictions.json") == 3
+    assert store.history_page("alice") == ([], None)
+
+    assert store.claim_unowned("alice") == 3
+    assert store.claim_unowned("bob") == 0
+    assert len(store.history_page("alice")[0]) == 3
+    assert store.history_page("bob") == ([], None)
+
+    # Records without a username that arrive later go to the same owner
+    store.merge_remote([make_prediction(10, username=None)], [make_feedback(10, username=None)], 2)
+    assert store.claim_unowned("bob") == 0
+    assert store.claim_unowned("alice") == 2
+
+
+def test_configured_legacy_owner(store, tmp_path, monkeypatch):
+    monkeypatch.setattr(prediction_store, "LEGACY_OWNER", "carol")
+    write_legacy_json(tmp_path / "local_predictions.json", 2)
+    store.migrate_json(tmp_path / "local_predictions.json")
+
+    assert store.claim_unowned("alice") == 0
+    assert store.claim_unowned("carol") == 2
@@ -0,0 +1,126 @@
+"""Incremental pulls (SyncWorker.pull_updates / PredictionStore.merge_remote) against the mock cloud"""
+import pytest
+import requests
+
+from conftest import make_feedback, make_prediction
+from sync_worker import SyncWorker
+
+OTHER_DEVICE = "other-device"
+
+
+def seed_other_device(server, predictions, feedback=0, start=0):
+    server.accept({
+        "device_id": OTHER_DEVICE,
+        "predictions": [make_prediction(start + i, username="bob") for i in range(predictions)],
+        "feedback": [make_feedback(start + i, username="bob") for i in range(feedback)],
+    })
+
+
+class InterruptAfter:
+    """Wraps session.get: records each requested cursor and fails the request after the first calls"""
+
+    def __init__(self, get, calls):
+        self.get = get
+        self.calls = calls
+        self.cursors = []
+
+    def __call__(self, url, **kwargs):
+        self.cursors.append(kwargs["params"]["cursor"])
+        if len(self.cursors) > self.calls:
+            raise requests.ConnectionError("connection dropped")
+        return self.get(url, **kwargs)
+
+
+def counts(store):
+    conn = store._conn()
+    return (conn.execute("SELECT COUNT(*) FROM predictions").fetchone()[0],
+            conn.execute("SELECT COUNT(*) FROM feedback").fetchone()[0])
+
+
+def test_interrupted_pull_resumes_from_its_cursor(store, cloud):
+    server, base_url = cloud
+    seed_other_device(server, predictions=250, feedback=20)
+    worker = SyncWorker(store, base_url, is_online=lambda: True)
+    worker.session.get = InterruptAfter(worker.session.get, calls=2)
+
+    with pytest.raises(requests.ConnectionError):
+        worker.pull_updates(page_size=100)
+    # The two pages that arrived were merged, each with its cursor
+    assert store.pull_cursor() == 200
+    assert counts(store) == (200, 0)
+
+    worker.session.get = InterruptAfter(worker.session.get.get, calls=10)
+    stats = worker.pull_updates(page_size=100)
+    assert worker.session.get.cursors == [200]
+    assert (stats["records"], stats["pages"]) == (70, 1)
+    assert store.pull_cursor() == 270
+    assert counts(store) == (250, 20)
+
+
+def test_reapplying_a_page_is_a_no_op(store, cloud):
+    server, base_url = cloud
+    seed_other_device(server, predictions=30, feedback=5)
+    page = server.updates(0, 100)
+
+    store.merge_remote(page["predictions"], page["feedback"], page["next_cursor"])
+    first = (counts(store), store.list_predictions(), store.pull_cursor(), store.pending_sync_count())
+    store.merge_remote(page["predictions"], page["feedback"], page["next_cursor"])
+    second = (counts(store), store.list_predictions(), store.pull_cursor(), store.pending_sync_count())
+
+    assert first == second
+    assert first[0] == (30, 5)
+    assert first[3] == 0
+
+
+def test_cursor_never_moves_backwards(store, cloud):
+    server, base_url = cloud
+    seed_other_device(server, predictions=300)
+    worker = SyncWorker(store, base_url, is_online=lambda: True)
+    worker.pull_updates(page_size=100)
+    assert store.pull_cursor() == 300
+
+    # A late, overlapping pull re-delivers an older page
+    stale = server.updates(0, 100)
+    store.merge_remote(stale["predictions"], stale["feedback"], stale["next_cursor"])
+    assert store.pull_cursor() == 300
+
+    seed_other_device(server, predictions=10, start=300)
+    assert worker.pull_updates(page_size=100)["records"] == 10
+    assert store.pull_cursor() == 310
+
+
+def test_own_uploads_are_not_pulled_back(store, cloud):
+    server, base_url = cloud
+    store.add_predictions([make_prediction(i) for i in range(20)])
+    store.add_feedback(make_feedback(0))
+    worker = SyncWorker(store, base_url, is_online=lambda: True)
+    assert worker.sync_once() == 21
+    seed_other_device(server, predictions=5, start=1000)
+
+    stats = worker.pull_updates(page_size=100)
+
+    assert stats["records"] == 5
+    assert counts(store) == (25, 1)
+    # The cursor still moves past this device's own records
+    assert store.pull_cursor() == 26
+    assert worker.pull_updates(page_size=100)["records"] == 0
+
+
+def test_malformed_records_are_skipped_and_the_pull_moves_on(store, cloud):
+    server, base_url = cloud
+    server.accept({
+        "device_id": OTHER_DEVICE,
+        "predictions": [make_prediction(0, username="bob"),
+                        {"id": "p-no-label", "username": "bob"}],
+        "feedback": [make_feedback(0, username="bob", timestamp=None),
+                     {"id": "f-no-text", "username": "bob"}],
+    })
+    worker = SyncWorker(store, base_url, is_online=lambda: True)
+
+    stats = worker.pull_updates(page_size=100)
+
+    assert (stats["records"], stats["skipped"]) == (4, 2)
+    assert counts(store) == (1, 1)
+    # A missing timestamp is filled in, as for local records
+    assert store._conn().execute("SELECT timestamp FROM feedback").fetchone()[0]
+    assert store.pull_cursor() == 4
@@ -0,0 +1,28 @@
+"""ResultCache: which models' results survive a restart"""
+import numpy as np
+
+from result_cache import ResultCache
+
+PROBABILITIES = np.full(10, 0.1, dtype=np.float32)
+
+
+def test_reopening_keeps_every_live_models_results(tmp_path):
+    cache = ResultCache(tmp_path / "results.db", live_models=2)
+    cache.put("image", "primary", PROBABILITIES)
+    cache.put("image", "candidate", PROBABILITIES)
+
+    reopened = ResultCache(tmp_path / "results.db", live_models=2)
+    assert reopened.get("image", "primary") is not None
+    assert reopened.get("image", "candidate") is not None
+
+
+def test_new_model_pushes_out_the_least_recently_written(tmp_path):
+    cache = ResultCache(tmp_path / "results.db", live_models=2)
+    for model_hash in ("old", "primary", "candidate"):
+        cache.put("image", model_hash, PROBABILITIES)
+
+    reopened = ResultCache(tmp_path / "results.db", live_models=2)
+    reopened.put("image", "retrained", PROBABILITIES)
+    # Read directly: get() would mark the model it asks for live again
+    rows = reopened._conn().execute("SELECT model_hash FROM results ORDER BY model_hash").fetchall()
+    assert [row["model_hash"] for row in rows] == ["candidate", "retrained"]
@@ -0,0 +1,145 @@
+"""SyncWorker uploads against the local mock cloud (mock_cloud.py)"""
+import socket
+import sqlite3
+import threading
+
+import pytest
+import requests
+
+import mock_cloud
+import sync_worker
+from conftest import make_feedback, make_prediction
+from sync_worker import BATCH_SIZE, SyncWorker
+
+
+class RecordingCloud(mock_cloud.MockCloud):
+    """MockCloud that remembers how many records each /sync request carried"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.batch_sizes = []
+
+    def accept(self, payload):
+        self.batch_sizes.append(len(payload["predictions"]) + len(payload["feedback"]))
+        return super().accept(payload)
+
+
+class StopAfter(threading.Event):
+    """Stand-in for SyncWorker._stop that records backoff waits instead of sleeping"""
+
+    def __init__(self, waits):
+        super().__init__()
+        self.waits = []
+        self.max_waits = waits
+
+    def wait(self, timeout=None):
+        self.waits.append(timeout)
+        if len(self.waits) >= self.max_waits:
+            self.set()
+        return self.is_set()
+
+
+@pytest.fixture
+def recording_cloud():
+    server, base_url = mock_cloud.start_server(RecordingCloud())
+    yield server.cloud, base_url
+    server.shutdown()
+    server.server_close()
+
+
+def unused_url():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return f"http://127.0.0.1:{sock.getsockname()[1]}"
+
+
+def test_uploads_in_batches_of_at_most_batch_size(store, recording_cloud):
+    cloud, base_url = recording_cloud
+    store.add_predictions([make_prediction(i) for i in range(2 * BATCH_SIZE + 30)])
+    for i in range(40):
+        store.add_feedback(make_feedback(i))
+    worker = SyncWorker(store, base_url, is_online=lambda: True)
+
+    while worker.sync_once():
+        pass
+
+    assert cloud.batch_sizes == [BATCH_SIZE, BATCH_SIZE, 70]
+    assert len(cloud.predictions) == 2 * BATCH_SIZE + 30
+    assert len(cloud.feedback) == 40
+    assert store.pending_sync_count() == 0
+
+
+def test_rows_stay_unsynced_until_the_server_accepts_them(store, cloud):
+    server, base_url = cloud
+    store.add_predictions([make_prediction(i) for i in range(5)])
+    worker = SyncWorker(store, base_url, is_online=lambda: True)
+
+    server.fail_rate = 1.0
+    with pytest.raises(requests.HTTPError):
+        worker.sync_once()
+    assert len(store.unsynced_predictions(10)) == 5
+
+    server.fail_rate = 0.0
+    assert worker.sync_once() == 5
+    assert store.unsynced_predictions(10) == []
+    assert all(record["synced"] for record in store.list_predictions())
+
+
+def test_resending_a_batch_after_a_lost_response_creates_no_duplicates(store, cloud):
+    server, base_url = cloud
+    store.add_predictions([make_prediction(i) for i in range(5)])
+    store.add_feedback(make_feedback(0))
+    worker = SyncWorker(store, base_url, is_online=lambda: True)
+
+    # The server stores the batch but the client never hears back
+    server.lose_rate = 1.0
+    with pytest.raises(requests.HTTPError):
+        worker.sync_once()
+    assert len(server.predictions) == 5
+    assert store.pending_sync_count() == 6
+
+    server.lose_rate = 0.0
+    assert worker.sync_once() == 6
+    assert len(server.predictions) == 5
+    assert len(server.feedback) == 1
+    assert len(server._log) == 6
+    assert store.pending_sync_count() == 0
+
+
+@pytest.mark.parametrize("failure", ["server_error", "connection_error"])
+def test_failures_back_off_exponentially_up_to_the_maximum(store, cloud, monkeypatch, failure):
+    server, base_url = cloud
+    if failure == "server_error":
+        server.fail_rate = 1.0
+    else:
+        base_url = unused_url()
+    store.add_prediction(make_prediction(0))
+    # No jitter, so the waits are exactly the backoff sequence
+    monkeypatch.setattr(sync_worker.random, "uniform", lambda low, high: 1.0)
+    worker = SyncWorker(store, base_url, is_online=lambda: True, backoff_min=1, backoff_max=8)
+    worker._stop = StopAfter(waits=6)
+
+    worker._run()
+
+    assert worker._stop.waits == [1, 2, 4, 8, 8, 8]
+    assert worker.failures == 6
+    assert worker.last_error
+    assert len(store.unsynced_predictions(10)) == 1
+
+
+def test_unexpected_errors_back_off_instead_of_stopping_the_worker(store, cloud, monkeypatch):
+    server, base_url = cloud
+    monkeypatch.setattr(sync_worker.random, "uniform", lambda low, high: 1.0)
+    worker = SyncWorker(store, base_url, is_online=lambda: True, backoff_min=1, backoff_max=8)
+
+    def broken_merge(*args):
+        raise sqlite3.IntegrityError("NOT NULL constraint failed: feedback.timestamp")
+
+    monkeypatch.setattr(store, "merge_remote", broken_merge)
+    worker._stop = StopAfter(waits=3)
+
+    worker._run()
+
+    assert worker._stop.waits == [1, 2, 4]
+    assert worker.failures == 3
+    assert "NOT NULL" in worker.last_error
@@ -0,0 +1,156 @@
+"""Tiled inference for high-resolution field photos.
+
+The normal path squashes the whole photo to 128x128, so a few small
+lesions on a wide shot of a plant are lost. Here the photo is decoded at
+up to MAX_SIDE pixels, cut into overlapping TILE_SIZE tiles every
+TILE_STRIDE pixels, and every tile that is mostly plant is classified in
+one batched call:
+
+- tiles are strided views of the decoded image (sliding_window_view), so
+  only the tiles that get classified are ever copied
+- background (soil, sky, stakes) is skipped with an excess-green mask,
+  2G - R - B > GREEN_THRESHOLD, which also keeps yellowed leaves
+- the per-image diagnosis pools the tile probabilities: healthy classes
+  are averaged over all tiles, while each disease scores the mean of its
+  LESION_FRACTION best tiles, so a lesion seen on a few tiles is not
+  averaged away by the healthy leaf around it
+- the heatmap is each tile's disease probability (1 - P(healthy))
+  averaged over the overlapping tiles at TILE_STRIDE resolution
+"""
+import io
+import math
+
+import numpy as np
+from PIL import Image
+
+from diagnosis import CLASS_NAMES, calibrate
+from preprocessing import RESAMPLE, TARGET_SIZE, open_rgb
+
+TILE_SIZE = TARGET_SIZE[0]
+# Must divide TILE_SIZE; half a tile means every point is seen by up to 4 tiles
+TILE_STRIDE = TILE_SIZE // 2
+MAX_SIDE = 768
+# Tiles with less plant than this are background
+MIN_PLANT_FRACTION = 0.2
+GREEN_THRESHOLD = 20
+# Keep the greenest tiles if a photo has more than this many
+MAX_TILES = 96
+# Below this there is nothing to gain over the whole-photo prediction
+MIN_TILES = 2
+LESION_FRACTION = 0.1
+HEATMAP_COLOR = (255, 0, 0)
+HEATMAP_ALPHA = 0.6
+
+HEALTHY = np.array([name.endswith("healthy") for name in CLASS_NAMES])
+
+
+def grid_size(width, height, max_side=MAX_SIDE, tile=TILE_SIZE, stride=TILE_STRIDE):
+    """(width, height) to resize a photo to so whole tiles cover it exactly.
+
+    The photo is scaled to fit max_side, then each side is rounded to
+    tile + k * stride; the stretch that adds is under stride / 2 pixels.
+    """
+    scale = min(1.0, max_side / max(width, height))
+
+    def fit(side):
+        return tile + stride * max(0, round((side * scale - tile) / stride))
+
+    return fit(width), fit(height)
+
+
+def decode_tiled(data, max_side=MAX_SIDE):
+    """uint8 (H, W, 3) RGB array sized by grid_size()"""
+    with Image.open(io.BytesIO(data)) as image:
+        width, height = image.size
+    scale = min(1.0, max_side / max(width, height))
+    # Square draft request: draft() scales both sides alike, so the short
+    # side decides
+    short = math.ceil(min(width, height) * scale)
+    image = open_rgb(data, (short, short))
+    image = image.resize(grid_size(*image.size, max_side=max_side), RESAMPLE)
+    return np.asarray(image, dtype=np.uint8)
+
+
+def tile_view(array, tile=TILE_SIZE, stride=TILE_STRIDE):
+    """(rows, cols, tile, tile, ...) view of the overlapping tiles of array (no copy)"""
+    windows = np.lib.stride_tricks.sliding_window_view(array, (tile, tile), axis=(0, 1))
+    # sliding_window_view puts the window axes last
+    return np.moveaxis(windows[::stride, ::stride], (-2, -1), (2, 3))
+
+
+def plant_mask(image, threshold=GREEN_THRESHOLD):
+    """Boolean (H, W) excess-green mask"""
+    r, g, b = np.moveaxis(image.astype(np.int16), -1, 0)
+    return 2 * g - r - b > threshold
+
+
+def pool_tiles(probabilities, lesion_fraction=LESION_FRACTION):
+    """Per-image probabilities from (tiles, classes) tile probabilities"""
+    k = max(1, math.ceil(lesion_fraction * len(probabilities)))
+    lesion = np.sort(probabilities, axis=0)[-k:].mean(axis=0)
+    pooled = np.where(HEALTHY, probabilities.mean(axis=0), lesion)
+    return pooled / pooled.sum()
+
+
+def heatmap(scores, keep, tile=TILE_SIZE, stride=TILE_STRIDE):
+    """(cells_y, cells_x) mean tile score per stride-sized cell, NaN where no tile was kept"""
+    rows, cols = keep.shape
+    per = tile // stride
+    shape = (rows - 1 + per, cols - 1 + per)
+    sums = np.zeros(shape, dtype=np.float32)
+    counts = np.zeros(shape, dtype=np.int32)
+    scores = np.where(keep, scores, 0)
+    # Each tile covers per x per cells; one pass per offset within the tile
+    for dy in range(per):
+        for dx in range(per):
+            sums[dy:dy + rows, dx:dx + cols] += scores
+            counts[dy:dy + rows, dx:dx + cols] += keep
+    with np.errstate(invalid="ignore"):
+        return np.where(counts > 0, sums / counts, np.nan)
+
+
+def overlay(image, cells, stride=TILE_STRIDE, color=HEATMAP_COLOR, alpha=HEATMAP_ALPHA):
+    """image with the heatmap blended on top in color, as uint8"""
+    weight = np.nan_to_num(cells).repeat(stride, axis=0).repeat(stride, axis=1)[..., None] * alpha
+    blended = image * (1 - weight) + np.array(color, dtype=np.float32) * weight
+    return blended.astype(np.uint8)
+
+
+def classify_tiles(image, predict_served, max_tiles=MAX_TILES, min_tiles=MIN_TILES):
+    """Tile, classify and pool a grid-sized image.
+
+    predict_served is a backend's predict_served (InferenceBatcher or
+    PoolClient) or anything else returning (probabilities, model digest).
+    Returns None when fewer than min_tiles tiles are plant, otherwise
+    {"probabilities", "model_digest", "tiles", "grid", "heatmap", "overlay"}.
+    """
+    tiles = tile_view(image)
+    rows, cols = tiles.shape[:2]
+    fraction = tile_view(plant_mask(image)).mean(axis=(2, 3))
+    keep = fraction >= MIN_PLANT_FRACTION
+    if keep.sum() > max_tiles:
+        cutoff = np.sort(fraction, axis=None)[-max_tiles]
+        keep &= fraction >= cutoff
+    if keep.sum() < min_tiles:
+        return None
+
+    # The only copy: the kept tiles, in row-major order
+    probabilities, digest = predict_served(list(tiles[keep]))
+    # Scaled by the temperature of the model that served the tiles
+    probabilities = calibrate(probabilities, digest=digest)
+    scores = np.zeros((rows, cols), dtype=np.float32)
+    scores[keep] = 1 - probabilities[:, HEALTHY].sum(axis=1)
+    cells = heatmap(scores, keep)
+    return {
+        "probabilities": pool_tiles(probabilities),
+        "model_digest": digest,
+        "tiles": int(keep.sum()),
+        "grid": (rows, cols),
+        "heatmap": cells,
+        "overlay": overlay(image, cells),
+    }
+
+
+def predict_tiled(data, predict_served, max_side=MAX_SIDE):
+    """classify_tiles() on image bytes"""
+    return classify_tiles(decode_tiled(data, max_side), predict_served)
@@ -0,0 +1,157 @@
+"""Versioned treatment knowledge base.
+
+treatment_kb.json (shipped with the app) seeds a small SQLite table of
+(treatment id, version) -> payload in treatments.db. Every version ever
+loaded is kept, so a prediction can store just its treatment id and
+version and still render the exact advice it was given later on.
+
+Lookups are served from an in-memory snapshot of the current version.
+When CROP_TREATMENTS_URL is set, the snapshot is refreshed from that URL
+in the background once REFRESH_TTL has passed; the remote document has
+the same shape as treatment_kb.json and is only applied if its version
+is newer.
+"""
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+import requests
+
+import db
+
+SEED_PATH = Path(__file__).resolve().parent / "treatment_kb.json"
+KB_DB_PATH = Path("treatments.db")
+REMOTE_URL = os.environ.get("CROP_TREATMENTS_URL", "")
+REFRESH_TTL = 3600
+REQUEST_TIMEOUT = 5
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS treatments (
+    id TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    payload TEXT NOT NULL,
+    PRIMARY KEY (id, version)
+);
+CREATE TABLE IF NOT EXISTS kb_meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+class TreatmentKB:
+    def __init__(self, path=KB_DB_PATH, seed_path=SEED_PATH, remote_url=REMOTE_URL,
+                 ttl=REFRESH_TTL):
+        self.path = Path(path)
+        self.remote_url = remote_url
+        self.ttl = ttl
+        self._refreshing = threading.Lock()
+        # First online lookup triggers a refresh
+        self._last_refresh = float("-inf")
+        # Older versions fetched for history records: (id, version) -> payload
+        self._versions = {}
+
+        self._conn().executescript(SCHEMA)
+        if Path(seed_path).exists():
+            self.apply(json.loads(Path(seed_path).read_text()))
+        self._load_current()
+
+    def _conn(self):
+        return db.connect(self.path)
+
+    def _current_version(self):
+        row = self._conn().execute("SELECT value FROM kb_meta WHERE key = 'version'").fetchone()
+        return int(row["value"]) if row else 0
+
+    def _load_current(self):
+        version = self._current_version()
+        rows = self._conn().execute(
+            "SELECT id, payload FROM treatments WHERE version = ?", (version,)
+        )
+        # (version, payloads) is swapped as one reference so readers always
+        # see a consistent pair
+        self._snapshot = (version, {row["id"]: json.loads(row["payload"]) for row in rows})
+
+    @property
+    def version(self):
+        return self._snapshot[0]
+
+    def labels(self):
+        return sorted(self._snapshot[1])
+
+    def apply(self, document):
+        """Store a {"version", "treatments"} document if it is newer; returns True if applied"""
+        version = int(document["version"])
+        if version <= self._current_version():
+            return False
+        with self._conn() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO treatments (id, version, payload) VALUES (?, ?, ?)",
+                [(treatment_id, version, json.dumps(payload))
+                 for treatment_id, payload in document["treatments"].items()],
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO kb_meta (key, value) VALUES ('version', ?)", (str(version),)
+            )
+        self._load_current()
+        return True
+
+    def lookup(self, treatment_id, online=False):
+        """(payload or None, version) from the current version"""
+        if online:
+            self.maybe_refresh()
+        version, payloads = self._snapshot
+        return payloads.get(treatment_id), version
+
+    def get(self, treatment_id, version):
+        """Payload for an exact (id, version), e.g. to render an old prediction"""
+        current_version, payloads = self._snapshot
+        if version == current_version:
+            return payloads.get(treatment_id)
+
+        key = (treatment_id, version)
+        if key not in self._versions:
+            row = self._conn().execute(
+                "SELECT payload FROM treatments WHERE id = ? AND version = ?", key
+            ).fetchone()
+            self._versions[key] = json.loads(row["payload"]) if row else None
+        return self._versions[key]
+
+    def maybe_refresh(self):
+        """Refresh from the remote source in the background once the TTL has passed"""
+        if not self.remote_url or time.monotonic() - self._last_refresh < self.ttl:
+            return
+        if not self._refreshing.acquire(blocking=False):
+            return
+        self._last_refresh = time.monotonic()
+
+        def run():
+            try:
+                self.refresh()
+            except (requests.RequestException, ValueError, KeyError) as e:
+                print(f"Treatment knowledge base refresh failed: {e}")
+            finally:
+                self._refreshing.release()
+
+        threading.Thread(target=run, name="treatment-kb-refresh", daemon=True).start()
+
+    def refresh(self):
+        response = requests.get(self.remote_url, timeout=REQUEST_TIMEOUT)
+        response.raise_for_status()
+        return self.apply(response.json())
+
+
+_kb = None
+_kb_lock = threading.Lock()
+
+
+def get_kb():
+    """Return the process-wide knowledge base"""
+    global _kb
+    if _kb is None:
+        with _kb_lock:
+            if _kb is None:
+                _kb = TreatmentKB()
+    return _kb
@@ -0,0 +1,326 @@
+"""Incrementally maintained usage statistics for the Statistics dashboard.
+
+    python -m usage_stats              # compare aggregates with the raw records
+    python -m usage_stats --rebuild    # recompute them first, then compare
+
+Counting predictions per label and day, feedback accuracy and the sync
+backlog by scanning every record would cost O(history) on each rerun.
+Instead, SQLite triggers on the predictions and feedback tables keep
+these small tables in predictions.db current, in the same transaction
+as every insert, update (e.g. a sync upsert) and delete:
+
+- stats_predictions: counts per (scope, username, day, label). day is
+  YYYY-MM-DD, or '' for the all-time total
+- stats_feedback: feedback counts per (scope, username, label, feedback)
+- stats_confusion: "Incorrect" feedback per (scope, username, predicted
+  label, actual label), for feedback that names the actual label
+- stats_totals: unsynced prediction and feedback counts
+
+scope is 'user' for one user's rows and 'all' (with username '') for
+the global ones. The dashboard reads a bounded number of these rows,
+however long the history is. install() backfills the tables with
+rebuild() the first time it runs on an existing database.
+"""
+import argparse
+import sys
+import threading
+import time
+
+import db
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS stats_predictions (
+    scope TEXT NOT NULL,
+    username TEXT NOT NULL,
+    day TEXT NOT NULL,
+    label TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (scope, username, day, label)
+);
+CREATE TABLE IF NOT EXISTS stats_feedback (
+    scope TEXT NOT NULL,
+    username TEXT NOT NULL,
+    label TEXT NOT NULL,
+    feedback TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (scope, username, label, feedback)
+);
+CREATE TABLE IF NOT EXISTS stats_confusion (
+    scope TEXT NOT NULL,
+    username TEXT NOT NULL,
+    predicted TEXT NOT NULL,
+    actual TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (scope, username, predicted, actual)
+);
+CREATE TABLE IF NOT EXISTS stats_totals (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+INSTALLED_KEY = "usage_stats_installed"
+TOTAL_KEYS = ("unsynced_predictions", "unsynced_feedback")
+DASHBOARD_DAYS = 30
+
+
+def _bump_prediction(row, sign):
+    """Trigger statement adding sign to the four counters a prediction row feeds"""
+    day = f"substr({row}.timestamp, 1, 10)"
+    user = f"COALESCE({row}.username, '')"
+    return f"""
+    INSERT INTO stats_predictions (scope, username, day, label, count) VALUES
+        ('all', '', {day}, {row}.prediction, {sign}),
+        ('all', '', '', {row}.prediction, {sign}),
+        ('user', {user}, {day}, {row}.prediction, {sign}),
+        ('user', {user}, '', {row}.prediction, {sign})
+    ON CONFLICT (scope, username, day, label) DO UPDATE SET count = count + ({sign});"""
+
+
+def _bump_feedback(row, sign):
+    user = f"COALESCE({row}.username, '')"
+    label = f"COALESCE({row}.prediction, '')"
+    return f"""
+    INSERT INTO stats_feedback (scope, username, label, feedback, count) VALUES
+        ('all', '', {label}, {row}.feedback, {sign}),
+        ('user', {user}, {label}, {row}.feedback, {sign})
+    ON CONFLICT (scope, username, label, feedback) DO UPDATE SET count = count + ({sign});
+    INSERT INTO stats_confusion (scope, username, predicted, actual, count)
+        SELECT 'all', '', {label}, {row}.actual_label, {sign}
+        WHERE {row}.feedback = 'Incorrect' AND {row}.actual_label IS NOT NULL
+        UNION ALL
+        SELECT 'user', {user}, {label}, {row}.actual_label, {sign}
+        WHERE {row}.feedback = 'Incorrect' AND {row}.actual_label IS NOT NULL
+    ON CONFLICT (scope, username, predicted, actual) DO UPDATE SET count = count + ({sign});"""
+
+
+def _bump_unsynced(table, row, sign):
+    return f"""
+    UPDATE stats_totals SET value = value + ({sign})
+        WHERE key = 'unsynced_{table}' AND {row}.synced = 0;"""
+
+
+TRIGGERS = f"""
+CREATE TRIGGER IF NOT EXISTS stats_predictions_insert AFTER INSERT ON predictions BEGIN
+    {_bump_prediction("NEW", 1)}
+    {_bump_unsynced("predictions", "NEW", 1)}
+END;
+CREATE TRIGGER IF NOT EXISTS stats_predictions_delete AFTER DELETE ON predictions BEGIN
+    {_bump_prediction("OLD", -1)}
+    {_bump_unsynced("predictions", "OLD", -1)}
+END;
+CREATE TRIGGER IF NOT EXISTS stats_predictions_update AFTER UPDATE OF prediction, username, timestamp
+    ON predictions
+    WHEN OLD.prediction IS NOT NEW.prediction OR OLD.username IS NOT NEW.username
+        OR OLD.timestamp IS NOT NEW.timestamp
+BEGIN
+    {_bump_prediction("OLD", -1)}
+    {_bump_prediction("NEW", 1)}
+END;
+CREATE TRIGGER IF NOT EXISTS stats_predictions_synced AFTER UPDATE OF synced ON predictions
+    WHEN OLD.synced IS NOT NEW.synced
+BEGIN
+    {_bump_unsynced("predictions", "OLD", -1)}
+    {_bump_unsynced("predictions", "NEW", 1)}
+END;
+CREATE TRIGGER IF NOT EXISTS stats_feedback_insert AFTER INSERT ON feedback BEGIN
+    {_bump_feedback("NEW", 1)}
+    {_bump_unsynced("feedback", "NEW", 1)}
+END;
+CREATE TRIGGER IF NOT EXISTS stats_feedback_delete AFTER DELETE ON feedback BEGIN
+    {_bump_feedback("OLD", -1)}
+    {_bump_unsynced("feedback", "OLD", -1)}
+END;
+CREATE TRIGGER IF NOT EXISTS stats_feedback_update AFTER UPDATE OF prediction, username, feedback, actual_label
+    ON feedback
+    WHEN OLD.prediction IS NOT NEW.prediction OR OLD.username IS NOT NEW.username
+        OR OLD.feedback IS NOT NEW.feedback OR OLD.actual_label IS NOT NEW.actual_label
+BEGIN
+    {_bump_feedback("OLD", -1)}
+    {_bump_feedback("NEW", 1)}
+END;
+CREATE TRIGGER IF NOT EXISTS stats_feedback_synced AFTER UPDATE OF synced ON feedback
+    WHEN OLD.synced IS NOT NEW.synced
+BEGIN
+    {_bump_unsynced("feedback", "OLD", -1)}
+    {_bump_unsynced("feedback", "NEW", 1)}
+END;
+"""
+
+# What the aggregates should hold, computed from the raw records; used by
+# rebuild() and check(). Each yields the aggregate table's columns in order.
+EXPECTED = {
+    "stats_predictions": """
+        SELECT 'all', '', substr(timestamp, 1, 10), prediction, COUNT(*) FROM predictions
+            GROUP BY 3, 4
+        UNION ALL
+        SELECT 'all', '', '', prediction, COUNT(*) FROM predictions GROUP BY 4
+        UNION ALL
+        SELECT 'user', COALESCE(username, ''), substr(timestamp, 1, 10), prediction, COUNT(*)
+            FROM predictions GROUP BY 2, 3, 4
+        UNION ALL
+        SELECT 'user', COALESCE(username, ''), '', prediction, COUNT(*) FROM predictions GROUP BY 2, 4
+    """,
+    "stats_feedback": """
+        SELECT 'all', '', COALESCE(prediction, ''), feedback, COUNT(*) FROM feedback GROUP BY 3, 4
+        UNION ALL
+        SELECT 'user', COALESCE(username, ''), COALESCE(prediction, ''), feedback, COUNT(*)
+            FROM feedback GROUP BY 2, 3, 4
+    """,
+    "stats_confusion": """
+        SELECT 'all', '', COALESCE(prediction, ''), actual_label, COUNT(*) FROM feedback
+            WHERE feedback = 'Incorrect' AND actual_label IS NOT NULL GROUP BY 3, 4
+        UNION ALL
+        SELECT 'user', COALESCE(username, ''), COALESCE(prediction, ''), actual_label, COUNT(*)
+            FROM feedback WHERE feedback = 'Incorrect' AND actual_label IS NOT NULL GROUP BY 2, 3, 4
+    """,
+    "stats_totals": """
+        SELECT 'unsynced_predictions', (SELECT COUNT(*) FROM predictions WHERE synced = 0)
+        UNION ALL
+        SELECT 'unsynced_feedback', (SELECT COUNT(*) FROM feedback WHERE synced = 0)
+    """,
+}
+
+
+def install(conn):
+    """Create the aggregate tables and triggers; backfill them the first time.
+
+    Needs the predictions and feedback tables with all their upgrade
+    columns in place (called from PredictionStore).
+    """
+    conn.executescript(SCHEMA)
+    conn.executescript(TRIGGERS)
+    if conn.execute("SELECT 1 FROM meta WHERE key = ?", (INSTALLED_KEY,)).fetchone() is None:
+        rebuild(conn)
+
+
+def rebuild(conn):
+    """Recompute every aggregate from the raw records in one transaction"""
+    # IMMEDIATE takes the write lock up front, so no write lands between the
+    # DELETE and the recount
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for table, query in EXPECTED.items():
+            conn.execute(f"DELETE FROM {table}")
+            conn.execute(f"INSERT INTO {table} {query}")
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                     (INSTALLED_KEY, time.strftime("%Y-%m-%d %H:%M:%S")))
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+
+def check(conn):
+    """[(table, key, expected, actual), ...] for every aggregate that disagrees with the records.
+
+    Zero counts left behind by decrements equal missing rows.
+    """
+    mismatches = []
+    for table, query in EXPECTED.items():
+        expected = {tuple(row[:-1]): row[-1] for row in conn.execute(query)}
+        actual = {tuple(row[:-1]): row[-1] for row in conn.execute(f"SELECT * FROM {table}")}
+        for key in sorted(set(expected) | set(actual), key=str):
+            if expected.get(key, 0) != actual.get(key, 0):
+                mismatches.append((table, key, expected.get(key, 0), actual.get(key, 0)))
+    return mismatches
+
+
+class UsageStats:
+    """Read side of the aggregates, for the Statistics dashboard"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def _conn(self):
+        return db.connect(self.path)
+
+    def _scope(self, username):
+        return ("user", username) if username is not None else ("all", "")
+
+    def label_totals(self, username=None):
+        """{label: predictions} all-time, for one user or everyone"""
+        rows = self._conn().execute(
+            "SELECT label, count FROM stats_predictions "
+            "WHERE scope = ? AND username = ? AND day = '' AND count > 0 ORDER BY count DESC",
+            self._scope(username),
+        )
+        return {row["label"]: row["count"] for row in rows}
+
+    def daily_counts(self, username=None, days=DASHBOARD_DAYS):
+        """[{"day", "label", "count"}] for the last days days"""
+        since = time.strftime("%Y-%m-%d", time.localtime(time.time() - days * 86400))
+        rows = self._conn().execute(
+            "SELECT day, label, count FROM stats_predictions "
+            "WHERE scope = ? AND username = ? AND day >= ? AND count > 0 ORDER BY day, label",
+            (*self._scope(username), since),
+        )
+        return [dict(row) for row in rows]
+
+    def feedback_accuracy(self, username=None):
+        """{label: {feedback: count, ..., "accuracy"}}; accuracy is the share marked Correct"""
+        rows = self._conn().execute(
+            "SELECT label, feedback, count FROM stats_feedback "
+            "WHERE scope = ? AND username = ? AND count > 0",
+            self._scope(username),
+        )
+        accuracy = {}
+        for row in rows:
+            accuracy.setdefault(row["label"], {})[row["feedback"]] = row["count"]
+        for counts in accuracy.values():
+            counts["accuracy"] = counts.get("Correct", 0) / sum(counts.values())
+        return accuracy
+
+    def confusion(self, username=None):
+        """[{"predicted", "actual", "count"}] from Incorrect feedback, most frequent first"""
+        rows = self._conn().execute(
+            "SELECT predicted, actual, count FROM stats_confusion "
+            "WHERE scope = ? AND username = ? AND count > 0 ORDER BY count DESC",
+            self._scope(username),
+        )
+        return [dict(row) for row in rows]
+
+    def sync_backlog(self):
+        rows = self._conn().execute("SELECT key, value FROM stats_totals")
+        totals = {row["key"]: row["value"] for row in rows}
+        return {key: totals.get(key, 0) for key in TOTAL_KEYS}
+
+
+_stats = None
+_stats_lock = threading.Lock()
+
+
+def get_usage_stats():
+    """Return the process-wide reader over the shared prediction store"""
+    global _stats
+    if _stats is None:
+        with _stats_lock:
+            if _stats is None:
+                from prediction_store import get_store
+                _stats = UsageStats(get_store().path)
+    return _stats
+
+
+def main(argv=None):
+    from prediction_store import DB_PATH, PredictionStore
+
+    parser = argparse.ArgumentParser(description="Check or rebuild the usage statistics aggregates")
+    parser.add_argument("--db", default=str(DB_PATH))
+    parser.add_argument("--rebuild", action="store_true", help="recompute the aggregates before checking")
+    args = parser.parse_args(argv)
+
+    # Creates the tables and triggers if this database predates them
+    conn = db.connect(PredictionStore(args.db).path)
+    if args.rebuild:
+        start = time.perf_counter()
+        rebuild(conn)
+        print(f"Rebuilt aggregates in {(time.perf_counter() - start) * 1000:.0f} ms")
+    mismatches = check(conn)
+    for table, key, expected, actual in mismatches[:50]:
+        print(f"{table} {key}: records say {expected}, aggregate has {actual}")
+    print(f"{len(mismatches)} mismatched aggregates" if mismatches else "Aggregates match the records")
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,118 @@
+"""User accounts in users.db.
+
+Uses the shared per-thread WAL connections from db.py, so concurrent
+logins don't open a fresh connection each or fail with "database is
+locked". Passwords are hashed with salted scrypt, stored as
+
+    scrypt$<n>$<r>$<p>$<salt hex>$<hash hex>
+
+Legacy unsalted SHA-256 hashes, and scrypt hashes made with an older
+cost setting, are transparently re-hashed on the next successful login.
+"""
+import hashlib
+import hmac
+import os
+import secrets
+import sqlite3
+import threading
+from pathlib import Path
+
+import db
+
+USERS_DB_PATH = Path("users.db")
+
+# scrypt cost. Each login costs ~128 * N * r bytes of memory and time
+# roughly linear in N; tune with benchmarks/login.py against login p99.
+SCRYPT_N = int(os.environ.get("CROP_SCRYPT_N", 2 ** 14))
+SCRYPT_R = 8
+SCRYPT_P = 1
+SALT_BYTES = 16
+HASH_BYTES = 32
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users
+    (username TEXT PRIMARY KEY,
+     password TEXT,
+     email TEXT)
+"""
+
+
+def _scrypt(password, salt, n, r, p):
+    return hashlib.scrypt(
+        password.encode(), salt=salt, n=n, r=r, p=p,
+        maxmem=2 * 128 * n * r * p + (1 << 20), dklen=HASH_BYTES,
+    )
+
+
+def hash_password(password, n=None, r=None, p=None):
+    # Read the cost at call time so changing SCRYPT_N takes effect immediately
+    n, r, p = n or SCRYPT_N, r or SCRYPT_R, p or SCRYPT_P
+    salt = secrets.token_bytes(SALT_BYTES)
+    return f"scrypt${n}${r}${p}${salt.hex()}${_scrypt(password, salt, n, r, p).hex()}"
+
+
+def check_password(password, stored):
+    """(matches, needs_rehash) for a stored scrypt or legacy SHA-256 hash"""
+    if stored.startswith("scrypt$"):
+        _, n, r, p, salt, expected = stored.split("$")
+        n, r, p = int(n), int(r), int(p)
+        actual = _scrypt(password, bytes.fromhex(salt), n, r, p)
+        matches = hmac.compare_digest(actual, bytes.fromhex(expected))
+        return matches, (n, r, p) != (SCRYPT_N, SCRYPT_R, SCRYPT_P)
+
+    legacy = hashlib.sha256(password.encode()).hexdigest()
+    return hmac.compare_digest(legacy, stored), True
+
+
+class UserStore:
+    def __init__(self, path=USERS_DB_PATH):
+        self.path = Path(path)
+        with self._conn() as conn:
+            conn.execute(SCHEMA)
+
+    def _conn(self):
+        return db.connect(self.path)
+
+    def create_user(self, username, password, email):
+        try:
+            with self._conn() as conn:
+                conn.execute(
+                    "INSERT INTO users (username, password, email) VALUES (?, ?, ?)",
+                    (username, hash_password(password), email),
+                )
+            return True
+        except sqlite3.IntegrityError:
+            return False  # Username already exists
+
+    def verify_user(self, username, password):
+        row = self._conn().execute(
+            "SELECT password FROM users WHERE username = ?", (username,)
+        ).fetchone()
+        if row is None:
+            # Spend the same time as a real check so response time
+            # doesn't reveal which usernames exist
+            _scrypt(password, b"\0" * SALT_BYTES, SCRYPT_N, SCRYPT_R, SCRYPT_P)
+            return False
+
+        matches, needs_rehash = check_password(password, row["password"])
+        if matches and needs_rehash:
+            with self._conn() as conn:
+                conn.execute(
+                    "UPDATE users SET password = ? WHERE username = ? AND password = ?",
+                    (hash_password(password), username, row["password"]),
+                )
+        return matches
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_user_store():
+    """Return the process-wide user store; the table is created once per process"""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = UserStore()
+    return _store